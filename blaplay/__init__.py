@@ -122,6 +122,10 @@ def finish_startup():
     # Initialize the library.
     bla.library = bladb.init()
 
+    # Initialize the fingerprint index for duplicate detection.
+    from blaplay.blacore import blafingerprint
+    blafingerprint.init()
+
     # Create an instance of the playback device.
     from blaplay.blacore import blaplayer
     bla.player = blaplayer.init()
@@ -71,7 +71,9 @@ def init(self):
                 "use.equalizer": "no",
                 "equalizer.profile": "",
                 "volume": "1.0",
-                "muted": "no"
+                "muted": "no",
+                "replaygain.mode": blaconst.REPLAYGAIN_OFF,
+                "replaygain.preamp": "0.0"
             },
             "equalizer.profiles": {
             },
@@ -85,7 +87,13 @@ def init(self):
                 "return.action": blaconst.ACTION_SEND_TO_NEW,
                 "draw.tree.lines": "yes",
                 "custom.browser": "yes",
-                "update.on.startup": "yes"
+                "update.on.startup": "yes",
+                "parser.workers": 0,
+                "fingerprint.tracks": "no",
+                "replaygain.write.tags": "no",
+                "rename.pattern": "<artist>/<album>/<track> - <title>",
+                "tags.pattern": "<artist>/<album>/<track> - <title>",
+                "monitor.poll.interval": 30
             },
             "keybindings": {
                 "playpause": "",
@@ -37,6 +37,7 @@
 IMAGES_PATH = os.path.join(BASEDIR, "images")
 ICONS_PATH = os.path.join(IMAGES_PATH, "icons")
 COVERS = os.path.join(CACHEDIR, "covers")
+COVER_IMAGES = os.path.join(COVERS, "images")
 ARTISTS = os.path.join(CACHEDIR, "artists")
 RELEASES = os.path.join(CACHEDIR, "releases")
 EVENTS = os.path.join(CACHEDIR, "events")
@@ -44,6 +45,8 @@
 # Files
 CFG_PATH = os.path.join(USERDIR, "config")
 PIDFILE = os.path.join(USERDIR, "pid")
+STORE_PATH = os.path.join(USERDIR, "store")
+FINGERPRINTS_PATH = os.path.join(USERDIR, "fingerprints")
 LIBRARY_PATH = os.path.join(USERDIR, "library")
 OOL_PATH = os.path.join(USERDIR, "ool")
 PLAYLISTS_PATH = os.path.join(USERDIR, "playlists")
@@ -67,6 +70,7 @@
 STATE_PLAYING, STATE_PAUSED, STATE_STOPPED = xrange(3)
 TRACK_PLAY, TRACK_NEXT, TRACK_PREVIOUS, TRACK_RANDOM = xrange(4)
 EQUALIZER_BANDS = 10
+REPLAYGAIN_OFF, REPLAYGAIN_TRACK, REPLAYGAIN_ALBUM = xrange(3)
 
 BORDER_PADDING = 3
 WIDGET_SPACING = gtk.HPaned().style_get_property("handle_size")
@@ -0,0 +1,203 @@
+# blaplay, Copyright (C) 2014  Niklas Koep
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+"""
+Cache of cover art found while parsing files. Covers are either embedded in
+the files or image files next to them. Images are stored under the SHA-1
+digest of their contents so a cover shared by all tracks of an album, or by
+several copies of an album, is kept only once. Tracks refer to their image by
+name through the COVER_ART property. Scaled-down copies for the cover display
+are generated along with the image so showing a cover never requires looking
+further than the cache.
+"""
+
+import os
+import re
+import hashlib
+
+import gobject
+import gtk
+
+from blaplay.blacore import blaconst
+from blaplay import blautil, formats
+from blaplay.formats._identifiers import *
+
+# Edge lengths of the scaled-down copies of every image.
+THUMBNAIL_SIZES = [128, 256, 512]
+
+_EXTENSIONS = [("\xff\xd8", "jpg"), ("\x89PNG", "png"), ("GIF8", "gif")]
+
+# Value of COVER_ART for tracks which have been searched for a cover without
+# success. It doesn't name an image in the cache.
+NO_COVER = "none"
+
+_FOLDER_IMAGE = re.compile(
+    r"front|cover|^folder|^albumart.*large", re.UNICODE)
+
+
+def _get_extension(data):
+    for magic, ext in _EXTENSIONS:
+        if data.startswith(magic):
+            return ext
+    return None
+
+def _write(path, data):
+    # Worker processes might store the same image at the same time so write
+    # to a private file first and move it into place atomically.
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+def get_thumbnail_path(name, size):
+    return os.path.join(blaconst.COVER_IMAGES, "%s-%d.png" % (
+        blautil.toss_extension(name), size))
+
+def get_thumbnail(path, size):
+    """
+    Returns the path of the smallest pre-scaled copy of the cached image at
+    `path' which is at least `size' pixels wide, or `path' itself if there is
+    none.
+    """
+
+    if os.path.dirname(path) != blaconst.COVER_IMAGES:
+        return path
+    name = os.path.basename(path)
+    for thumbnail_size in THUMBNAIL_SIZES:
+        if thumbnail_size >= size:
+            thumbnail = get_thumbnail_path(name, thumbnail_size)
+            if os.path.isfile(thumbnail):
+                return thumbnail
+            break
+    return path
+
+def _make_thumbnails(path, name):
+    try:
+        pb = gtk.gdk.pixbuf_new_from_file(path)
+    except gobject.GError:
+        return
+    width, height = pb.get_width(), pb.get_height()
+    for size in THUMBNAIL_SIZES:
+        if size >= max(width, height):
+            break
+        scale = float(size) / max(width, height)
+        thumbnail = pb.scale_simple(
+            max(int(width * scale), 1), max(int(height * scale), 1),
+            gtk.gdk.INTERP_HYPER)
+        thumbnail_path = get_thumbnail_path(name, size)
+        tmp_path = "%s.%d.tmp" % (thumbnail_path, os.getpid())
+        try:
+            thumbnail.save(tmp_path, "png")
+            os.rename(tmp_path, thumbnail_path)
+        except (gobject.GError, OSError):
+            pass
+
+def store(data):
+    """
+    Adds the image `data' to the cache and returns its name, or None if the
+    image format isn't supported.
+    """
+
+    ext = _get_extension(data)
+    if ext is None:
+        return None
+    name = "%s.%s" % (hashlib.sha1(data).hexdigest(), ext)
+    path = os.path.join(blaconst.COVER_IMAGES, name)
+    if not os.path.isfile(path):
+        try:
+            _write(path, data)
+        except (IOError, OSError) as exc:
+            print_d("Failed to store cover \"%s\": %s" % (path, exc))
+            return None
+        _make_thumbnails(path, name)
+    return name
+
+def _find_folder_image(directory):
+    try:
+        names = sorted(os.listdir(directory))
+    except OSError:
+        return None
+    for name in names:
+        if (blautil.get_extension(name).lower() in ["jpg", "png"] and
+            _FOLDER_IMAGE.search(name.lower())):
+            return os.path.join(directory, name)
+    return None
+
+def _extract(path, directory, seen):
+    # Embedded art takes precedence over images in the track's directory.
+    try:
+        picture = formats.get_picture(path)
+    except Exception as exc:
+        print_d("Failed to extract cover from \"%s\": %r" % (path, exc))
+        picture = None
+    if picture is not None:
+        name = store(picture[1])
+        if name is not None:
+            return name
+
+    # Every directory is only searched once.
+    try:
+        return seen[directory]
+    except KeyError:
+        pass
+    name = seen[directory] = _store_folder_image(directory)
+    return name
+
+def _store_folder_image(directory):
+    image = _find_folder_image(directory)
+    if image is None:
+        return None
+    try:
+        with open(image, "rb") as f:
+            return store(f.read())
+    except IOError:
+        return None
+
+def find_cover(path, seen):
+    """
+    Adds the cover of the file at `path', either embedded or an image in its
+    directory, to the cache and returns its name, or None if there is none.
+    `seen' caches the results per directory like for extract(). Tracks
+    parsed before covers were extracted along with their tags have to be
+    looked up this way.
+    """
+
+    return _extract(path, os.path.dirname(path), seen)
+
+def extract(tracks, seen):
+    """
+    Sets the COVER_ART property of the freshly parsed `tracks' to the name of
+    their cover in the cache, adding the cover to the cache if necessary, or
+    to NO_COVER if they don't have one.
+    `seen' should be shared between calls for files parsed in one go. Tracks
+    of the same album in the same directory then only have their cover
+    extracted once.
+    """
+
+    for track in tracks:
+        path = formats.split_uri(track.uri)[0]
+        directory = os.path.dirname(path)
+        # Tracks without an album tag might well have different covers.
+        album = track[ALBUM]
+        if not album:
+            name = _extract(path, directory, seen)
+        else:
+            key = (directory, album)
+            try:
+                name = seen[key]
+            except KeyError:
+                name = seen[key] = _extract(path, directory, seen)
+        track[COVER_ART] = name or NO_COVER
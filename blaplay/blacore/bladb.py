@@ -19,23 +19,41 @@
 locale.setlocale(locale.LC_ALL, "")
 import shutil
 import time
-import re
 import threading
 import Queue
+import itertools
 import multiprocessing
 
 import gobject
 import gtk
-import gio
 
 import blaplay
-from blaplay.blacore import blacfg, blaconst
+from blaplay.blacore import (
+    blacfg, blaconst, blastore, blaparse, blawatch, blacovers)
+from blaplay.blacore.blawatch import (
+    EVENT_CREATED, EVENT_DELETED, EVENT_MOVED, EVENT_CHANGED, EVENT_OVERFLOW)
 from blaplay import blautil, formats
 get_track = formats.get_track
+get_tracks = formats.get_tracks
 from blaplay.blagui import blaguiutils
 from blaplay.formats._identifiers import *
+from blaplay.formats._blatable import BlaTrackTable, BlaTrackRow
 
-EVENT_CREATED, EVENT_DELETED, EVENT_MOVED, EVENT_CHANGED = xrange(4)
+# Events arriving within EVENT_WINDOW seconds of each other are coalesced into
+# one batch. A batch is dispatched after EVENT_MAX_DELAY seconds or once it
+# holds EVENT_MAX_BATCH_SIZE events, whichever comes first.
+EVENT_WINDOW = 0.5
+EVENT_MAX_DELAY = 5.0
+EVENT_MAX_BATCH_SIZE = 10000
+
+# Table ids of the library store
+(TABLE_LIBRARY, TABLE_SNAPSHOT, TABLE_DIRECTORIES, TABLE_OOL,
+ TABLE_FAILURES, TABLE_SHEETS) = xrange(6)
+
+# Tags covered by the library's search index. Track basenames are indexed as
+# well.
+SEARCH_IDENTIFIERS = (ARTIST, TITLE, ALBUM, ALBUM_ARTIST, COMPOSER, PERFORMER,
+                      DATE, GENRE, FORMAT)
 
 # TODO: Move `pending_save' or a similar variable into BlaLibrary.
 pending_save = False
@@ -56,138 +74,215 @@ def update_library():
 
 class BlaLibraryMonitor(gobject.GObject):
     __gsignals__ = {
-        "initialized": blautil.signal(1)
+        "initialized": blautil.signal(1),
+        "overflowed": blautil.signal(0)
     }
 
-    __monitors = {}
-    __lock = blautil.BlaLock()
     __queue = Queue.Queue()
     __processing = False
+    # Paths whose next event is skipped because whoever caused it, e.g. the
+    # tag writer or the renamer, updates the library on its own.
     ignore = set()
 
-    def __init__(self):
+    def __init__(self, directory_cache=None):
         super(BlaLibraryMonitor, self).__init__()
+        self.__directory_cache = directory_cache
+        self.__watcher = blawatch.create_watcher(self.__queue_event)
+        print_d("Using the `%s' watcher backend" % self.__watcher.name)
+        # Directories which don't fit into the primary watcher due to the
+        # system's watch limit are handed to a polling watcher.
+        self.__poller = None
         self.__process_events()
 
-    def __queue_event(self, monitor, path_from, path_to, type_):
-        if type_ == gio.FILE_MONITOR_EVENT_CHANGES_DONE_HINT:
-            event = EVENT_CHANGED
-        elif type_ == gio.FILE_MONITOR_EVENT_DELETED:
-            event = EVENT_DELETED
-        elif type_ == gio.FILE_MONITOR_EVENT_MOVED:
-            event = EVENT_MOVED
-        elif type_ == gio.FILE_MONITOR_EVENT_CREATED:
-            event = EVENT_CREATED
-            path = path_from.get_path()
-            if os.path.isdir(path):
-                self.add_directory(path)
-        else:
-            event = None
-
-        if event is not None:
-            path_from = path_from.get_path()
-            try:
-                path_to = path_to.get_path()
-            except AttributeError:
-                pass
-            self.__queue.put((event, path_from, path_to))
+    def __queue_event(self, event, path_from, path_to):
+        if event == EVENT_OVERFLOW:
+            self.__rescan()
+            return
+        if event == EVENT_CREATED and os.path.isdir(path_from):
+            self.add_directory(path_from)
+        self.__queue.put((event, path_from, path_to))
 
     @blautil.thread
-    def __process_events(self):
-        EVENTS = {
-            EVENT_CREATED: "EVENT_CREATED",
-            EVENT_DELETED: "EVENT_DELETED",
-            EVENT_CHANGED: "EVENT_CHANGED",
-            EVENT_MOVED: "EVENT_MOVED"
-        }
-
-        tid = -1
-
-        while True:
-            event, path_from, path_to = self.__queue.get()
-            print_d("New event of type `%s' for file %s (%r)" %
-                    (EVENTS[event], path_from, path_to))
+    def __rescan(self):
+        # The watcher lost events. Watch any directories created in the
+        # meantime and let the library reconcile itself with the file system.
+        self.__watch(self.__get_subdirectories(
+            blacfg.getdotliststr("library", "directories")))
+        gobject.idle_add(self.emit, "overflowed")
+
+    def __watch(self, directories):
+        for directory in directories:
+            if self.__poller is not None and directory in self.__poller:
+                continue
+            try:
+                self.__watcher.add_directory(directory)
+            except blawatch.BlaWatchLimitError as exc:
+                if self.__poller is None:
+                    print_w("%s, polling remaining directories" % exc)
+                    self.__poller = blawatch.BlaPollingWatcher(
+                        self.__queue_event,
+                        blacfg.getint("library", "monitor.poll.interval"),
+                        self.__directory_cache)
+                self.__poller.add_directory(directory)
+            except OSError as exc:
+                print_d("Failed to watch `%s': %s" % (directory, exc))
+
+    def get_watch_counts(self):
+        # Returns a dict mapping the names of the watcher backends in use to
+        # the number of watches they hold.
+        counts = {self.__watcher.name: len(self.__watcher)}
+        if self.__poller is not None:
+            counts[self.__poller.name] = len(self.__poller)
+        return counts
+
+    def __coalesce_events(self, events):
+        # Collapses a list of events into a list of operations. Every path is
+        # added or removed at most once per batch, e.g. the CREATED event and
+        # the subsequent CHANGED events for a copied file result in a single
+        # add. Moves act as a barrier for the paths involved so operations are
+        # still applied in the order the events occurred in.
+        operations = []
+        pending = {}
+        ignore = BlaLibraryMonitor.ignore
+
+        def cancel(path):
+            try:
+                idx = pending.pop(path)
+            except KeyError:
+                return None
+            event = operations[idx][0]
+            operations[idx] = None
+            return event
+
+        for event, path_from, path_to in events:
+            if event in (EVENT_CREATED, EVENT_CHANGED):
+                if path_from in ignore:
+                    ignore.remove(path_from)
+                    continue
+                try:
+                    if operations[pending[path_from]][0] == EVENT_CREATED:
+                        continue
+                except KeyError:
+                    pass
+                pending[path_from] = len(operations)
+                operations.append((EVENT_CREATED, path_from, None))
 
-            # TODO: Rename this.
-            update = True
-            gobject.source_remove(tid)
+            elif event == EVENT_DELETED:
+                if path_from in ignore:
+                    ignore.remove(path_from)
+                    continue
+                cancel(path_from)
+                pending[path_from] = len(operations)
+                operations.append((EVENT_DELETED, path_from, None))
 
-            if event == EVENT_CREATED:
-                if path_from in BlaLibraryMonitor.ignore:
-                    BlaLibraryMonitor.ignore.remove(path_from)
-                    update = False
-                elif os.path.isfile(path_from):
-                    library.add_tracks([path_from])
+            else: # event == EVENT_MOVED
+                if path_from in ignore:
+                    ignore.remove(path_from)
+                    ignore.discard(path_to)
+                    continue
+                # A file which was created and renamed within the same batch,
+                # e.g. a finished download, only needs to be added under its
+                # final name.
+                if cancel(path_from) == EVENT_CREATED:
+                    cancel(path_to)
+                    pending[path_to] = len(operations)
+                    operations.append((EVENT_CREATED, path_to, None))
                 else:
-                    # For files that are copied a CHANGED event is triggered
-                    # as well. This is not the case for moved files. This is
-                    # why we can't add any paths to the ignore set here as they
-                    # might never be removed again. Unfortunately, we have no
-                    # choice but to let the event handlers do their job even if
-                    # it means checking certain files multiple times.
-                    library.add_tracks(blautil.discover(path_from))
-
-            elif event == EVENT_CHANGED:
-                if path_from in BlaLibraryMonitor.ignore:
-                    BlaLibraryMonitor.ignore.remove(path_from)
-                    update = False
-                elif os.path.isfile(path_from):
-                    library.add_tracks([path_from])
-
-            elif event == EVENT_DELETED:
-                # This is a bit fiddly. We can't check if whatever was deleted
-                # was a file or a directory since it's already unlinked.
-                # We therefore have to check every URI in the library against
-                # `path_from'. If we get an exact match we can remove the track
-                # and stop since URIs are unique. If we get a partial match we
-                # have to continue looking. To keep string comparison to a
-                # minimum we use str.startswith to see if we should remove a
-                # track. We then check if the strings have the same length as
-                # this indicates an exact match so we can stop iterating.
-                l = len(path_from)
-                try:
-                    # iterating over a BlaLibrary instance uses a generator so
-                    # we have to make a list of tracks to remove first
-                    for uri in library:
-                        if uri.startswith(path_from) and uri[l] == "/":
-                            library.remove_track(uri)
-                except IndexError:
-                    # IndexError will only be raised for exact matches, meaning
-                    # we removed a file.
-                    library.remove_track(uri)
+                    cancel(path_to)
+                    operations.append((EVENT_MOVED, path_from, path_to))
+
+        return filter(None, operations)
+
+    def __dispatch(self, operations):
+        added = []
+        moved = {}
+
+        def add_tracks():
+            # Consecutive adds are handed to the library in one go.
+            if added:
+                files = []
+                for path in added:
+                    if os.path.isfile(path):
+                        files.append(path)
+                    elif os.path.isdir(path):
+                        files.extend(blautil.discover(path))
+                library.add_tracks(files)
+                del added[:]
+
+        for event, path_from, path_to in operations:
+            if event == EVENT_CREATED:
+                added.append(path_from)
+                continue
+            add_tracks()
+
+            if event == EVENT_DELETED:
+                # We can't check if whatever was deleted was a file or a
+                # directory since it's already unlinked. If `path_from' is in
+                # the library we removed a file. Otherwise we remove every
+                # track and every monitor below it.
+                if path_from in library:
+                    library.remove_track(path_from)
                 else:
-                    # If we made it this far we didn't get an exact match so
-                    # we removed a directory. In this case we remove every file
-                    # monitor under the given directory.
+                    # This also takes care of CUE sheets and of files which
+                    # back the virtual tracks of a sheet.
+                    library.remove_track(path_from)
+                    map(library.remove_track,
+                        library.get_uris_below(path_from))
                     self.remove_directories(path_from)
 
             else: # event == EVENT_MOVED
-                uris = {}
                 if os.path.isfile(path_to):
                     library.move_track(path_from, path_to)
-                    uris[path_from] = path_to
+                    moved[path_from] = path_to
                 else:
-                    for uri in library:
-                        if uri.startswith(path_from):
-                            new_path = os.path.join(
-                                path_to, uri[len(path_from)+1:])
-                            library.move_track(uri, new_path)
-                            uris[uri] = new_path
+                    for uri in library.get_uris_below(path_from):
+                        new_path = os.path.join(
+                            path_to, uri[len(path_from)+1:])
+                        library.move_track(uri, new_path)
+                        moved[uri] = new_path
 
                     self.remove_directories(path_from)
                     self.add_directory(path_to)
-                # TODO: Add a `library_entries_moved' signal for this so we
-                #       don't need to call methods on the playlist manager.
-                from blaplay.blagui.blaplaylist import BlaPlaylistManager
-                BlaPlaylistManager().update_uris(uris)
+        add_tracks()
+
+        if moved:
+            # TODO: Add a `library_entries_moved' signal for this so we
+            #       don't need to call methods on the playlist manager.
+            from blaplay.blagui.blaplaylist import BlaPlaylistManager
+            BlaPlaylistManager().update_uris(moved)
+
+    @blautil.thread
+    def __process_events(self):
+        tid = -1
+
+        while True:
+            # Collect events until the queue stayed empty for the length of
+            # the coalescing window or the batch is due anyway.
+            events = [self.__queue.get()]
+            deadline = time.time() + EVENT_MAX_DELAY
+            while len(events) < EVENT_MAX_BATCH_SIZE:
+                timeout = min(EVENT_WINDOW, deadline - time.time())
+                if timeout <= 0:
+                    break
+                try:
+                    events.append(self.__queue.get(timeout=timeout))
+                except Queue.Empty:
+                    break
+
+            operations = self.__coalesce_events(events)
+            print_d("Processing %d events as %d operations" %
+                    (len(events), len(operations)))
+            if not operations:
+                continue
+
+            gobject.source_remove(tid)
+            self.__dispatch(operations)
 
             # Schedule an update for the library browser, etc. The timeout
-            # might be removed immediately at the beginning of this loop if
-            # there are more events in the queue.
-            if update:
-                global pending_save
-                pending_save = True
-                tid = gobject.timeout_add(3000, update_library)
+            # might be removed again if more events arrive in the meantime.
+            global pending_save
+            pending_save = True
+            tid = gobject.timeout_add(3000, update_library)
 
     def __get_subdirectories(self, directories):
         # The heavy lifting here is actually just getting a list of all the
@@ -223,48 +318,26 @@ def get_subdirectories(conn, directories):
     def add_directory(self, directory):
         # TODO: this is largely identical to update_directories. combine the
         #       two methods
-        directories = self.__get_subdirectories(directory)
-
-        with self.__lock:
-            for directory in directories:
-                if directory in self.__monitors:
-                    continue
-                f = gio.File(directory)
-                monitor = f.monitor_directory(
-                    flags=gio.FILE_MONITOR_NONE | gio.FILE_MONITOR_SEND_MOVED)
-                monitor.connect("changed", self.__queue_event)
-                self.__monitors[directory] = monitor
+        self.__watch(self.__get_subdirectories(directory))
 
     @blautil.thread
     def remove_directories(self, md):
-        with self.__lock:
-            for directory in sorted(self.__monitors.keys()):
-                if directory.startswith(md):
-                    self.__monitors.pop(directory).cancel()
+        self.__watcher.remove_directories(md)
+        if self.__poller is not None:
+            self.__poller.remove_directories(md)
 
     @blautil.thread
     def update_directories(self):
         monitored_directories = blacfg.getdotliststr("library", "directories")
         directories = self.__get_subdirectories(monitored_directories)
 
-        with self.__lock:
-            cancel = gio.FileMonitor.cancel
-            map(cancel, self.__monitors.itervalues())
-            self.__monitors.clear()
-
-            # According to the GIO C API documentation there are backends which
-            # don't support gio.FILE_MONITOR_EVENT_MOVED. However, since we
-            # specifically target Linux which has inotify since kernel 2.6.13
-            # we should be in the clear (that is if the kernel in use was
-            # compiled with inotify support).
-            for directory in directories:
-                f = gio.File(directory)
-                monitor = f.monitor_directory(
-                    flags=gio.FILE_MONITOR_NONE | gio.FILE_MONITOR_SEND_MOVED)
-                monitor.connect("changed", self.__queue_event)
-                self.__monitors[directory] = monitor
-        print_d("Now monitoring %d directories under %r" %
-                (len(self.__monitors), monitored_directories))
+        self.__watcher.clear()
+        if self.__poller is not None:
+            self.__poller.clear()
+        self.__watch(directories)
+        print_d("Now monitoring %d directories under %r (watches: %r)" %
+                (len(directories), monitored_directories,
+                 self.get_watch_counts()))
         self.emit("initialized", directories)
 
 # TODO: Make this a singleton.
@@ -277,34 +350,65 @@ class BlaLibrary(gobject.GObject):
     __monitored_directories = []
     __scan_queue = []
     __currently_scanning = None
+    # Whether a pass of __detect_changes is running and whether another one
+    # was requested in the meantime.
+    __detecting = False
+    __detect_again = False
+    # Tracks are kept in a columnar table. The dicts below map URIs to row ids
+    # in this table. Library tracks are only decoded from the store when they
+    # are first accessed. Until then they map to None.
+    __table = BlaTrackTable()
     __tracks = {}
     __tracks_ool = {}
+    # Out-of-library tracks are kept as long as playlists reference them. We
+    # count references per URI and remember URIs which might have become
+    # unreferenced so pruning doesn't need to look at every OOL track.
+    __ool_refs = {}
+    __ool_unreferenced = set()
+    # Sorted index of the keys of __tracks to quickly find every track below a
+    # given directory.
+    __index = blautil.BlaPathIndex()
+    # Word index over the tags of library and out-of-library tracks used to
+    # narrow down searches. It's built on the first search.
+    __search_index = None
+    __dirty = set()
+    # Maps URIs of library tracks to the (mtime, size, inode) triple of the
+    # file as of the last startup reconciliation.
+    __snapshot = {}
+    # Cache of directory listings used by blautil.discover_stat().
+    __directories = {}
+    # Maps paths of files which failed to parse to their (mtime, size) pair at
+    # the time. They're skipped until they change.
+    __failures = {}
+    # Maps paths of CUE sheets, or of files with an embedded sheet, to the
+    # URIs of their virtual tracks. Files backing these tracks are only
+    # represented by them and are kept in __covered.
+    __sheets = {}
+    __covered = set()
+    __store = None
     __playlists = []
     __lock = blautil.BlaLock(strict=True)
 
-    def __init__(self):
-        super(BlaLibrary, self).__init__()
-
-        self.__extension_filter = re.compile(
-            r".*\.(%s)$" % "|".join(formats.formats.keys())).match
-
     def __call__(self):
         print_i("Saving pending library changes")
 
-        if pending_save:
-            self.__save_library()
+        # Even without dirty tracks the store might hold pending snapshots,
+        # directory listings or parse failures.
+        self.__save_library()
 
     def __getitem__(self, key):
         try:
-            return self.__tracks[key]
+            row = self.__get_row(key)
         except KeyError:
-            return self.__tracks_ool[key]
+            row = self.__tracks_ool[key]
+        return self.__table.row(row)
 
     def __setitem__(self, key, item):
         if self.__tracks.has_key(key):
-            self.__tracks[key] = item
+            self.__tracks[key] = self.__insert(key, item)
+            self.__mark_dirty(key)
         else:
-            self.__tracks_ool[key] = item
+            self.__add_ool_track(key, self.__insert(key, item))
 
     def __contains__(self, item):
         return item in self.__tracks
@@ -316,27 +420,207 @@ def next(self):
         for uri in self.__tracks.keys():
             yield uri
 
+    def __get_row(self, uri):
+        # Returns the row id of library track `uri', decoding the track from
+        # the store on first access.
+        row = self.__tracks[uri]
+        if row is None:
+            with self.__lock:
+                row = self.__tracks[uri]
+                if row is None:
+                    track = self.__store.get(TABLE_LIBRARY, uri)
+                    if track is None:
+                        del self.__tracks[uri]
+                        self.__index.discard(uri)
+                        if self.__search_index is not None:
+                            self.__search_index.discard(uri)
+                        raise KeyError(uri)
+                    row = self.__tracks[uri] = self.__table.add(track)
+        return row
+
+    def __insert(self, uri, track):
+        # Returns the row id for `track'. If `uri' already refers to a row we
+        # update it in place so existing row views pick up the changes.
+        table = self.__table
+        if isinstance(track, BlaTrackRow):
+            if track.table is table:
+                return track.row
+            track = track.materialize()
+        # Tracks which haven't been decoded yet are simply replaced.
+        try:
+            row = self.__tracks[uri]
+        except KeyError:
+            row = self.__tracks_ool.get(uri)
+        if row is None:
+            row = table.add(track)
+        else:
+            table.update(row, track)
+        self.__index_track(uri, row)
+        return row
+
+    def __index_track(self, uri, row):
+        if self.__search_index is None:
+            return
+        get_first_value = self.__table.get_first_value
+        strings = [get_first_value(row, identifier)
+                   for identifier in SEARCH_IDENTIFIERS]
+        strings.append(os.path.basename(blautil.toss_extension(uri)))
+        self.__search_index.add(uri, strings)
+
+    def __add_ool_track(self, uri, row):
+        self.__tracks_ool[uri] = row
+        self.__ool_unreferenced.add(uri)
+        self.__mark_dirty(uri)
+
+    def __load(self, tracks):
+        add = self.__table.add
+        return dict((uri, add(track)) for uri, track in tracks.iteritems()
+                    if track is not None)
+
+    def __mark_dirty(self, *uris):
+        # The snapshot of a file is invalid once its track changed. Tracks
+        # without a snapshot are checked against the mtime and filesize stored
+        # with the track on the next startup instead.
+        self.__dirty.update(uris)
+        for uri in uris:
+            if self.__snapshot.pop(uri, None) is not None:
+                self.__store.delete(TABLE_SNAPSHOT, uri)
+
+    def __set_snapshot(self, uri, st):
+        state = (st.st_mtime, st.st_size, st.st_ino)
+        if self.__snapshot.get(uri) != state:
+            self.__snapshot[uri] = state
+            self.__store.put(TABLE_SNAPSHOT, uri, state)
+
+    def __is_known_failure(self, uri, st=None):
+        # Returns True if `uri' failed to parse before and hasn't changed
+        # since.
+        try:
+            state = self.__failures[uri]
+        except KeyError:
+            return False
+        if st is None:
+            try:
+                st = os.stat(uri)
+            except OSError:
+                return False
+        return state == (st.st_mtime, st.st_size)
+
+    def __set_failure(self, uri, st=None):
+        if st is None:
+            try:
+                st = os.stat(uri)
+            except OSError:
+                return
+        state = (st.st_mtime, st.st_size)
+        if self.__failures.get(uri) != state:
+            self.__failures[uri] = state
+            self.__store.put(TABLE_FAILURES, uri, state)
+
+    def __clear_failure(self, uri):
+        if self.__failures.pop(uri, None) is not None:
+            self.__store.delete(TABLE_FAILURES, uri)
+
+    def __update_covered(self):
+        split_uri = formats.split_uri
+        self.__covered = set(split_uri(uri)[0]
+                             for uris in self.__sheets.itervalues()
+                             for uri in uris)
+
+    def __set_sheet(self, path, uris):
+        # Virtual tracks which the sheet no longer describes are removed, as
+        # are library tracks of the files backing the sheet.
+        map(self.remove_track,
+            set(self.__sheets.get(path, ())).difference(uris))
+        self.__sheets[path] = uris
+        self.__store.put(TABLE_SHEETS, path, uris)
+        self.__update_covered()
+        split_uri = formats.split_uri
+        for backing in set(split_uri(uri)[0] for uri in uris):
+            if backing in self.__tracks:
+                self.remove_track(backing)
+
+    def __remove_sheet(self, path):
+        try:
+            uris = self.__sheets.pop(path)
+        except KeyError:
+            return
+        self.__store.delete(TABLE_SHEETS, path)
+        if self.__snapshot.pop(path, None) is not None:
+            self.__store.delete(TABLE_SNAPSHOT, path)
+        self.__update_covered()
+        map(self.remove_track, uris)
+
+    def __walk(self, directories):
+        # Generator yielding the (path, stat_result) tuples of all files below
+        # `directories'. Changes to the directory cache are persisted even if
+        # the walk is aborted.
+        cache = self.__directories
+        previous = dict(cache)
+        try:
+            for item in blautil.discover_stat(directories, cache):
+                yield item
+        finally:
+            store = self.__store
+            for dirname, entry in cache.iteritems():
+                if previous.get(dirname) != entry:
+                    store.put(TABLE_DIRECTORIES, dirname, entry)
+            for dirname in set(previous).difference(cache):
+                store.delete(TABLE_DIRECTORIES, dirname)
+
     def __save_library(self):
-        # Pickling a large dict causes quite an increase in memory use as the
-        # module basically creates an exact copy of the object in memory. To
-        # combat the problem we offload the serialization of the library to
-        # another process. We join the process in a separate thread to avoid
-        # that the process turns into a zombie process after it terminates.
-        # If the process itself is spawned from a thread this seems to deadlock
-        # occasionally.
-        p = multiprocessing.Process(
-            target=blautil.serialize_to_file,
-            args=(self.__tracks, blaconst.LIBRARY_PATH))
-        p.start()
+        # Only tracks which were added, changed or removed since the last save
+        # are written to the store. The library monitor might mark tracks as
+        # dirty while we're at it so swap in a fresh set first. Values are
+        # pickled right here while the actual disk I/O happens in a thread.
+        dirty, self.__dirty = self.__dirty, set()
+        store = self.__store
+        materialize = self.__table.materialize
+        for uri in dirty:
+            try:
+                store.put(TABLE_LIBRARY, uri, materialize(self.__get_row(uri)))
+            except KeyError:
+                store.delete(TABLE_LIBRARY, uri)
+            try:
+                store.put(TABLE_OOL, uri, materialize(self.__tracks_ool[uri]))
+            except KeyError:
+                store.delete(TABLE_OOL, uri)
 
         @blautil.thread_nondaemonic
-        def join():
-            p.join()
-        join()
+        def commit():
+            store.commit()
+        commit()
+
+    def __migrate_legacy_file(self, path, table):
+        # Versions prior to the introduction of the store kept library and
+        # out-of-library tracks in one big pickled dict each. Import them once
+        # and get rid of the old files.
+        tracks = blautil.deserialize_from_file(path)
+        if tracks is None:
+            return None
+
+        print_i("Migrating \"%s\" to the new store format" % path)
+        put = self.__store.put
+        for uri, track in tracks.iteritems():
+            put(table, uri, track)
+        self.__store.commit()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        return tracks
 
-    def __detect_changes(self, directories):
-        # XXX: We should be able to update the contents of __tracks in one go.
+    def __request_detection(self, *args):
+        # Requests arriving while a pass is running are collapsed into a
+        # single pass after it.
+        if self.__detecting:
+            self.__detect_again = True
+            return
+        self.__detecting = True
+        p = self.__detect_changes()
+        gobject.idle_add(p.next, priority=gobject.PRIORITY_LOW)
 
+    def __detect_changes(self):
         print_i("Checking for changes in monitored directories %r" %
                 blacfg.getdotliststr("library", "directories"))
 
@@ -349,40 +633,97 @@ def __detect_changes(self, directories):
             if idx % yield_interval == 0:
                 yield True
 
-        # Check for new tracks or tracks in need of updating in monitored
-        # directories.
-        remove_track = self.remove_track
-        updated = 0
-        missing = 0
-        for idx, uri in enumerate(self):
-            try:
-                updated += int(update_track(uri))
-            except TypeError:
-                remove_track(uri)
-                missing += 1
-            if idx % yield_interval == 0:
+        # Walk all monitored directories once and compare the stat results of
+        # every file against the snapshot from the last startup. Only new
+        # files and files whose snapshot doesn't match are parsed again.
+        table = self.__table
+        snapshot = self.__snapshot
+        filt = formats.is_supported
+        is_known_failure = self.__is_known_failure
+        sheets = self.__sheets
+        covered = self.__covered
+        seen = set()
+        changed = {}
+        new = {}
+        # Files backing the virtual tracks of a sheet.
+        backing = {}
+        skipped = 0
+        for idx, (uri, st) in enumerate(
+            self.__walk(self.__monitored_directories)):
+            if idx % (10 * yield_interval) == 0:
                 yield True
+            if not filt(uri):
+                continue
+            seen.add(uri)
+            if uri not in self.__tracks:
+                if uri in sheets:
+                    # Sheets are only parsed again if they changed.
+                    if (snapshot.get(uri) !=
+                        (st.st_mtime, st.st_size, st.st_ino)):
+                        new[uri] = st
+                elif uri in covered:
+                    backing[uri] = st
+                elif is_known_failure(uri, st):
+                    skipped += 1
+                else:
+                    new[uri] = st
+                continue
+            # Comparing against the snapshot doesn't require decoding the
+            # track.
+            try:
+                unchanged = (snapshot[uri] ==
+                             (st.st_mtime, st.st_size, st.st_ino))
+            except KeyError:
+                try:
+                    row = self.__get_row(uri)
+                except KeyError:
+                    new[uri] = st
+                    continue
+                unchanged = (
+                    table.get_value(row, MTIME) == st.st_mtime and
+                    table.get_value(row, FILESIZE) == st.st_size)
+                if unchanged:
+                    self.__set_snapshot(uri, st)
+            if not unchanged:
+                changed[uri] = st
+
+        # Files which no longer back any sheet are added like new ones.
+        map(self.__remove_sheet, [path for path in sheets if path not in seen])
+        for uri, st in backing.iteritems():
+            if uri not in self.__covered:
+                new[uri] = st
 
-        files = set()
-        add = files.add
-        discover = blautil.discover
+        remove_track = self.remove_track
+        split_uri = formats.split_uri
+        missing = [uri for uri in self
+                   if uri not in seen and split_uri(uri)[0] not in seen]
+        map(remove_track, missing)
+        missing = len(missing)
+        map(self.__clear_failure,
+            [uri for uri in self.__failures if uri not in seen])
+
+        updated = 0
         new_files = 0
-        idx = 0
-        for directory in set(directories):
-            for f in discover(directory):
-                if f not in self:
-                    add(f)
-                if len(files) == yield_interval:
-                    new_files += self.add_tracks(files)
-                    files.clear()
-                if idx % yield_interval == 0:
-                    yield True
-                idx += 1
-            if files:
-                new_files += self.add_tracks(files)
+        for tracks in blaparse.parse(itertools.chain(changed, new)):
+            self.__add_parsed_tracks(tracks)
+            for uri, track in tracks:
+                if uri in changed:
+                    if track:
+                        updated += 1
+                    else:
+                        # The file can't be parsed anymore.
+                        remove_track(uri)
+                        missing += 1
+                        continue
+                elif track:
+                    new_files += 1
+                else:
+                    continue
+                self.__set_snapshot(uri, changed.get(uri) or new[uri])
+            yield True
 
-        print_i("%d files missing, %d new ones, %d updated" %
-                (missing, new_files, updated))
+        print_i("%d files missing, %d new ones, %d updated, %d skipped as "
+                "unparseable" % (missing, new_files, updated, skipped))
 
         # Finally update the model for the library browser and playlists. The
         # GUI might not be fully initialized yet, so wait for that to happen
@@ -390,22 +731,45 @@ def __detect_changes(self, directories):
         while blaplay.bla.window is None:
             yield True
         update_library()
+        self.__detecting = False
+        if self.__detect_again:
+            self.__detect_again = False
+            self.__request_detection()
         yield False
 
     def init(self):
         print_i("Initializing the database")
 
-        # Restore the library.
-        tracks = blautil.deserialize_from_file(blaconst.LIBRARY_PATH)
+        # Restore the library by replaying the store.
+        self.__store = blastore.BlaStore(blaconst.STORE_PATH)
+        tracks = dict.fromkeys(self.__store.keys(TABLE_LIBRARY))
+        if not tracks:
+            tracks = self.__migrate_legacy_file(
+                blaconst.LIBRARY_PATH, TABLE_LIBRARY)
+            if tracks is not None:
+                tracks = self.__load(tracks)
+        else:
+            self.__snapshot = dict(self.__store.items(TABLE_SNAPSHOT))
+            self.__directories = dict(
+                self.__store.items(TABLE_DIRECTORIES))
+            self.__failures = dict(self.__store.items(TABLE_FAILURES))
+            self.__sheets = dict(self.__store.items(TABLE_SHEETS))
+            self.__update_covered()
         if tracks is None:
             blacfg.set("library", "directories", "")
         else:
             self.__tracks = tracks
-
-        # Restore out-of-library tracks.
-        tracks = blautil.deserialize_from_file(blaconst.OOL_PATH)
-        if tracks is not None:
-            self.__tracks_ool = tracks
+            self.__index = blautil.BlaPathIndex(self.__tracks)
+
+        # Restore out-of-library tracks. Playlists reference the ones they
+        # need once they're restored. Everything else gets pruned on the next
+        # save.
+        tracks = dict(self.__store.items(TABLE_OOL))
+        if not tracks:
+            tracks = self.__migrate_legacy_file(
+                blaconst.OOL_PATH, TABLE_OOL) or {}
+        self.__tracks_ool = self.__load(tracks)
+        self.__ool_unreferenced.update(self.__tracks_ool)
 
         print_d("Restoring library: %d tracks in the library, %d additional "
                 "tracks" % (len(self.__tracks), len(self.__tracks_ool)))
@@ -415,18 +779,20 @@ def init(self):
 
         def initialized(library_monitor, directories):
             if blacfg.getboolean("library", "update.on.startup"):
-                p = self.__detect_changes(directories)
-                gobject.idle_add(p.next, priority=gobject.PRIORITY_LOW)
+                self.__request_detection()
                 # TODO: This is more efficient than the method above. However,
                 # it does not clean up missing tracks.
                 # for md in self.__monitored_directories:
                 #     self.scan_directory(md)
             self.__library_monitor.disconnect(cid)
-        self.__library_monitor = BlaLibraryMonitor()
+        self.__library_monitor = BlaLibraryMonitor(self.__directories)
         cid = self.__library_monitor.connect("initialized", initialized)
         # FIXME: Pass in `initialized' as a callback function instead of using
         #        a single-purpose-single-use signal.
         self.__library_monitor.update_directories()
+        # Events lost by the watcher are made up for by checking the monitored
+        # directories for changes.
+        self.__library_monitor.connect("overflowed", self.__request_detection)
 
         blaplay.bla.register_for_cleanup(self)
 
@@ -435,26 +801,57 @@ def initialized(library_monitor, directories):
     # if the key is already present and otherwise adds it to the ool dict.
     def add_track(self, track):
         uri = track.uri
-        self.__tracks[uri] = track
+        self.__tracks[uri] = self.__insert(uri, track)
+        self.__index.add(uri)
+        self.__mark_dirty(uri)
         try:
             del self.__tracks_ool[uri]
         except KeyError:
             pass
 
-    def add_tracks(self, uris):
+    def __add_parsed_tracks(self, tracks, directory=None):
+        # Adds (uri, track) pairs as yielded by blaparse.parse() to the library
+        # and returns the number of successfully parsed tracks. Files which
+        # couldn't be parsed are remembered as such. Tracks are assigned to
+        # `directory' if given and to their monitored directory otherwise.
         count = 0
-        filt = self.__extension_filter
         add_track = self.add_track
-        for uri in filter(filt, uris):
-            track = get_track(uri)
+        split_uri = formats.split_uri
+        if directory:
+            directories = [directory]
+        else:
+            directories = self.__monitored_directories
+        sheets = {}
+        for uri, track in tracks:
             if not track:
+                self.__set_failure(uri)
+                self.__remove_sheet(uri)
                 continue
-            for md in self.__monitored_directories:
+            self.__clear_failure(uri)
+            if split_uri(track.uri)[1] is not None:
+                sheets.setdefault(uri, []).append(track.uri)
+            else:
+                # The file might have carried an embedded sheet before.
+                self.__remove_sheet(uri)
+                if uri in self.__covered:
+                    continue
+            for md in directories:
                 if uri.startswith(md):
                     track[MONITORED_DIRECTORY] = md
                     add_track(track)
                     break
             count += 1
+        for path, uris in sheets.iteritems():
+            self.__set_sheet(path, uris)
+        return count
+
+    def add_tracks(self, uris):
+        count = 0
+        is_known_failure = self.__is_known_failure
+        uris = (uri for uri in uris
+                if formats.is_supported(uri) and not is_known_failure(uri))
+        for tracks in blaparse.parse(uris):
+            count += self.__add_parsed_tracks(tracks)
         return count
 
     def update_track(self, uri):
@@ -464,6 +861,11 @@ def update_track(self, uri):
         refers to a non-existent resource or the resource's format is not
         supported.
         """
+        # Virtual tracks are updated along with their sheet.
+        path, number = formats.split_uri(uri)
+        if number is not None:
+            return False if os.path.isfile(path) else None
+
         try:
             mtime = os.path.getmtime(uri)
         except OSError:
@@ -477,6 +879,7 @@ def update_track(self, uri):
             track = get_track(uri) # Get a new BlaTrack from `uri'.
             if track is None:
                 return None
+            blacovers.extract([track], {})
             track[MONITORED_DIRECTORY] = md
             self[uri] = track
             track_updated = True
@@ -488,8 +891,8 @@ def move_track(self, path_from, path_to, md=""):
         # necessary because some elements like the player, scrobbler or a
         # playlist might still try to get metadata using the old URI so we have
         # to guarantee that it's still available somewhere. The redundant data
-        # will be removed from __tracks_ool on shutdown when we sync entries in
-        # __tracks_ool to playlist contents.
+        # will be removed from __tracks_ool once no playlist references the old
+        # URI anymore.
 
         # Get first match for a monitored directory if no specific one is
         # given.
@@ -505,32 +908,101 @@ def move_track(self, path_from, path_to, md=""):
         # Chromium, for instance, appends a .crdownload suffix to downloads and
         # then renames them on transfer completion.
         try:
-            track = self.__tracks[path_from]
+            row = self.__get_row(path_from)
         except KeyError:
-            track = get_track(path_to)
-            if track:
-                track[MONITORED_DIRECTORY] = md
-                self.add_track(track)
+            # `path_from' might also have been a CUE sheet or a file backing
+            # one.
+            self.remove_track(path_from)
+            self.add_tracks([path_to])
             return
 
-        if path_from in self.__tracks and path_from != path_to:
-            self.__tracks_ool[path_from] = self.__tracks.pop(path_from)
-        track[URI] = path_to
-        track[MONITORED_DIRECTORY] = md
+        # The old and the new URI share the same row.
+        if path_from != path_to:
+            self.__add_ool_track(path_from, self.__tracks.pop(path_from))
+            self.__index.discard(path_from)
+        table = self.__table
+        table.set_value(row, URI, path_to)
+        table.set_value(row, MONITORED_DIRECTORY, md)
         if md:
-            self.__tracks[path_to] = track
+            self.__tracks[path_to] = row
+            self.__index.add(path_to)
         else:
-            self.__tracks_ool[path_to] = track
+            self.__add_ool_track(path_to, row)
+        self.__index_track(path_to, row)
+        self.__mark_dirty(path_from, path_to)
 
     def remove_track(self, uri):
+        # Removed tracks might still be referenced by playlists so they need
+        # to be decoded before moving them to __tracks_ool.
         try:
-            track = self.__tracks[uri]
+            row = self.__get_row(uri)
         except KeyError:
-            pass
+            # Removing a sheet or the file backing it removes its virtual
+            # tracks.
+            self.__remove_sheet(uri)
+            map(self.remove_track, self.__index.get_paths_starting_with(
+                "%s%s" % (uri, formats.SEPARATOR)))
         else:
-            track[MONITORED_DIRECTORY] = ""
-            self.__tracks_ool[uri] = track
             del self.__tracks[uri]
+            self.__index.discard(uri)
+            self.__table.set_value(row, MONITORED_DIRECTORY, "")
+            self.__add_ool_track(uri, row)
+
+    def get_failures(self):
+        # Returns the paths of files which are skipped because they failed to
+        # parse.
+        return self.__failures.keys()
+
+    def clear_failures(self):
+        # Forgets about all parse failures so the files are tried again on the
+        # next scan.
+        map(self.__clear_failure, self.__failures.keys())
+        self.__save_library()
+
+    def get_uris_below(self, directory):
+        # Returns the URIs of all library tracks below `directory'.
+        return self.__index.get_paths_below(directory)
+
+    def __get_rows(self, uris):
+        rows = []
+        for uri in uris:
+            try:
+                rows.append(self.__get_row(uri))
+            except KeyError:
+                rows.append(self.__tracks_ool[uri])
+        return rows
+
+    def get_columns(self, uris, identifiers):
+        # Returns a list of values for every identifier in `identifiers', each
+        # aligned with `uris'. This reads the table column by column instead
+        # of creating a row view per track. Raises KeyError for unknown URIs.
+        rows = self.__get_rows(uris)
+        get_values = self.__table.get_values
+        return [get_values(rows, identifier) for identifier in identifiers]
+
+    def get_sort_keys(self, uris, name, func):
+        # Returns the keys of the sort order `name' for the tracks in `uris'.
+        # Keys are computed by `func' from a track and cached in the table
+        # until the track changes. Raises KeyError for unknown URIs.
+        return self.__table.get_sort_keys(self.__get_rows(uris), name, func)
+
+    def search(self, filter_string):
+        """
+        Returns the set of URIs of library and out-of-library tracks whose
+        tags might match every word in `filter_string', or None if the string
+        contains no words. Callers still need to check the candidates.
+        """
+
+        if self.__search_index is None:
+            self.__search_index = blautil.BlaTokenIndex()
+            for uri in self.__tracks.keys():
+                try:
+                    self.__index_track(uri, self.__get_row(uri))
+                except KeyError:
+                    pass
+            for uri, row in self.__tracks_ool.items():
+                self.__index_track(uri, row)
+        return self.__search_index.search(filter_string)
 
     def sync(self):
         self.__save_library()
@@ -539,26 +1011,54 @@ def sync(self):
         self.emit("library_updated")
         return False
 
-    def save_ool_tracks(self, uris):
-        print_d("Saving out-of-library tracks")
+    def ref_uris(self, uris):
+        # Playlists call this for every URI they add.
+        refs = self.__ool_refs
+        for uri in uris:
+            refs[uri] = refs.get(uri, 0) + 1
 
-        # We create a set of all OOL uris. Then we take the difference between
-        # this set and the set of URIs for each playlist. The remainder will be
-        # a set of URIs that weren't referenced by any playlist so we just get
-        # rid of them.
-        ool_uris = set(self.__tracks_ool.keys())
-        for uri in ool_uris.difference(uris):
-            self.__tracks_ool.pop(uri)
+    def unref_uris(self, uris):
+        # Playlists call this for every URI they remove.
+        refs = self.__ool_refs
+        for uri in uris:
+            try:
+                count = refs[uri] - 1
+            except KeyError:
+                continue
+            if count:
+                refs[uri] = count
+            else:
+                del refs[uri]
+                self.__ool_unreferenced.add(uri)
 
-        p = multiprocessing.Process(
-            target=blautil.serialize_to_file,
-            args=(self.__tracks_ool, blaconst.OOL_PATH))
-        p.start()
+    def save_ool_tracks(self):
+        print_d("Saving out-of-library tracks")
 
-        @blautil.thread_nondaemonic
-        def join():
-            p.join()
-        join()
+        # Drop out-of-library tracks which are no longer referenced by any
+        # playlist. Only the URIs whose reference count dropped to zero since
+        # the last save need to be checked.
+        refs = self.__ool_refs
+        candidates, self.__ool_unreferenced = self.__ool_unreferenced, set()
+        rows = []
+        for uri in candidates:
+            if uri not in refs and uri in self.__tracks_ool:
+                rows.append(self.__tracks_ool.pop(uri))
+                self.__mark_dirty(uri)
+                if (self.__search_index is not None and
+                    uri not in self.__tracks):
+                    self.__search_index.discard(uri)
+
+        # Free the rows of dropped tracks in the table. Moved tracks share
+        # their row with the URI they were moved to so rows which are still
+        # referenced are kept.
+        if rows:
+            used = set(self.__tracks_ool.itervalues())
+            used.update(self.__tracks.itervalues())
+            remove = self.__table.remove
+            for row in rows:
+                if row not in used:
+                    remove(row)
+        self.__save_library()
 
     def parse_ool_uris(self, uris):
         # TODO: Test if it is faster to move this to a separate process.
@@ -568,7 +1068,7 @@ def process(namespace, uris, pb):
             tid = gobject.timeout_add(40, pb.pulse)
 
             files = []
-            filt = self.__extension_filter
+            filt = formats.is_supported
             for uri in uris:
                 uri = os.path.realpath(uri)
                 if os.path.isdir(uri):
@@ -583,6 +1083,7 @@ def process(namespace, uris, pb):
 
             pb.switch_mode()
             uris = sorted(files, cmp=locale.strcoll)
+            covers = {}
             try:
                 step_size = 1.0 / len(uris)
             except ZeroDivisionError:
@@ -594,12 +1095,19 @@ def process(namespace, uris, pb):
                 yield True
 
                 try:
-                    track = self[uri]
+                    tracks = [self[uri]]
                 except KeyError:
-                    track = get_track(uri)
-                    self.__tracks_ool[uri] = track
-                if track:
-                    namespace["uris"].append(uri)
+                    # CUE sheets expand to their virtual tracks.
+                    tracks = get_tracks(uri)
+                    blacovers.extract(tracks, covers)
+                    for track in tracks:
+                        if (track.uri not in self and
+                            track.uri not in self.__tracks_ool):
+                            row = self.__table.add(track)
+                            self.__add_ool_track(track.uri, row)
+                            self.__index_track(track.uri, row)
+                namespace["uris"].extend(
+                    track.uri for track in tracks if track)
 
             pb.set_fraction(1.0)
             pb.hide()
@@ -639,9 +1147,11 @@ def scan(directory):
             checked_directories = []
             files = []
 
-            filt = self.__extension_filter
-            for f in blautil.discover(directory):
-                filt(f) and files.append(f)
+            filt = formats.is_supported
+            is_known_failure = self.__is_known_failure
+            for f, st in self.__walk(directory):
+                if filt(f) and not is_known_failure(f, st):
+                    files.append(f)
                 if self.__aborted:
                     self.emit("progress", "abort")
                     self.__currently_scanning = None
@@ -656,32 +1166,51 @@ def scan(directory):
 
             update_track = self.update_track
             add_track = self.add_track
-            for idx, path in enumerate(files):
-                self.emit("progress", step_size * (idx+1))
+            def add(track):
+                if track and not track[MONITORED_DIRECTORY]:
+                    track[MONITORED_DIRECTORY] = directory
+                    add_track(track)
+
+            # Tracks we already know about are handled right away. Everything
+            # else is handed to the parser pool.
+            new_files = []
+            idx = 0
+            for path in files:
+                if path in self.__tracks:
+                    add(self[path])
+                elif path in self.__tracks_ool:
+                    # Out-of-library tracks might require an update as we don't
+                    # monitor them.
+                    update_track(path)
+                    add(self[path])
+                else:
+                    new_files.append(path)
+                    continue
+                idx += 1
+                self.emit("progress", step_size * idx)
 
                 if self.__aborted:
                     self.emit("progress", "abort")
                     self.__currently_scanning = None
                     namespace["wait"] = False
                     yield False
+                yield True
 
-                try:
-                    track = self.__tracks[path]
-                except KeyError:
-                    # If track wasn't in the library check if it was in
-                    # __tracks_ool. In that case it might require an update as
-                    # we don't monitor such tracks.
-                    try:
-                        track = self.__tracks_ool[path]
-                    except KeyError:
-                        track = get_track(path)
-                    else:
-                        if update_track(path):
-                            track = self[path]
+            parser = blaparse.parse(new_files)
+            for tracks in parser:
+                if self.__aborted:
+                    parser.close()
+                    self.emit("progress", "abort")
+                    self.__currently_scanning = None
+                    namespace["wait"] = False
+                    yield False
 
-                if track and not track[MONITORED_DIRECTORY]:
-                    track[MONITORED_DIRECTORY] = directory
-                    add_track(track)
+                self.__add_parsed_tracks(tracks, directory)
+                # CUE sheets yield one tuple per virtual track, but progress
+                # is measured in files.
+                idx += len(set(path for path, track in tracks))
+                if tracks:
+                    self.emit("progress", step_size * idx)
                 yield True
 
             self.sync()
@@ -725,8 +1254,10 @@ def remove_directory(self, directory):
             self.__aborted = True
 
         remove_track = self.remove_track
-        tracks = [(uri, track) for uri, track in self.__tracks.iteritems()
-                if track[MONITORED_DIRECTORY] == directory]
+        get_value = self.__table.get_value
+        tracks = [uri for uri in self.__index.get_paths_below(directory)
+                  if get_value(self.__get_row(uri), MONITORED_DIRECTORY) ==
+                  directory]
         mds = self.__monitored_directories
 
         try:
@@ -734,7 +1265,7 @@ def remove_directory(self, directory):
         except ValueError:
             pass
 
-        for uri, track in tracks:
+        for uri in tracks:
             for md in mds:
                 if uri.startswith(md):
                     self.move_track(uri, uri, md)
@@ -745,7 +1276,7 @@ def remove_directory(self, directory):
         # If there are no more monitored directories but still tracks in the
         # library something went wrong so move them to __tracks_ool as well.
         if not mds:
-            map(remove_track, self.__tracks.iterkeys())
+            map(remove_track, self.__tracks.keys())
         self.sync()
         self.__library_monitor.remove_directories(directory)
 
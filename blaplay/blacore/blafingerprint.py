@@ -0,0 +1,442 @@
+# blaplay, Copyright (C) 2014  Niklas Koep
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+"""
+Local acoustic fingerprints to recognize the same recording stored under
+different paths or in different encodings. The first DURATION seconds of a
+track are decoded to mono audio at a low sampling rate and cut into frames.
+The spectrum of every frame is folded into a chroma vector, i.e. the energy
+per pitch class, which hardly depends on the codec or bitrate. Each frame of
+the smoothed chroma sequence is reduced to a CODE_BITS-bit code which
+records how neighboring pitch classes and consecutive frames compare. Two
+fingerprints match if their codes mostly agree.
+"""
+
+import threading
+
+import gobject
+import numpy as np
+
+import blaplay
+from blaplay.blacore import blacfg, blaconst, blastore, blaparse, blagst as gst
+from blaplay import formats
+from blaplay.formats._identifiers import *
+
+# Table ids of the fingerprint store. The anchors table maps URIs to
+# (mtime, anchors) tuples and is small enough to be kept in memory. The
+# fingerprints themselves are only read from the store when comparing them.
+TABLE_ANCHORS, TABLE_FINGERPRINTS = xrange(2)
+
+# Number of seconds of every track which are fingerprinted.
+DURATION = 60
+# Decoding a file is given up after this many seconds, e.g. if it never
+# prerolls or the decoder stalls.
+DECODE_TIMEOUT = 30
+
+SAMPLE_RATE = 11025
+FRAME_SIZE = 4096
+HOP_SIZE = 2048
+CODE_BITS = 24
+
+# Number of frames the chroma vectors are averaged over, and the distance
+# between the frames compared for the temporal half of the code bits.
+_SMOOTHING = 8
+_DELTA = 4
+
+# Samples below this amplitude at the start of a track count as silence.
+# Leading silence differs between rips so it's skipped.
+_SILENCE = 256
+
+# Fingerprints are compared at offsets of up to this many frames (about
+# three seconds) in each direction to make up for differences in encoder
+# delay and lead-in. Overlaps shorter than _MIN_FRAMES don't count.
+_MAX_OFFSET = 16
+_MIN_FRAMES = 64
+
+# Fraction of matching code bits for two fingerprints to be considered the
+# same recording. Unrelated recordings agree on about half of the bits.
+MATCH_THRESHOLD = 0.85
+
+# Number of anchors per fingerprint. Anchors are the codes with the smallest
+# hash values, so fingerprints sharing most of their codes are likely to
+# share an anchor as well. Only fingerprints sharing an anchor are compared.
+_N_ANCHORS = 12
+
+# Fingerprinting is expensive so only few tracks are handed to a worker at a
+# time.
+BATCH_SIZE = 4
+# Number of tracks grouped per mainloop iteration by group_async().
+GROUP_CHUNK_SIZE = 64
+
+
+def _make_chroma_matrix():
+    # Maps the FFT bins between A0 and A7 to the pitch class of the nearest
+    # note.
+    n_bins = FRAME_SIZE // 2 + 1
+    frequencies = np.arange(n_bins) * (float(SAMPLE_RATE) / FRAME_SIZE)
+    matrix = np.zeros((n_bins, 12))
+    bins = np.flatnonzero((frequencies >= 27.5) & (frequencies <= 3520.0))
+    notes = np.round(12 * np.log2(frequencies[bins] / 440.0)).astype(int)
+    matrix[bins, notes % 12] = 1.0
+    return matrix
+
+_CHROMA = _make_chroma_matrix()
+_WINDOW = np.hanning(FRAME_SIZE)
+_WEIGHTS = (1 << np.arange(CODE_BITS)).astype(np.uint32)
+
+
+def compute(samples):
+    """
+    Returns the fingerprint of the 16-bit mono samples `samples', a numpy
+    array sampled at SAMPLE_RATE, as a numpy array of codes. Returns None if
+    there's not enough audio to fingerprint.
+    """
+
+    loud = np.flatnonzero(np.abs(samples) > _SILENCE)
+    if not len(loud):
+        return None
+    samples = samples[loud[0]:].astype(np.float32)
+    n_frames = 1 + (len(samples) - FRAME_SIZE) // HOP_SIZE
+    if n_frames < _MIN_FRAMES + _SMOOTHING + _DELTA:
+        return None
+
+    indices = (np.arange(FRAME_SIZE)[np.newaxis, :] +
+               HOP_SIZE * np.arange(n_frames)[:, np.newaxis])
+    spectrum = np.abs(np.fft.rfft(samples[indices] * _WINDOW)) ** 2
+    chroma = np.dot(spectrum, _CHROMA)
+    norms = np.sqrt((chroma ** 2).sum(axis=1))
+    chroma /= np.maximum(norms, 1e-9)[:, np.newaxis]
+
+    # Moving average over time.
+    cumulative = np.cumsum(chroma, axis=0)
+    chroma = (cumulative[_SMOOTHING:] - cumulative[:-_SMOOTHING]) / _SMOOTHING
+
+    spectral = chroma > np.roll(chroma, -1, axis=1)
+    temporal = chroma[_DELTA:] > chroma[:-_DELTA]
+    bits = np.hstack([spectral[:-_DELTA], temporal]).astype(np.uint32)
+    return np.dot(bits, _WEIGHTS).astype(np.uint32)
+
+def similarity(fingerprint1, fingerprint2):
+    """
+    Returns the fraction of matching code bits of two fingerprints at their
+    best alignment.
+    """
+
+    best = 0.0
+    for offset in xrange(-_MAX_OFFSET, _MAX_OFFSET+1):
+        if offset >= 0:
+            a, b = fingerprint1[offset:], fingerprint2
+        else:
+            a, b = fingerprint1, fingerprint2[-offset:]
+        n = min(len(a), len(b))
+        if n < _MIN_FRAMES:
+            continue
+        errors = np.unpackbits((a[:n] ^ b[:n]).view(np.uint8)).sum()
+        best = max(best, 1.0 - errors / float(n * CODE_BITS))
+    return best
+
+def _get_anchors(fingerprint):
+    # Code 0 is mostly produced by silence and noise so it's no anchor.
+    codes = np.unique(fingerprint)
+    codes = codes[codes != 0].astype(np.uint64)
+    hashes = (codes * 2654435761) & 0xffffffff
+    return tuple(int(value) for value in np.sort(hashes)[:_N_ANCHORS])
+
+def _decode(path, start, duration):
+    # Decodes `duration' seconds of the file at `path', starting at `start'
+    # seconds, to 16-bit mono samples at SAMPLE_RATE. The appsink is drained
+    # synchronously so no mainloop is required. Returns None on errors or
+    # if decoding takes longer than DECODE_TIMEOUT seconds.
+    pipeline = gst.parse_launch(
+        "filesrc name=src ! decodebin2 ! audioconvert ! audioresample ! "
+        "audio/x-raw-int,rate=%d,channels=1,width=16,depth=16,signed=true,"
+        "endianness=1234 ! appsink name=sink sync=false" % SAMPLE_RATE)
+    pipeline.get_by_name("src").set_property("location", path)
+    sink = pipeline.get_by_name("sink")
+    # Pulling buffers blocks until the decoder delivers data, or forever if
+    # it stalls or fails. Shutting down the pipeline makes the pull return.
+    timed_out = threading.Event()
+    def stop():
+        timed_out.set()
+        pipeline.set_state(gst.STATE_NULL)
+    watchdog = threading.Timer(DECODE_TIMEOUT, stop)
+    watchdog.daemon = True
+    try:
+        pipeline.set_state(gst.STATE_PAUSED)
+        # A timeout leaves the state change pending, i.e. ASYNC.
+        if (pipeline.get_state(timeout=DECODE_TIMEOUT * gst.SECOND)[0] !=
+            gst.STATE_CHANGE_SUCCESS):
+            return None
+        if start:
+            pipeline.seek_simple(
+                gst.FORMAT_TIME, gst.SEEK_FLAG_FLUSH | gst.SEEK_FLAG_ACCURATE,
+                int(start * gst.SECOND))
+        watchdog.start()
+        pipeline.set_state(gst.STATE_PLAYING)
+
+        size = 2 * int(duration * SAMPLE_RATE)
+        chunks = []
+        n_bytes = 0
+        while n_bytes < size:
+            buf = sink.emit("pull_buffer")
+            if buf is None:
+                break
+            chunks.append(buf.data)
+            n_bytes += len(buf.data)
+    finally:
+        watchdog.cancel()
+        pipeline.set_state(gst.STATE_NULL)
+    if timed_out.is_set():
+        return None
+    data = "".join(chunks)[:size]
+    return np.fromstring(data[:len(data) & ~1], dtype=np.int16)
+
+def _fingerprint_batch(jobs):
+    results = []
+    for uri, path, start, mtime in jobs:
+        try:
+            samples = _decode(path, start, DURATION)
+            fingerprint = compute(samples) if samples is not None else None
+        except Exception as exc:
+            print_d("Failed to fingerprint \"%s\": %r" % (uri, exc))
+            fingerprint = None
+        if fingerprint is not None:
+            fingerprint = fingerprint.tostring()
+        results.append((uri, mtime, fingerprint))
+    return results
+
+def init():
+    global fingerprints
+    fingerprints = BlaFingerprints()
+    blaplay.bla.register_for_cleanup(fingerprints)
+    if blacfg.getboolean("library", "fingerprint.tracks"):
+        blaplay.bla.library.connect_object(
+            "library_updated", BlaFingerprints.update_library, fingerprints)
+
+
+class BlaFingerprints(object):
+    """
+    Persistent fingerprints of tracks with an index for near-duplicate
+    search. Fingerprints are recorded along with the mtime of the file they
+    were computed from and are only recomputed once the file changes. Files
+    which fail to fingerprint are remembered the same way.
+    """
+
+    def __init__(self):
+        self.__store = blastore.BlaStore(blaconst.FINGERPRINTS_PATH)
+        # The anchors and the index are loaded on first use.
+        self.__anchors = None
+        self.__index = None
+        self.__cache = {}
+        self.__pending = []
+        self.__updating = False
+
+    def __call__(self):
+        self.__store.commit()
+        self.__store.close()
+
+    def __load(self):
+        if self.__anchors is not None:
+            return
+        self.__anchors = dict(self.__store.items(TABLE_ANCHORS))
+        self.__index = {}
+        for uri, (_, anchors) in self.__anchors.iteritems():
+            for anchor in anchors:
+                self.__index.setdefault(anchor, set()).add(uri)
+
+    def __add(self, uri, mtime, fingerprint):
+        if fingerprint is not None:
+            anchors = _get_anchors(np.fromstring(fingerprint, np.uint32))
+            self.__store.put(TABLE_FINGERPRINTS, uri, fingerprint)
+        else:
+            anchors = ()
+            self.__store.delete(TABLE_FINGERPRINTS, uri)
+        self.__store.put(TABLE_ANCHORS, uri, (mtime, anchors))
+        self.__cache.pop(uri, None)
+
+        try:
+            _, previous = self.__anchors[uri]
+        except KeyError:
+            pass
+        else:
+            for anchor in previous:
+                self.__index[anchor].discard(uri)
+        self.__anchors[uri] = (mtime, anchors)
+        for anchor in anchors:
+            self.__index.setdefault(anchor, set()).add(uri)
+
+    def is_current(self, uri, mtime):
+        self.__load()
+        try:
+            return self.__anchors[uri][0] == mtime
+        except KeyError:
+            return False
+
+    def get(self, uri):
+        """
+        Returns the fingerprint of `uri' as a numpy array or None if the track
+        hasn't been fingerprinted or failed to fingerprint.
+        """
+
+        try:
+            return self.__cache[uri]
+        except KeyError:
+            pass
+        fingerprint = self.__store.get(TABLE_FINGERPRINTS, uri)
+        if fingerprint is not None:
+            fingerprint = np.fromstring(fingerprint, np.uint32)
+        self.__cache[uri] = fingerprint
+        return fingerprint
+
+    def __update(self, uris, callback):
+        library = blaplay.bla.library
+        is_current = self.is_current
+        split_uri = formats.split_uri
+        # The library is only listed once the pass starts so it covers all
+        # changes made while it was queued.
+        if uris is None:
+            uris = list(library)
+
+        def jobs():
+            for uri in uris:
+                try:
+                    track = library[uri]
+                except KeyError:
+                    continue
+                mtime = track[MTIME]
+                if is_current(uri, mtime):
+                    continue
+                path = split_uri(uri)[0]
+                yield uri, path, float(track[OFFSET_START] or 0), mtime
+
+        for results in blaparse.run(_fingerprint_batch, jobs(), BATCH_SIZE):
+            for uri, mtime, fingerprint in results:
+                self.__add(uri, mtime, fingerprint)
+            yield True
+
+        self.__store.commit()
+        self.__updating = False
+        if callback is not None:
+            callback()
+        if self.__pending:
+            uris, callback = self.__pending.pop(0)
+            self.update(uris, callback)
+        yield False
+
+    def update(self, uris=None, callback=None):
+        """
+        Fingerprints the tracks in `uris', or in the library if it's None,
+        which weren't fingerprinted yet or changed since they were in a pool
+        of worker processes. `callback' is called once all of them are done.
+        Requests made while an update is running are queued. At most one
+        pass over the library is queued at any time.
+        """
+
+        self.__load()
+        if self.__updating:
+            if uris is None and (None, callback) in self.__pending:
+                return
+            self.__pending.append((uris, callback))
+            return
+        self.__updating = True
+        if uris is not None:
+            uris = list(uris)
+        p = self.__update(uris, callback)
+        gobject.idle_add(p.next, priority=gobject.PRIORITY_LOW)
+
+    def update_library(self):
+        # This is called whenever the library is synced. Tracks whose mtime
+        # matches that of their fingerprint are skipped without decoding so
+        # only changed tracks are fingerprinted.
+        self.update()
+
+    def __is_duplicate(self, uri, other):
+        # Tracks of the same recording are about equally long, in particular
+        # when the fingerprint covers all of the shorter one.
+        library = blaplay.bla.library
+        try:
+            length, other_length = library[uri][LENGTH], library[other][LENGTH]
+        except KeyError:
+            return False
+        if (length and other_length and
+            abs(length - other_length) > max(5, 0.05 * length)):
+            return False
+        fingerprint, other_fingerprint = self.get(uri), self.get(other)
+        if fingerprint is None or other_fingerprint is None:
+            return False
+        return (similarity(fingerprint, other_fingerprint) >=
+                MATCH_THRESHOLD)
+
+    def find_duplicates(self, uri, uris=None):
+        """
+        Returns the URIs of all fingerprinted tracks, or just of those in the
+        set `uris' if given, which are the same recording as `uri'.
+        """
+
+        self.__load()
+        try:
+            _, anchors = self.__anchors[uri]
+        except KeyError:
+            return []
+        candidates = set()
+        for anchor in anchors:
+            candidates.update(self.__index.get(anchor, ()))
+        candidates.discard(uri)
+        if uris is not None:
+            candidates.intersection_update(uris)
+        return [other for other in candidates
+                if self.__is_duplicate(uri, other)]
+
+    def __group(self, uris, groups):
+        seen = set()
+        for idx, uri in enumerate(uris):
+            if uri in groups:
+                continue
+            groups[uri] = uri
+            for other in self.find_duplicates(uri, seen):
+                groups[uri] = groups[other]
+                break
+            seen.add(uri)
+            if idx % GROUP_CHUNK_SIZE == 0:
+                yield True
+        self.__cache.clear()
+
+    def group(self, uris):
+        """
+        Maps every URI in the sequence `uris' to the first URI in it which is
+        the same recording. Only fingerprints already in the store are
+        considered.
+        """
+
+        groups = {}
+        for _ in self.__group(uris, groups):
+            pass
+        return groups
+
+    def group_async(self, uris, callback):
+        """
+        Like group() but runs in chunks on the mainloop and passes the result
+        to `callback' once it's done.
+        """
+
+        def group():
+            groups = {}
+            for _ in self.__group(list(uris), groups):
+                yield True
+            callback(groups)
+            yield False
+        p = group()
+        gobject.idle_add(p.next, priority=gobject.PRIORITY_LOW)
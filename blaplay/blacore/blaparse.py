@@ -0,0 +1,124 @@
+# blaplay, Copyright (C) 2014  Niklas Koep
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+import signal
+import collections
+import itertools
+import multiprocessing
+
+from blaplay.blacore import blacfg, blacovers
+from blaplay import formats
+
+# Number of paths handed to a worker process at once. Jobs with fewer paths
+# than this are parsed in the calling process as spawning the pool would take
+# longer than parsing the files.
+BATCH_SIZE = 64
+
+# Time in seconds to block while waiting for the next batch before returning
+# control to the caller.
+_WAIT_TIMEOUT = 0.01
+
+
+def _parse_batch(paths):
+    tracks = []
+    get_tracks = formats.get_tracks
+    # Cover art is extracted here so it happens in the worker processes. The
+    # tracks of an album usually end up in the same batch so we only extract
+    # it once per album.
+    covers = {}
+    for path in paths:
+        # Don't let a single broken file take down the whole batch.
+        try:
+            parsed = get_tracks(path)
+        except Exception as exc:
+            print_d("Failed to parse \"%s\": %r" % (path, exc))
+            parsed = None
+        if parsed:
+            blacovers.extract(parsed, covers)
+            tracks.extend((path, track) for track in parsed)
+        else:
+            tracks.append((path, None))
+    return tracks
+
+def _init_worker():
+    # Interrupts are handled by the main process which tears down the pool.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def get_worker_count():
+    n = blacfg.getint("library", "parser.workers")
+    if not n or n < 1:
+        try:
+            n = multiprocessing.cpu_count()
+        except NotImplementedError:
+            n = 1
+    return n
+
+def run(function, items, batch_size=BATCH_SIZE, workers=None):
+    """
+    Generator which calls `function' on batches of at most `batch_size' items
+    from the iterable `items' in a pool of worker processes and yields the
+    results in the order in which the items were given. An empty list is
+    yielded whenever no batch finished in time so callers running as idle
+    handlers can return to the mainloop. At most twice as many batches as
+    there are workers are in flight at any time, i.e. `items' is only
+    consumed as fast as the workers keep up with it.
+    """
+
+    items = iter(items)
+    batch = list(itertools.islice(items, batch_size))
+    if workers is None:
+        workers = get_worker_count()
+    if len(batch) < batch_size or workers < 2:
+        while batch:
+            yield function(batch)
+            batch = list(itertools.islice(items, batch_size))
+        return
+
+    pool = multiprocessing.Pool(workers, _init_worker)
+    pending = collections.deque()
+    max_pending = 2 * workers
+    try:
+        while True:
+            while batch and len(pending) < max_pending:
+                pending.append(pool.apply_async(function, (batch,)))
+                batch = list(itertools.islice(items, batch_size))
+            if not pending:
+                break
+            result = pending[0]
+            result.wait(_WAIT_TIMEOUT)
+            if result.ready():
+                pending.popleft()
+                yield result.get()
+            else:
+                yield []
+        pool.close()
+    finally:
+        # We end up here without closing the pool first if the generator is
+        # closed early, e.g. because a scan was aborted.
+        pool.terminate()
+        pool.join()
+
+def parse(paths, workers=None):
+    """
+    Generator which parses the files in the iterable `paths' in a pool of
+    worker processes. It yields lists of (path, track) tuples in the order in
+    which the paths were given, with `track' set to None for files that could
+    not be parsed. CUE sheets and files with an embedded sheet yield one tuple
+    per virtual track, all with the path of the file that was parsed. Like
+    run(), it yields an empty list whenever no batch finished in time.
+    """
+
+    return run(_parse_batch, paths, workers=workers)
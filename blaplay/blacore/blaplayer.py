@@ -22,8 +22,10 @@
 import blaplay
 library = blaplay.bla.library
 from blaplay.blacore import blaconst, blacfg, blagst as gst
-from blaplay import blautil
-from blaplay.formats._identifiers import TITLE
+from blaplay import blautil, formats
+from blaplay.formats._identifiers import (
+    TITLE, OFFSET_START, OFFSET_END, REPLAYGAIN_TRACK_GAIN,
+    REPLAYGAIN_TRACK_PEAK, REPLAYGAIN_ALBUM_GAIN, REPLAYGAIN_ALBUM_PEAK)
 
 BlaStatusbar = None
 gstreamer_is_working = None
@@ -69,8 +71,13 @@ class BlaPlayer(gobject.GObject):
 
     __bin = None
     __volume = None
+    __replaygain = None
     __equalizer = None
     __uri = None
+    # (start, end) of the section of the file to play for virtual tracks in
+    # nanoseconds. `end' is None for tracks lasting until the end of the file.
+    __segment = None
+    __segment_pending = False
     __station = None
     __state = blaconst.STATE_STOPPED
     __window_id = 0
@@ -98,6 +105,8 @@ def __init_pipeline(self):
                                          "width=(int)32,"
                                          "depth=(int)32,"
                                          "endianness=(int)1234"))
+        # The ReplayGain adjustment is kept separate from the user's volume.
+        self.__replaygain = gst.element_factory_make("volume")
         self.__equalizer = gst.element_factory_make("equalizer-10bands")
         tee = gst.element_factory_make("tee")
         queue = gst.element_factory_make("queue")
@@ -114,14 +123,14 @@ def new_buffer(sink):
         sink = gst.element_factory_make("autoaudiosink")
 
         self.__volume = gst.element_factory_make("volume")
-        elements = [filt, self.__equalizer, tee, queue, appsink,
-                    self.__volume, sink]
+        elements = [filt, self.__replaygain, self.__equalizer, tee, queue,
+                    appsink, self.__volume, sink]
         map(audio_sink.add, elements)
 
         pad = elements[0].get_static_pad("sink")
         audio_sink.add_pad(gst.GhostPad("sink", pad))
 
-        gst.element_link_many(filt, self.__equalizer, tee)
+        gst.element_link_many(filt, self.__replaygain, self.__equalizer, tee)
         gst.element_link_many(tee, self.__volume, sink)
         gst.element_link_many(tee, queue, appsink)
 
@@ -162,9 +171,29 @@ def __about_to_finish(self, player):
         # we're likely to call gtk functions somewhere down the line from here.
         pass
 
+    def __seek_segment(self, position=0):
+        start, end = self.__segment
+        if end is None:
+            stop_type, end = gst.SEEK_TYPE_NONE, -1
+        else:
+            stop_type = gst.SEEK_TYPE_SET
+        # Playback stops with an EOS message once the stop position is
+        # reached.
+        self.__bin.seek(1.0, gst.FORMAT_TIME,
+                        gst.SEEK_FLAG_FLUSH | gst.SEEK_FLAG_ACCURATE,
+                        gst.SEEK_TYPE_SET, start + position, stop_type, end)
+
     def __message(self, bus, message):
         if message.type == gst.MESSAGE_EOS:
             self.next(force_advance=False)
+        elif message.type == gst.MESSAGE_ASYNC_DONE:
+            # Seeking into the segment of a virtual track is only possible
+            # once the pipeline prerolled.
+            if self.__segment_pending:
+                self.__segment_pending = False
+                self.__seek_segment()
+                if self.__state == blaconst.STATE_PLAYING:
+                    self.__bin.set_state(gst.STATE_PLAYING)
         elif message.type == gst.MESSAGE_TAG:
             self.__parse_tags(message.parse_tag())
         elif message.type == gst.MESSAGE_BUFFERING:
@@ -277,16 +306,54 @@ def set_volume(self, volume):
         except AttributeError:
             pass
 
+    def update_replaygain(self):
+        # Applies the gain stored in the library for the current track so
+        # files don't need to be read again. In album mode tracks without an
+        # album gain fall back to their track gain and vice versa. The peak
+        # keeps positive gains from clipping.
+        factor = 1.0
+        mode = blacfg.getint("player", "replaygain.mode")
+        try:
+            track = library[self.__uri]
+        except KeyError:
+            track = None
+        if track is not None and mode != blaconst.REPLAYGAIN_OFF:
+            keys = [(REPLAYGAIN_TRACK_GAIN, REPLAYGAIN_TRACK_PEAK),
+                    (REPLAYGAIN_ALBUM_GAIN, REPLAYGAIN_ALBUM_PEAK)]
+            if mode == blaconst.REPLAYGAIN_ALBUM:
+                keys.reverse()
+            for gain, peak in keys:
+                gain, peak = track[gain], track[peak]
+                if gain != "":
+                    gain += blacfg.getfloat("player", "replaygain.preamp")
+                    factor = pow(10, gain / 20.0)
+                    if peak:
+                        factor = min(factor, 1.0 / peak)
+                    break
+        try:
+            # The volume element doesn't amplify beyond a factor of 10.
+            self.__replaygain.set_property("volume", min(factor, 10.0))
+        except AttributeError:
+            pass
+
     def seek(self, pos):
-        self.__bin.seek_simple(gst.FORMAT_TIME, gst.SEEK_FLAG_FLUSH, pos)
+        if self.__segment is not None:
+            self.__seek_segment(pos)
+        else:
+            self.__bin.seek_simple(gst.FORMAT_TIME, gst.SEEK_FLAG_FLUSH, pos)
         self.emit("seeked", pos)
 
     def get_position(self):
+        # Positions of virtual tracks are relative to the start of the track.
         if not self.radio:
             try:
-                return self.__bin.query_position(gst.FORMAT_TIME, None)[0]
+                position = self.__bin.query_position(gst.FORMAT_TIME, None)[0]
             except (AttributeError, gst.QueryError):
                 pass
+            else:
+                if self.__segment is not None:
+                    position = max(position - self.__segment[0], 0)
+                return position
         return 0
 
     def get_track(self):
@@ -329,7 +396,8 @@ def play(self):
         # trying and inform the user about the situation. If we'd just ask
         # for another track we'd potentially end up hitting the interpreter's
         # recursion limit in case lots of tracks turn out to be invalid.
-        if not os.path.exists(self.__uri) or not os.path.isfile(self.__uri):
+        path, number = formats.split_uri(self.__uri)
+        if not os.path.exists(path) or not os.path.isfile(path):
             from blaplay.blagui import blaguiutils
             uri = self.__uri
             self.stop()
@@ -346,8 +414,26 @@ def play(self):
             not self.__init_pipeline()):
             return
         self.__bin.set_state(gst.STATE_NULL)
-        self.__bin.set_property("uri", "file://%s" % self.__uri)
-        self.__bin.set_state(gst.STATE_PLAYING)
+        self.__bin.set_property("uri", "file://%s" % path)
+        self.update_replaygain()
+        self.__segment = None
+        self.__segment_pending = False
+        if number is not None:
+            try:
+                track = library[self.__uri]
+            except KeyError:
+                pass
+            else:
+                end = track[OFFSET_END]
+                self.__segment = (
+                    int(float(track[OFFSET_START] or 0) * gst.SECOND),
+                    int(end * gst.SECOND) if end != "" else None)
+        if self.__segment is not None:
+            # Preroll first so we can seek to the start of the track.
+            self.__segment_pending = True
+            self.__bin.set_state(gst.STATE_PAUSED)
+        else:
+            self.__bin.set_state(gst.STATE_PLAYING)
         self.__station = None
 
         self.__state = blaconst.STATE_PLAYING
@@ -377,8 +463,11 @@ def play_station(self, station):
             return
         self.__station = station
         self.__uri = None
+        self.__segment = None
+        self.__segment_pending = False
         self.__bin.set_state(gst.STATE_NULL)
         self.__bin.set_property("uri", self.__station.location)
+        self.update_replaygain()
         self.__bin.set_state(gst.STATE_PAUSED)
         self.__state = blaconst.STATE_PAUSED
         self.emit("track_changed")
@@ -392,8 +481,11 @@ def stop(self):
             bus.remove_signal_watch()
 
         self.__bin = None
+        self.__replaygain = None
         self.__equalizer = None
         self.__uri = None
+        self.__segment = None
+        self.__segment_pending = False
         self.__station = None
 
         self.__state = blaconst.STATE_STOPPED
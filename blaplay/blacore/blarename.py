@@ -0,0 +1,335 @@
+# blaplay, Copyright (C) 2014  Niklas Koep
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+"""
+Bulk operations which rename files after their tags or derive tags from
+filenames. Both work in two steps: a plan is computed for all tracks at once
+which can be shown to the user as a dry run, and is then applied in the
+background.
+"""
+
+import os
+import re
+import errno
+
+import gobject
+
+from blaplay.blacore import bladb, blatagwriter
+from blaplay import blautil, formats
+from blaplay.formats._identifiers import *
+
+# Number of files renamed per mainloop iteration.
+BATCH_SIZE = 64
+
+# Names of the fields usable in patterns
+FIELDS = {
+    "artist": ARTIST,
+    "title": TITLE,
+    "album": ALBUM,
+    "year": DATE,
+    "genre": GENRE,
+    "composer": COMPOSER,
+    "performer": PERFORMER,
+    "albumartist": ALBUM_ARTIST,
+    "track": TRACK,
+    "disc": DISC
+}
+
+# Substitute for tags which are missing when renaming files.
+UNKNOWN = u"Unknown"
+
+_NAME_MAX = 255
+
+
+def _clean(identifier, value):
+    # Turns a tag value into something that's safe to use as (part of) a
+    # filename.
+    if isinstance(value, str):
+        value = value.decode("utf-8", "replace")
+    value = unicode(value)
+    if identifier in (TRACK, DISC):
+        value = value.split("/")[0].strip()
+        if identifier == TRACK and value.isdigit():
+            value = u"%02d" % int(value)
+    value = value.replace("/", "-").replace("\0", "").strip().lstrip(".")
+    return value or UNKNOWN
+
+def _truncate(name, limit):
+    # Truncates `name' to at most `limit' bytes of UTF-8.
+    encoded = name.encode("utf-8")
+    if len(encoded) <= limit:
+        return name
+    return encoded[:limit].decode("utf-8", "ignore").rstrip()
+
+
+class BlaPattern(object):
+    """
+    A pattern like `<artist>/<album>/<track> - <title>' compiled for
+    formatting paths from tags and for matching tags in paths. Fields never
+    span directories. Raises ValueError for unknown fields.
+    """
+
+    __field = re.compile(r"<(\w+)>")
+
+    def __init__(self, pattern):
+        parts = self.__field.split(pattern)
+        literals, names = parts[::2], parts[1::2]
+        if not names:
+            raise ValueError("The pattern doesn't contain any fields")
+        try:
+            self.identifiers = [FIELDS[name.lower()] for name in names]
+        except KeyError as exc:
+            raise ValueError("Unknown field <%s>" % exc.args[0])
+        self.pattern = pattern
+        self.__template = u"%s".join(
+            literal.replace("%", "%%") for literal in literals)
+        regex = "([^/]+?)".join(map(re.escape, literals))
+        self.__regex = re.compile(r"(?:^|/)%s$" % regex, re.UNICODE)
+
+    def format(self, values, ext=""):
+        # Returns the relative path for the tag values in `values', given in
+        # the order of self.identifiers, with extension `ext' appended.
+        ext = ext.decode("utf-8", "replace")
+        path = self.__template % tuple(
+            _clean(identifier, value)
+            for identifier, value in zip(self.identifiers, values))
+        components = path.strip(u"/").split(u"/")
+        components = [_truncate(component, _NAME_MAX)
+                      for component in components[:-1]] + [
+            _truncate(components[-1], _NAME_MAX - len(ext.encode("utf-8")))]
+        return u"%s%s" % (u"/".join(components), ext)
+
+    def match(self, path):
+        # Returns a dict mapping identifiers to the values found in `path', or
+        # None if `path' doesn't match. Later fields win if a field is used
+        # more than once. Placeholders for missing tags are skipped.
+        if isinstance(path, str):
+            path = path.decode("utf-8", "replace")
+        match = self.__regex.search(path)
+        if match is None:
+            return None
+        values = {}
+        for identifier, value in zip(self.identifiers, match.groups()):
+            value = value.strip()
+            if value and value != UNKNOWN:
+                values[identifier] = value
+        return values
+
+
+def plan_renames(uris, pattern, base=None):
+    """
+    Computes the new paths of the files in `uris' according to the BlaPattern
+    `pattern', relative to `base' or, if it's None, to the tracks' monitored
+    directories. Returns a list of (path_from, path_to) tuples for files
+    which need to be renamed and one of those that can't be renamed because
+    their target already exists or is claimed by more than one file. Nothing
+    is changed on disk.
+    """
+
+    split_uri = formats.split_uri
+    # Virtual tracks can't be renamed on their own.
+    uris = [uri for uri in uris if split_uri(uri)[1] is None]
+    if not uris:
+        return [], []
+    columns = bladb.library.get_columns(
+        uris, pattern.identifiers + [MONITORED_DIRECTORY])
+    directories = columns.pop()
+    format_ = pattern.format
+
+    targets = {}
+    for uri, directory, values in zip(uris, directories, zip(*columns)):
+        directory = base or directory
+        if not directory:
+            continue
+        path = format_(values, os.path.splitext(uri)[1])
+        path = os.path.join(directory, path.encode("utf-8"))
+        targets.setdefault(path, []).append(uri)
+
+    renames = []
+    conflicts = []
+    lexists = os.path.lexists
+    for path, sources in targets.iteritems():
+        if len(sources) > 1:
+            conflicts.extend((uri, path) for uri in sources if uri != path)
+            continue
+        uri = sources[0]
+        if uri == path:
+            continue
+        # Files are never overwritten, not even by files which are about to
+        # be renamed themselves. This rules out chains and cycles of renames
+        # but makes the plan independent of the order it's applied in.
+        if lexists(path):
+            conflicts.append((uri, path))
+        else:
+            renames.append((uri, path))
+    renames.sort(key=lambda item: item[1])
+    conflicts.sort(key=lambda item: item[1])
+    return renames, conflicts
+
+def plan_tags(uris, pattern):
+    """
+    Matches the paths of the files in `uris' against the BlaPattern
+    `pattern'. Returns a list of (uri, values) tuples for tracks whose tags
+    would change, with `values' mapping identifiers to new values, and the
+    list of URIs which didn't match.
+    """
+
+    split_uri = formats.split_uri
+    uris = [uri for uri in uris if split_uri(uri)[1] is None]
+    if not uris:
+        return [], []
+    identifiers = sorted(set(pattern.identifiers))
+    columns = bladb.library.get_columns(uris, identifiers)
+    match = pattern.match
+    toss_extension = blautil.toss_extension
+
+    changes = []
+    unmatched = []
+    for uri, old_values in zip(uris, zip(*columns)):
+        values = match(toss_extension(uri))
+        if values is None:
+            unmatched.append(uri)
+            continue
+        old_values = dict(zip(identifiers, old_values))
+        if any(old_values[identifier] != value
+               for identifier, value in values.iteritems()):
+            changes.append((uri, values))
+    return changes, unmatched
+
+def rename(renames):
+    """
+    Applies a list of renames as returned by plan_renames() in the
+    background, reporting progress via the library's progress signal.
+    """
+
+    library = bladb.library
+    renamer = BlaRenamer(renames)
+    renamer.connect("progress", lambda r, arg: library.emit("progress", arg))
+    library.emit("progress", "pulse")
+    renamer.start()
+    return renamer
+
+def tag(changes):
+    """
+    Writes the tags of a list of changes as returned by plan_tags() in the
+    background.
+    """
+
+    library = bladb.library
+    tracks = []
+    for uri, values in changes:
+        try:
+            track = library[uri].materialize()
+        except KeyError:
+            continue
+        for identifier, value in values.iteritems():
+            track[identifier] = value
+        tracks.append(track)
+
+    writer = blatagwriter.BlaTagWriter(tracks)
+    writer.connect("progress", lambda w, n_done, n_total: library.emit(
+        "progress", float(n_done) / n_total))
+    writer.connect("finished", lambda *x: library.emit("progress", 1.0))
+    library.emit("progress", "pulse")
+    writer.start()
+    return writer
+
+
+class BlaRenamer(gobject.GObject):
+    """
+    Renames files in batches on the mainloop and moves their tracks in the
+    library accordingly. The paths involved are added to the library
+    monitor's ignore set beforehand so the events caused by the renames don't
+    trigger a rescan. Emits `progress' with the fraction of processed files
+    and `finished' with the list of paths that couldn't be renamed.
+    """
+
+    __gsignals__ = {
+        "progress": blautil.signal(1),
+        "finished": blautil.signal(1)
+    }
+
+    def __init__(self, renames):
+        super(BlaRenamer, self).__init__()
+        self.__renames = list(renames)
+        self.__ignored = []
+        self.__cancelled = False
+
+    def __ignore(self, *paths):
+        bladb.BlaLibraryMonitor.ignore.update(paths)
+        self.__ignored.extend(paths)
+
+    def __release(self):
+        # Events are dispatched at most EVENT_MAX_DELAY seconds after they
+        # occurred. Whatever is left in the ignore set by then belongs to
+        # events the watcher never reported.
+        ignore = bladb.BlaLibraryMonitor.ignore
+        map(ignore.discard, self.__ignored)
+        self.__ignored = []
+        return False
+
+    def __makedirs(self, directory):
+        missing = []
+        while directory and not os.path.isdir(directory):
+            missing.append(directory)
+            directory = os.path.dirname(directory)
+        for directory in reversed(missing):
+            self.__ignore(directory)
+            os.mkdir(directory)
+
+    def __rename(self):
+        library = bladb.library
+        n_renames = len(self.__renames)
+        moved = {}
+        failed = []
+
+        for idx in xrange(0, n_renames, BATCH_SIZE):
+            if self.__cancelled:
+                break
+            for path_from, path_to in self.__renames[idx:idx+BATCH_SIZE]:
+                self.__ignore(path_from, path_to)
+                try:
+                    if os.path.lexists(path_to):
+                        raise OSError(errno.EEXIST, os.strerror(errno.EEXIST))
+                    self.__makedirs(os.path.dirname(path_to))
+                    os.rename(path_from, path_to)
+                except OSError as exc:
+                    print_d("Failed to rename \"%s\": %s" % (path_from, exc))
+                    failed.append(path_from)
+                    continue
+                library.move_track(path_from, path_to)
+                moved[path_from] = path_to
+            self.emit("progress",
+                      float(min(idx+BATCH_SIZE, n_renames)) / n_renames)
+            yield True
+
+        if moved:
+            from blaplay.blagui.blaplaylist import BlaPlaylistManager
+            BlaPlaylistManager().update_uris(moved)
+        library.sync()
+        gobject.timeout_add(int(2 * bladb.EVENT_MAX_DELAY * 1000),
+                            self.__release)
+        self.emit("progress", 1.0)
+        self.emit("finished", failed)
+        yield False
+
+    def start(self):
+        p = self.__rename()
+        gobject.idle_add(p.next)
+
+    def cancel(self):
+        self.__cancelled = True
+
@@ -0,0 +1,274 @@
+# blaplay, Copyright (C) 2014  Niklas Koep
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+"""
+ReplayGain analysis of library tracks. Tracks are grouped into albums which
+are analyzed by GStreamer's rganalysis element in a pool of worker
+processes, one album per job, so the album gain covers all of an album's
+tracks. Results are stored in the library and optionally written to the
+files' tags.
+"""
+
+import os
+import collections
+
+import gobject
+
+from blaplay.blacore import blacfg, blaparse, bladb, blatagwriter
+from blaplay.blacore import blagst as gst
+from blaplay import blautil, formats
+from blaplay.formats._identifiers import *
+
+# Names of the tags in which rganalysis reports its results.
+_TAGS = {
+    "replaygain-track-gain": REPLAYGAIN_TRACK_GAIN,
+    "replaygain-track-peak": REPLAYGAIN_TRACK_PEAK,
+    "replaygain-album-gain": REPLAYGAIN_ALBUM_GAIN,
+    "replaygain-album-peak": REPLAYGAIN_ALBUM_PEAK
+}
+_ALBUM_IDENTIFIERS = (REPLAYGAIN_ALBUM_GAIN, REPLAYGAIN_ALBUM_PEAK)
+
+# A track fails if its file doesn't preroll within this many seconds or if
+# decoding makes no progress for as long.
+TIMEOUT = 30
+
+
+def _create_pipeline():
+    # The decoder is linked by hand instead of with gst.parse_launch() since
+    # the links of the latter only last for the first file.
+    pipeline = gst.Pipeline()
+    src = gst.element_factory_make("filesrc")
+    decoder = gst.element_factory_make("decodebin2")
+    convert = gst.element_factory_make("audioconvert")
+    resample = gst.element_factory_make("audioresample")
+    analysis = gst.element_factory_make("rganalysis")
+    analysis.set_property("forced", True)
+    sink = gst.element_factory_make("fakesink")
+    pipeline.add(src, decoder, convert, resample, analysis, sink)
+    src.link(decoder)
+    gst.element_link_many(convert, resample, analysis, sink)
+
+    def pad_added(decoder, pad):
+        sink_pad = convert.get_pad("sink")
+        caps = pad.get_caps()
+        if (not sink_pad.is_linked() and
+            caps[0].get_name().startswith("audio/")):
+            pad.link(sink_pad)
+    decoder.connect("pad_added", pad_added)
+    return pipeline, src, analysis, sink
+
+def _analyze_track(pipeline, sink, start, end):
+    # Runs the current file through the pipeline and returns the results
+    # reported by rganalysis, or None on errors and timeouts. Tags reach the
+    # sink in order so the results, which are sent right before EOS, replace
+    # any ReplayGain tags the file already had.
+    if start or end is not None:
+        pipeline.set_state(gst.STATE_PAUSED)
+        # A timeout leaves the state change pending, i.e. ASYNC.
+        if (pipeline.get_state(timeout=TIMEOUT * gst.SECOND)[0] !=
+            gst.STATE_CHANGE_SUCCESS):
+            return None
+        if end is None:
+            stop_type, end = gst.SEEK_TYPE_NONE, -1
+        else:
+            stop_type, end = gst.SEEK_TYPE_SET, int(end * gst.SECOND)
+        pipeline.seek(1.0, gst.FORMAT_TIME,
+                      gst.SEEK_FLAG_FLUSH | gst.SEEK_FLAG_ACCURATE,
+                      gst.SEEK_TYPE_SET, int(start * gst.SECOND), stop_type,
+                      end)
+    pipeline.set_state(gst.STATE_PLAYING)
+
+    bus = pipeline.get_bus()
+    values = {}
+    # Long tracks take a while to analyze so rather than limiting the time
+    # spent per track we give up once the position stops advancing.
+    position = None
+    stalled = 0
+    while True:
+        message = bus.timed_pop_filtered(
+            gst.SECOND, gst.MESSAGE_EOS | gst.MESSAGE_ERROR | gst.MESSAGE_TAG)
+        if message is None:
+            try:
+                current = pipeline.query_position(gst.FORMAT_TIME)[0]
+            except gst.QueryError:
+                current = None
+            if current == position:
+                stalled += 1
+                if stalled >= TIMEOUT:
+                    return None
+            else:
+                position = current
+                stalled = 0
+            continue
+        if message.type == gst.MESSAGE_EOS:
+            return values
+        elif message.type == gst.MESSAGE_ERROR:
+            return None
+        elif message.src is sink:
+            tags = message.parse_tag()
+            for key in tags.keys():
+                if key in _TAGS:
+                    values[_TAGS[key]] = float(tags[key])
+
+def _analyze_album(tracks):
+    pipeline, src, analysis, sink = _create_pipeline()
+    # rganalysis counts down the number of tracks and reports the album
+    # results along with the results of the last one. A failed track stops
+    # the countdown, and its partial data might be part of the album
+    # results anyway, so album values are only kept if every track
+    # succeeded.
+    analysis.set_property("num-tracks", len(tracks))
+    results = []
+    album = {}
+    failed = False
+    try:
+        for uri, path, start, end in tracks:
+            src.set_property("location", path)
+            try:
+                values = _analyze_track(pipeline, sink, start, end)
+            finally:
+                pipeline.set_state(gst.STATE_READY)
+            if values is None:
+                print_d("Failed to analyze \"%s\"" % uri)
+                results.append((uri, None))
+                failed = True
+                continue
+            for identifier in _ALBUM_IDENTIFIERS:
+                if identifier in values:
+                    album[identifier] = values.pop(identifier)
+            results.append((uri, values))
+    finally:
+        pipeline.set_state(gst.STATE_NULL)
+
+    if len(tracks) > 1 and not failed:
+        for uri, values in results:
+            if values:
+                values.update(album)
+    return results
+
+def _analyze_batch(albums):
+    results = []
+    for tracks in albums:
+        try:
+            results.extend(_analyze_album(tracks))
+        except Exception as exc:
+            print_d("Failed to analyze album: %r" % exc)
+            results.extend((track[0], None) for track in tracks)
+    return results
+
+def analyze(uris):
+    """
+    Analyzes the tracks in `uris' in the background, reporting progress via
+    the library's progress signal. Tags are written if the user asked for
+    it.
+    """
+
+    library = bladb.library
+    analyzer = BlaReplayGainAnalyzer(
+        uris, blacfg.getboolean("library", "replaygain.write.tags"))
+    analyzer.connect("progress", lambda a, arg: library.emit("progress", arg))
+    library.emit("progress", "pulse")
+    analyzer.start()
+    return analyzer
+
+
+class BlaReplayGainAnalyzer(gobject.GObject):
+    """
+    Computes the ReplayGain values of a list of tracks in a pool of worker
+    processes. Tracks without an album tag are analyzed on their own. If a
+    track of an album fails or times out, the other tracks of the album
+    only get track values since the album values would be incomplete. The
+    `progress' signal is emitted with the fraction of finished tracks and
+    `finished' with the list of URIs that couldn't be analyzed.
+    """
+
+    __gsignals__ = {
+        "progress": blautil.signal(1),
+        "finished": blautil.signal(1)
+    }
+
+    def __init__(self, uris, write_tags=False):
+        super(BlaReplayGainAnalyzer, self).__init__()
+        self.__uris = list(uris)
+        self.__write_tags = write_tags
+        self.__cancelled = False
+
+    def __albums(self):
+        library = bladb.library
+        split_uri = formats.split_uri
+        albums = collections.OrderedDict()
+        for uri in self.__uris:
+            try:
+                track = library[uri]
+            except KeyError:
+                continue
+            path = split_uri(uri)[0]
+            album = track[ALBUM]
+            key = (os.path.dirname(path), album) if album else uri
+            end = track[OFFSET_END]
+            albums.setdefault(key, []).append(
+                (uri, path, float(track[OFFSET_START] or 0),
+                 end if end != "" else None))
+        for tracks in albums.itervalues():
+            if self.__cancelled:
+                break
+            yield tracks
+
+    def __analyze(self):
+        library = bladb.library
+        n_tracks = len(self.__uris)
+        n_done = 0
+        failed = []
+        tracks = []
+
+        for results in blaparse.run(_analyze_batch, self.__albums(), 1):
+            for uri, values in results:
+                n_done += 1
+                if not values:
+                    failed.append(uri)
+                    continue
+                try:
+                    track = library[uri].materialize()
+                except KeyError:
+                    continue
+                track.set_replaygain(values)
+                library[uri] = track
+                if formats.split_uri(uri)[1] is None:
+                    tracks.append(track)
+            if results:
+                self.emit("progress", float(n_done) / max(n_tracks, 1))
+            yield True
+
+        def finished(*args):
+            self.emit("progress", 1.0)
+            self.emit("finished", failed)
+
+        if self.__write_tags and tracks and not self.__cancelled:
+            # The tag writer persists the library once it's done.
+            writer = blatagwriter.BlaTagWriter(tracks)
+            writer.connect("finished", finished)
+            writer.start()
+        else:
+            library.sync()
+            finished()
+        yield False
+
+    def start(self):
+        p = self.__analyze()
+        gobject.idle_add(p.next)
+
+    def cancel(self):
+        self.__cancelled = True
@@ -0,0 +1,275 @@
+# blaplay, Copyright (C) 2014  Niklas Koep
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+import os
+import mmap
+import struct
+import cPickle as pickle
+
+from blaplay import blautil
+
+MAGIC = "BLASTORE"
+VERSION = 1
+
+OP_PUT, OP_DELETE = xrange(2)
+
+# Every record starts with a fixed-size header holding the operation, the
+# table id, and the lengths of the key and the pickled value which follow the
+# header.
+_HEADER = struct.Struct("<BBII")
+
+# Compact the log once it holds more dead records than this and more dead
+# than live ones.
+_COMPACT_THRESHOLD = 4096
+
+_DELETED = object()
+
+
+class BlaStore(object):
+    """
+    Append-only, log-structured key-value store. Each put or delete is
+    appended to the log as a single record so persisting a change costs as
+    much as the change itself instead of a rewrite of the whole data set.
+    Records superseded by later ones are dropped by periodically compacting
+    the log into a new file. Values are read from a memory map of the log so
+    only records which are actually requested are ever paged in.
+    """
+
+    def __init__(self, path):
+        self.__path = path
+        # Maps table ids to dicts which map keys to (offset, length) pairs of
+        # the pickled value of the last record for the key.
+        self.__index = {}
+        self.__pending = {}
+        self.__n_dead = 0
+        self.__lock = blautil.BlaLock(strict=True)
+        self.__f = None
+        self.__map = None
+        self.__open()
+
+    def __open(self):
+        try:
+            f = open(self.__path, "a+b")
+        except IOError as exc:
+            print_w("Failed to open store \"%s\": %s" % (self.__path, exc))
+            return
+
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            f.write(MAGIC + chr(VERSION))
+            f.flush()
+        else:
+            f.seek(0)
+            if f.read(len(MAGIC) + 1) != MAGIC + chr(VERSION):
+                print_w("Invalid store \"%s\", starting from scratch" %
+                        self.__path)
+                f.truncate(0)
+                f.write(MAGIC + chr(VERSION))
+                f.flush()
+            else:
+                self.__replay(f)
+        self.__f = f
+
+    def __replay(self, f):
+        # Rebuild the index by walking the record headers. A record which was
+        # only partially written, e.g. because we crashed in the middle of a
+        # commit, marks the end of the usable log.
+        offset = f.tell()
+        header_size = _HEADER.size
+        index = self.__index
+        size = os.fstat(f.fileno()).st_size
+        n_dead = 0
+        while True:
+            header = f.read(header_size)
+            if len(header) < header_size:
+                break
+            op, table, key_length, value_length = _HEADER.unpack(header)
+            key = f.read(key_length)
+            value_offset = offset + header_size + key_length
+            if len(key) < key_length or value_offset + value_length > size:
+                break
+            f.seek(value_length, os.SEEK_CUR)
+
+            entries = index.setdefault(table, {})
+            if key in entries:
+                n_dead += 1
+            if op == OP_PUT:
+                entries[key] = (value_offset, value_length)
+            else:
+                n_dead += 1
+                entries.pop(key, None)
+            offset = f.tell()
+
+        f.seek(0, os.SEEK_END)
+        if f.tell() != offset:
+            print_w("Discarding truncated records at the end of \"%s\"" %
+                    self.__path)
+            f.truncate(offset)
+        self.__n_dead = n_dead
+
+    def __unmap(self):
+        if self.__map is not None:
+            self.__map.close()
+            self.__map = None
+
+    def __read(self, offset, length):
+        # The log only ever grows between compactions so we just need to remap
+        # it when reading a record which was appended after mapping it.
+        if self.__map is None or offset + length > len(self.__map):
+            self.__unmap()
+            self.__map = mmap.mmap(
+                self.__f.fileno(), 0, access=mmap.ACCESS_READ)
+        return pickle.loads(self.__map[offset:offset+length])
+
+    @staticmethod
+    def __encode_key(key):
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        return key
+
+    def keys(self, table):
+        with self.__lock:
+            keys = set(self.__index.get(table, {}).iterkeys())
+            for key, value in self.__pending.get(table, {}).iteritems():
+                if value is _DELETED:
+                    keys.discard(key)
+                else:
+                    keys.add(key)
+        return keys
+
+    def get(self, table, key, default=None):
+        key = self.__encode_key(key)
+        with self.__lock:
+            try:
+                value = self.__pending[table][key]
+            except KeyError:
+                try:
+                    offset, length = self.__index[table][key]
+                except KeyError:
+                    return default
+                return self.__read(offset, length)
+        return default if value is _DELETED else pickle.loads(value)
+
+    def items(self, table):
+        for key in self.keys(table):
+            value = self.get(table, key, _DELETED)
+            if value is not _DELETED:
+                yield key, value
+
+    def count(self, table):
+        return len(self.keys(table))
+
+    def put(self, table, key, value):
+        # Values are pickled right away so later mutations of `value' before
+        # the next commit don't leak into the store.
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self.__lock:
+            self.__pending.setdefault(table, {})[self.__encode_key(key)] = data
+
+    def delete(self, table, key):
+        with self.__lock:
+            self.__pending.setdefault(table, {})[self.__encode_key(key)] = (
+                _DELETED)
+
+    def clear(self, table):
+        for key in self.keys(table):
+            self.delete(table, key)
+
+    def commit(self):
+        """
+        Appends all pending changes to the log and syncs it to disk.
+        """
+
+        with self.__lock:
+            if self.__f is None or not self.__pending:
+                self.__pending.clear()
+                return
+
+            f = self.__f
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            header_size = _HEADER.size
+            chunks = []
+            for table, entries in self.__pending.iteritems():
+                index = self.__index.setdefault(table, {})
+                for key, data in entries.iteritems():
+                    if key in index:
+                        self.__n_dead += 1
+                    if data is _DELETED:
+                        if key not in index:
+                            continue
+                        del index[key]
+                        self.__n_dead += 1
+                        data = ""
+                        op = OP_DELETE
+                    else:
+                        op = OP_PUT
+                        index[key] = (offset + header_size + len(key),
+                                      len(data))
+                    chunks.append(_HEADER.pack(op, table, len(key), len(data)))
+                    chunks.append(key)
+                    chunks.append(data)
+                    offset += header_size + len(key) + len(data)
+            self.__pending.clear()
+
+            f.write("".join(chunks))
+            f.flush()
+            os.fsync(f.fileno())
+
+            n_live = sum(map(len, self.__index.itervalues()))
+            if (self.__n_dead > _COMPACT_THRESHOLD and
+                self.__n_dead > n_live):
+                self.__compact()
+
+    def __compact(self):
+        # Copy the latest record of every live key into a new log and swap it
+        # in atomically. Values are copied verbatim without unpickling them.
+        print_d("Compacting store \"%s\"" % self.__path)
+
+        tmp_path = "%s.tmp" % self.__path
+        header_size = _HEADER.size
+        index = {}
+        with open(tmp_path, "wb") as f:
+            f.write(MAGIC + chr(VERSION))
+            offset = f.tell()
+            for table, entries in self.__index.iteritems():
+                new_entries = index[table] = {}
+                for key, (value_offset, length) in entries.iteritems():
+                    self.__f.seek(value_offset)
+                    data = self.__f.read(length)
+                    f.write(_HEADER.pack(OP_PUT, table, len(key), length))
+                    f.write(key)
+                    f.write(data)
+                    new_entries[key] = (offset + header_size + len(key),
+                                        length)
+                    offset += header_size + len(key) + length
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(tmp_path, self.__path)
+        self.__unmap()
+        self.__f.close()
+        self.__f = open(self.__path, "a+b")
+        self.__index = index
+        self.__n_dead = 0
+
+    def close(self):
+        self.commit()
+        with self.__lock:
+            if self.__f is not None:
+                self.__unmap()
+                self.__f.close()
+                self.__f = None
@@ -0,0 +1,114 @@
+# blaplay, Copyright (C) 2014  Niklas Koep
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+import os
+
+import gobject
+
+from blaplay.blacore import blaparse, bladb
+from blaplay import blautil
+from blaplay.formats._identifiers import *
+
+# Number of tracks handed to a worker process at once. Batches are kept small
+# so progress is reported smoothly and cancelling doesn't have to wait for
+# many files to be written.
+BATCH_SIZE = 4
+
+
+def _write_batch(jobs):
+    results = []
+    for track, deleted_tags in jobs:
+        # The set of deleted tags isn't pickled along with the track.
+        if deleted_tags:
+            track._deleted_tags = set(deleted_tags)
+        uri = track.uri
+        try:
+            status = bool(track._save())
+        except Exception as exc:
+            print_d("Failed to write tags to \"%s\": %r" % (uri, exc))
+            status = False
+        try:
+            mtime = os.path.getmtime(uri)
+        except OSError:
+            mtime = None
+            status = False
+        results.append((uri, status, mtime))
+    return results
+
+
+class BlaTagWriter(gobject.GObject):
+    """
+    Writes the tags of a list of tracks to their files in a pool of worker
+    processes while the mainloop keeps running. The library is updated as
+    files are written and persisted once when all of them are done. Emits
+    `progress' with the number of finished and the total number of tracks
+    and `finished' with the list of URIs that couldn't be written.
+    Cancelling stops handing out tracks but lets the files which are already
+    being written finish, i.e. a file is never left half-written.
+    """
+
+    __gsignals__ = {
+        "progress": blautil.signal(2),
+        "finished": blautil.signal(1)
+    }
+
+    def __init__(self, tracks):
+        super(BlaTagWriter, self).__init__()
+        self.__tracks = list(tracks)
+        self.__cancelled = False
+
+    def __jobs(self):
+        ignore = bladb.BlaLibraryMonitor.ignore
+        for track in self.__tracks:
+            if self.__cancelled:
+                break
+            # The library monitor should skip the CHANGED events caused by
+            # writing the file as we update the library ourselves.
+            ignore.add(track.uri)
+            yield track, getattr(track, "_deleted_tags", None)
+
+    def __write(self):
+        library = bladb.library
+        ignore = bladb.BlaLibraryMonitor.ignore
+        tracks = dict((track.uri, track) for track in self.__tracks)
+        n_tracks = len(tracks)
+        n_done = 0
+        failed = []
+
+        for results in blaparse.run(_write_batch, self.__jobs(), BATCH_SIZE):
+            for uri, status, mtime in results:
+                if status:
+                    track = tracks[uri]
+                    track[MTIME] = mtime
+                    library[uri] = track
+                else:
+                    ignore.discard(uri)
+                    failed.append(uri)
+                n_done += 1
+            if results:
+                self.emit("progress", n_done, n_tracks)
+            yield True
+
+        library.sync()
+        self.emit("finished", failed)
+        yield False
+
+    def start(self):
+        p = self.__write()
+        gobject.idle_add(p.next)
+
+    def cancel(self):
+        self.__cancelled = True
@@ -0,0 +1,383 @@
+# blaplay, Copyright (C) 2014  Niklas Koep
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+import os
+import errno
+import select
+import struct
+import threading
+import ctypes
+import ctypes.util
+
+import gio
+
+from blaplay import blautil
+
+(EVENT_CREATED, EVENT_DELETED, EVENT_MOVED, EVENT_CHANGED,
+ EVENT_OVERFLOW) = xrange(5)
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_EXCL_UNLINK = 0x04000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+_INOTIFY_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+                 IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR | IN_EXCL_UNLINK)
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class BlaWatchLimitError(Exception):
+    pass
+
+
+class BlaWatcher(object):
+    """
+    Base class for watcher backends. A backend watches individual directories
+    and reports changes to their entries by calling `callback' with the event
+    type, the path of the affected entry, and the destination path for moves
+    (None otherwise). If a backend lost events it reports EVENT_OVERFLOW with
+    both paths set to None. Subdirectories need to be added explicitly.
+    Backends raise BlaWatchLimitError from `add_directory' if they can't hold
+    any more watches.
+    """
+
+    name = ""
+
+    def __init__(self, callback):
+        self._callback = callback
+        self._lock = blautil.BlaLock()
+        self._index = blautil.BlaPathIndex()
+
+    def __len__(self):
+        # Returns the number of watches held.
+        return len(self._index)
+
+    def __contains__(self, directory):
+        return directory in self._index
+
+    def _add(self, directory):
+        raise NotImplementedError
+
+    def _remove(self, directory):
+        raise NotImplementedError
+
+    def add_directory(self, directory):
+        with self._lock:
+            if directory not in self._index:
+                self._add(directory)
+                self._index.add(directory)
+
+    def remove_directories(self, directory):
+        # Removes the watches for `directory' and all its subdirectories.
+        with self._lock:
+            directories = self._index.get_paths_below(directory)
+            if directory in self._index:
+                directories.append(directory)
+            for directory in directories:
+                self._remove(directory)
+                self._index.discard(directory)
+
+    def clear(self):
+        with self._lock:
+            for directory in list(self._index):
+                self._remove(directory)
+            self._index = blautil.BlaPathIndex()
+
+    def close(self):
+        self.clear()
+
+class BlaGioWatcher(BlaWatcher):
+    """
+    Watcher backend using one GIO file monitor per directory.
+    """
+
+    name = "gio"
+
+    def __init__(self, callback):
+        super(BlaGioWatcher, self).__init__(callback)
+        self.__monitors = {}
+
+    def __changed(self, monitor, path_from, path_to, type_):
+        if type_ == gio.FILE_MONITOR_EVENT_CHANGES_DONE_HINT:
+            event = EVENT_CHANGED
+        elif type_ == gio.FILE_MONITOR_EVENT_DELETED:
+            event = EVENT_DELETED
+        elif type_ == gio.FILE_MONITOR_EVENT_MOVED:
+            event = EVENT_MOVED
+        elif type_ == gio.FILE_MONITOR_EVENT_CREATED:
+            event = EVENT_CREATED
+        else:
+            return
+
+        try:
+            path_to = path_to.get_path()
+        except AttributeError:
+            pass
+        self._callback(event, path_from.get_path(), path_to)
+
+    def _add(self, directory):
+        # According to the GIO C API documentation there are backends which
+        # don't support gio.FILE_MONITOR_EVENT_MOVED. However, since we
+        # specifically target Linux which has inotify since kernel 2.6.13 we
+        # should be in the clear (that is if the kernel in use was compiled
+        # with inotify support).
+        f = gio.File(directory)
+        monitor = f.monitor_directory(
+            flags=gio.FILE_MONITOR_NONE | gio.FILE_MONITOR_SEND_MOVED)
+        monitor.connect("changed", self.__changed)
+        self.__monitors[directory] = monitor
+
+    def _remove(self, directory):
+        self.__monitors.pop(directory).cancel()
+
+class BlaInotifyWatcher(BlaWatcher):
+    """
+    Watcher backend talking to inotify directly. All watches share a single
+    file descriptor which is read from a dedicated thread.
+    """
+
+    name = "inotify"
+
+    def __init__(self, callback):
+        super(BlaInotifyWatcher, self).__init__(callback)
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        try:
+            self.__add_watch = libc.inotify_add_watch
+            self.__rm_watch = libc.inotify_rm_watch
+            fd = libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        except AttributeError:
+            raise OSError(errno.ENOSYS, "inotify is not supported")
+        if fd < 0:
+            errno_ = ctypes.get_errno()
+            raise OSError(errno_, os.strerror(errno_))
+
+        self.__fd = fd
+        self.__wds = {}
+        self.__paths = {}
+        # Writing to this pipe wakes up the reader thread on shutdown.
+        self.__pipe = os.pipe()
+        self.__read_events()
+
+    def _add(self, directory):
+        wd = self.__add_watch(self.__fd, directory, _INOTIFY_MASK)
+        if wd < 0:
+            errno_ = ctypes.get_errno()
+            if errno_ == errno.ENOSPC:
+                raise BlaWatchLimitError(
+                    "Reached the inotify watch limit with %d watches" %
+                    len(self))
+            raise OSError(errno_, os.strerror(errno_), directory)
+        # Watching a directory which was moved while already being watched
+        # yields the same watch descriptor again.
+        self.__paths.pop(self.__wds.get(wd), None)
+        self.__wds[wd] = directory
+        self.__paths[directory] = wd
+
+    def _remove(self, directory):
+        try:
+            wd = self.__paths.pop(directory)
+        except KeyError:
+            return
+        self.__wds.pop(wd, None)
+        self.__rm_watch(self.__fd, wd)
+
+    def __dispatch(self, data, moves):
+        # Moves are reported as a pair of consecutive events tied together by
+        # a cookie. The source half is kept in `moves' until we see the next
+        # event. If that's not the destination half the entry was moved out of
+        # the watched directories.
+        callback = self._callback
+        join = os.path.join
+        offset = 0
+        size = _INOTIFY_EVENT.size
+        while offset < len(data):
+            wd, mask, cookie, length = _INOTIFY_EVENT.unpack_from(data, offset)
+            name = data[offset+size:offset+size+length].rstrip("\0")
+            offset += size + length
+
+            if moves and not (mask & IN_MOVED_TO and cookie in moves):
+                self.__flush_moves(moves)
+            if mask & IN_Q_OVERFLOW:
+                print_w("inotify event queue overflowed, events were lost")
+                callback(EVENT_OVERFLOW, None, None)
+                continue
+            with self._lock:
+                try:
+                    directory = self.__wds[wd]
+                except KeyError:
+                    continue
+                if mask & (IN_IGNORED | IN_DELETE_SELF):
+                    if mask & IN_IGNORED:
+                        self.__wds.pop(wd)
+                        self.__paths.pop(directory, None)
+                        self._index.discard(directory)
+                    continue
+            path = join(directory, name)
+
+            if mask & IN_CREATE:
+                callback(EVENT_CREATED, path, None)
+            elif mask & IN_CLOSE_WRITE:
+                callback(EVENT_CHANGED, path, None)
+            elif mask & IN_DELETE:
+                callback(EVENT_DELETED, path, None)
+            elif mask & IN_MOVED_FROM:
+                moves[cookie] = path
+            elif mask & IN_MOVED_TO:
+                try:
+                    callback(EVENT_MOVED, moves.pop(cookie), path)
+                except KeyError:
+                    # Moved in from outside the watched directories.
+                    callback(EVENT_CREATED, path, None)
+
+    def __flush_moves(self, moves):
+        for path in moves.itervalues():
+            self._callback(EVENT_DELETED, path, None)
+        moves.clear()
+
+    @blautil.thread
+    def __read_events(self):
+        fd = self.__fd
+        pipe = self.__pipe[0]
+        moves = {}
+        while True:
+            # The halves of a move might end up in different reads so wait a
+            # little while for the destination half before giving up on it.
+            timeout = 0.1 if moves else None
+            try:
+                readable = select.select([fd, pipe], [], [], timeout)[0]
+            except select.error as exc:
+                if exc.args[0] == errno.EINTR:
+                    continue
+                raise
+            if pipe in readable:
+                break
+            if not readable:
+                self.__flush_moves(moves)
+                continue
+            try:
+                data = os.read(fd, 65536)
+            except OSError as exc:
+                if exc.errno in (errno.EAGAIN, errno.EINTR):
+                    continue
+                raise
+            self.__dispatch(data, moves)
+
+        os.close(fd)
+        map(os.close, self.__pipe)
+
+    def close(self):
+        super(BlaInotifyWatcher, self).close()
+        os.write(self.__pipe[1], "\0")
+
+class BlaPollingWatcher(BlaWatcher):
+    """
+    Fallback backend which polls directories every `interval' seconds. A
+    directory is only listed again if its mtime or link count changed. Note
+    that this only picks up entries being added or removed, not files being
+    modified in place.
+    """
+
+    name = "polling"
+
+    def __init__(self, callback, interval, cache=None):
+        super(BlaPollingWatcher, self).__init__(callback)
+        self.__interval = interval
+        # A directory cache as maintained by blautil.discover_stat() saves us
+        # from listing directories again which haven't changed since.
+        self.__cache = cache if cache is not None else {}
+        self.__directories = {}
+        self.__stop = threading.Event()
+        self.__poll()
+
+    def __list(self, directory):
+        st = os.stat(directory)
+        state = (st.st_mtime, st.st_nlink)
+        entry = self.__cache.get(directory)
+        if entry is not None and entry[:2] == state:
+            names = set(map(os.path.basename, entry[2]))
+            names.update(entry[3])
+        else:
+            names = set(os.listdir(directory))
+        return state, names
+
+    def _add(self, directory):
+        try:
+            self.__directories[directory] = self.__list(directory)
+        except OSError:
+            pass
+
+    def _remove(self, directory):
+        self.__directories.pop(directory, None)
+
+    def __check(self, directory, state, names):
+        try:
+            st = os.stat(directory)
+        except OSError:
+            # The parent directory reports the removal unless it isn't
+            # watched.
+            if os.path.dirname(directory) not in self:
+                self._callback(EVENT_DELETED, directory, None)
+            with self._lock:
+                self._remove(directory)
+                self._index.discard(directory)
+            return
+        if (st.st_mtime, st.st_nlink) == state:
+            return
+
+        try:
+            state, current = self.__list(directory)
+        except OSError:
+            return
+        with self._lock:
+            if directory in self.__directories:
+                self.__directories[directory] = (state, current)
+        join = os.path.join
+        for name in current.difference(names):
+            self._callback(EVENT_CREATED, join(directory, name), None)
+        for name in names.difference(current):
+            self._callback(EVENT_DELETED, join(directory, name), None)
+
+    @blautil.thread
+    def __poll(self):
+        while not self.__stop.wait(self.__interval):
+            with self._lock:
+                directories = self.__directories.items()
+            for directory, (state, names) in directories:
+                self.__check(directory, state, names)
+
+    def close(self):
+        super(BlaPollingWatcher, self).close()
+        self.__stop.set()
+
+def create_watcher(callback):
+    # Returns an instance of the first watcher backend available.
+    for backend in [BlaInotifyWatcher, BlaGioWatcher]:
+        try:
+            return backend(callback)
+        except OSError as exc:
+            print_d("Watcher backend `%s' unavailable: %s" %
+                    (backend.name, exc))
+    raise OSError("No watcher backend available")
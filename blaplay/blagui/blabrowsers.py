@@ -28,10 +28,11 @@
 
 import blaplay
 library = blaplay.bla.library
-from blaplay.blacore import blaconst, blacfg
+from blaplay.blacore import blaconst, blacfg, blareplaygain
 from blaplay import blautil, blagui
 from blaplay.formats._identifiers import *
 from blawindows import BlaScrolledWindow
+import blarenamer
 from blaplaylist import playlist_manager
 from blaqueue import queue
 import blaguiutils
@@ -329,6 +330,14 @@ def dirname(s):
         if self.__browser_id == blaconst.BROWSER_LIBRARY:
             items.append(("Add to playback queue", "Q",
                           lambda *x: self.__send_to_queue(), True))
+            items.append(("Analyze ReplayGain", None,
+                          lambda *x: blareplaygain.analyze(tracks), True))
+            items.append(("Rename files from tags...", None,
+                          lambda *x: blarenamer.BlaRenameDialog(
+                              tracks, blarenamer.MODE_RENAME).run(), True))
+            items.append(("Tags from filenames...", None,
+                          lambda *x: blarenamer.BlaRenameDialog(
+                              tracks, blarenamer.MODE_TAGS).run(), True))
 
         accel_group = blaplay.bla.ui_manager.get_accel_group()
         menu = gtk.Menu()
@@ -357,11 +366,15 @@ def __init__(self, filter_string):
             flags = re.UNICODE | re.IGNORECASE
             self.__res = [re.compile(t, flags)
                           for t in map(re.escape, filter_string.split())]
+            self.candidates = library.search(filter_string)
             self.query = self.__query
         else:
+            self.candidates = None
             self.query = lambda *x: True
 
     def __query(self, uri):
+        if self.candidates is not None and uri not in self.candidates:
+            return False
         track = library[uri]
         strings = [track[identifier] for identifier in (ARTIST, TITLE, ALBUM)]
 
@@ -416,10 +429,16 @@ def cb(uri, comps):
             list_ = []
             append = list_.append
             library_filter = self.__get_filter()
-            query = BlaQuery(filter_string).query
+            query = BlaQuery(filter_string)
+            # Only the candidates of the search index need to be checked.
+            if query.candidates is not None:
+                uris = [uri for uri in query.candidates if uri in library]
+            else:
+                uris = library
+            query = query.query
             def filt(*args):
                 return library_filter(*args) and query(*args)
-            for uri in filter(filt, library):
+            for uri in filter(filt, uris):
                 comps = tuple(map(unicode, cb(uri, library[uri])))
                 append((comps, uri))
                 count = count+1
@@ -19,6 +19,7 @@
 from random import randint
 import urllib
 import re
+from array import array
 import xml.etree.cElementTree as ETree
 from xml.sax.saxutils import escape as xml_escape
 from copy import copy
@@ -30,14 +31,15 @@
 player = blaplay.bla.player
 library = blaplay.bla.library
 ui_manager = blaplay.bla.ui_manager
-from blaplay.blacore import blaconst, blacfg
+from blaplay.blacore import blaconst, blacfg, blafingerprint
 from blaplay import blautil, blagui
 from blaplay.formats._identifiers import *
 from blawindows import BlaScrolledWindow
 from blatracklist import (
     COLUMN_ALBUM_ARTIST, COLUMN_YEAR, COLUMN_GENRE, COLUMN_FORMAT,
     COLUMN_ARTIST, COLUMN_ALBUM, update_columns, parse_track_list_stats, popup,
-    BlaTreeView, BlaEval, BlaTrackListItem)
+    BlaTreeView, BlaEval, BlaTrackListItem, BlaTrackListModel,
+    BlaTrackListStats, get_sort_keys)
 from blaplay.blautil import blafm
 from blastatusbar import BlaStatusbar
 import blaview
@@ -65,15 +67,19 @@ def __init__(self, filter_string, regexp):
         filter_string = filter_string.decode("utf-8")
         if regexp:
             self.__res = [re.compile(r"%s" % filter_string, flags)]
+            self.__candidates = None
         else:
             self.__res = [re.compile(t, flags)
                           for t in map(re.escape, filter_string.split())]
+            # The library's search index rules out most tracks without
+            # looking at their tags.
+            self.__candidates = library.search(filter_string)
 
     def __column_to_tag_ids(self, column_id):
         if column_id == COLUMN_ALBUM_ARTIST:
             return [ALBUM_ARTIST, COMPOSER, PERFORMER]
         elif column_id == COLUMN_YEAR:
-            return [YEAR]
+            return [DATE]
         elif column_id == COLUMN_GENRE:
             return [GENRE]
         elif column_id == COLUMN_FORMAT:
@@ -91,13 +97,20 @@ def query(self, item):
                 return False
         return True
 
+    def filter(self, items):
+        candidates = self.__candidates
+        if candidates is None:
+            return filter(self.query, items)
+        query = self.query
+        return [item for item in items
+                if item.uri in candidates and query(item)]
+
 class BlaPlaylist(gtk.VBox):
-    __layout = (
-        gobject.TYPE_PYOBJECT,  # BlaTrackListItem instance
-        gobject.TYPE_STRING     # Stock item id
-    )
     __sort_parameters = None
     __fid = -1
+    # Incremented whenever the items or views of the playlist change so
+    # results of background jobs can tell whether they're outdated.
+    __generation = 0
 
     class HeaderBox(gtk.HBox):
         def __init__(self, name):
@@ -317,13 +330,22 @@ def __reduce__(self):
         return (self.__class__, ("bla",), self.__getstate__())
 
     def __getstate__(self):
+        # Only the URIs of the unsorted, unfiltered items are stored. The
+        # other lists are stored as arrays of indices into them. Items which
+        # are no longer part of the playlist are dropped from the lists.
+        positions = dict((id(item), idx)
+                         for idx, item in enumerate(self.__all_items))
+        def indices(items):
+            return array("i", [positions[id(item)] for item in items
+                               if id(item) in positions])
+
         state = {
             "name": self.get_name(),
             "locked": self.locked(),
-            "all_items": self.__all_items,
-            "items": self.__items,
-            "all_sorted": self.__all_sorted,
-            "sorted": self.__sorted,
+            "uris": [item.uri for item in self.__all_items],
+            "items": indices(self.__items),
+            "all_sorted": indices(self.__all_sorted),
+            "sorted": indices(self.__sorted),
             "mode": self.__mode,
             "sort_parameters": self.__sort_parameters,
             "regexp": self.__regexp_button.get_active(),
@@ -335,12 +357,27 @@ def __setstate__(self, state):
         self.set_name(state.get("name", ""))
         if state.get("locked", False):
             self.toggle_lock()
-        self.__all_items = state.get("all_items", [])
-        self.__items = state.get("items", [])
-        self.__all_sorted = state.get("all_sorted", [])
-        self.__sorted = state.get("sorted", [])
+        uris = state.get("uris")
+        if uris is None:
+            # Playlists saved by older versions pickled their items.
+            self.__all_items = state.get("all_items", [])
+            self.__items = state.get("items", [])
+            self.__all_sorted = state.get("all_sorted", [])
+            self.__sorted = state.get("sorted", [])
+        else:
+            self.__all_items = items = create_items_from_uris(uris)
+            for item in items:
+                item.playlist = self
+            self.__items = [items[idx] for idx in state["items"]]
+            self.__all_sorted = [items[idx] for idx in state["all_sorted"]]
+            self.__sorted = [items[idx] for idx in state["sorted"]]
+        library.ref_uris([item.uri for item in self.__all_items])
         self.__mode = state.get("mode", MODE_NORMAL)
         self.__sort_parameters = state.get("sort_parameters", None)
+        self.__stats = BlaTrackListStats(self.__all_items)
+        if self.__mode & MODE_FILTERED:
+            self.__filtered_stats = BlaTrackListStats(
+                self.__get_current_items())
 
         self.__regexp_button.set_active(state.get("regexp", True))
         self.__entry.set_text(state.get("query", ""))
@@ -351,6 +388,7 @@ def __setstate__(self, state):
 
     def __populate_model(self, scroll_item=None, row_align=0.5,
                          selected_items=[]):
+        self.__generation += 1
         if self.__mode & MODE_FILTERED:
             if self.__mode & MODE_SORTED:
                 items = self.__sorted
@@ -362,15 +400,9 @@ def __populate_model(self, scroll_item=None, row_align=0.5,
             else:
                 items = self.__all_items
 
-        # Determine new playlist metadata for the statusbar.
-        self.__length = sum([item.track[LENGTH] for item in items])
-        self.__size = sum([item.track[FILESIZE] for item in items])
-
-        # Fill and apply the new model.
-        model = gtk.ListStore(*self.__layout)
-        append = model.append
-        for item in items:
-            append([item, None])
+        # The model reads its rows straight from `items' so creating it is
+        # cheap regardless of the playlist's size.
+        model = BlaTrackListModel(items)
         self.__treeview.set_model(model)
 
         # Select the appropriate rows and scroll to last known location.
@@ -489,11 +521,12 @@ def __filter(self, *args):
 
             self.__mode |= MODE_FILTERED
             query = BlaQuery(
-                filter_string, self.__regexp_button.get_active()).query
+                filter_string, self.__regexp_button.get_active())
             if self.__mode & MODE_SORTED:
-                self.__sorted = filter(query, self.__all_sorted)
+                self.__sorted = items = query.filter(self.__all_sorted)
             else:
-                self.__items = filter(query, self.__all_items)
+                self.__items = items = query.filter(self.__all_items)
+            self.__filtered_stats = BlaTrackListStats(items)
         else:
             self.__mode &= ~MODE_FILTERED
             if self.__mode & MODE_SORTED:
@@ -618,14 +651,21 @@ def clear(self):
         if not self.modification_allowed(check_filter_state=False):
             return
 
+        self.__generation += 1
         self.__treeview.freeze_notify()
         self.__treeview.freeze_child_notify()
         model = self.__treeview.get_model()
         self.disable_search()
 
-        self.__length = 0
-        self.__size = 0
+        # Totals of the whole playlist and of the filtered items for the
+        # statusbar.
+        self.__stats = BlaTrackListStats()
+        self.__filtered_stats = BlaTrackListStats()
         self.__history.clear()
+        try:
+            library.unref_uris([item.uri for item in self.__all_items])
+        except AttributeError:
+            pass
         self.__all_items = []   # Unfiltered, unsorted tracks
         self.__all_sorted = []  # Unfiltered, sorted tracks
         self.__items = []       # Visible tracks when unsorted
@@ -635,7 +675,7 @@ def clear(self):
             column.set_sort_indicator(False)
         self.__mode = MODE_NORMAL
 
-        self.__treeview.set_model(gtk.ListStore(*self.__layout))
+        self.__treeview.set_model(BlaTrackListModel(self.__all_items))
         self.__treeview.thaw_child_notify()
         self.__treeview.thaw_notify()
 
@@ -788,36 +828,17 @@ def add_items(self, items, drop_info=None, select_rows=False):
             else:
                 drop_info = (path, gtk.TREE_VIEW_DROP_BEFORE)
 
-        reverse = False
+        # Insert new items into our book-keeping lists. The model shares the
+        # list of visible items so it only needs to be told about the new
+        # rows. Filtered playlists don't show the list we insert into.
         model = self.__freeze_treeview()
-        iterator = None
-        if drop_info is not None:
-            path, pos = drop_info
-            iterator = model.get_iter(path)
-
-            if pos in [gtk.TREE_VIEW_DROP_BEFORE,
-                       gtk.TREE_VIEW_DROP_INTO_OR_BEFORE]:
-                insert_func = model.insert_before
-                reverse = True
-            else:
-                path = (path[0]+1,)
-                insert_func = model.insert_after
+        start = self.insert(items, drop_info)
+        if self.__mode & MODE_FILTERED:
+            self.__populate_model()
+            model = self.__treeview.get_model()
         else:
-            path = (len(model),)
-            append = model.append
-            def insert_func(iterator, item):
-                append(item)
-
-        # Insert new items into our book-keeping lists.
-        self.insert(items, drop_info)
-
+            model.insert_rows(start, len(items))
         scroll_item = items[-1]
-        if reverse:
-            items.reverse()
-
-        # Insert into the actual model.
-        for item in items:
-            iterator = insert_func(iterator, [item, None])
 
         # Insertion is likely to destroy the sort order so remove sort
         # indicators.
@@ -828,7 +849,7 @@ def insert_func(iterator, item):
         if select_rows:
             selection = self.__treeview.get_selection()
             selection.unselect_all()
-            paths = [(p,) for p in xrange(path[0], path[0]+len(items))]
+            paths = [(p,) for p in xrange(start, start+len(items))]
             self.set_row(self.get_path_from_item(scroll_item), paths,
                          row_align=1.0)
 
@@ -840,6 +861,7 @@ def insert(self, items, drop_info):
         # Due to the way playlist contents are handled to speed up filtering
         # and sorting, dealing with track insertion into our book-keeping lists
         # is a rather fiddly task so be careful tampering with this function!
+        self.__generation += 1
         if self.__mode & MODE_SORTED:
             list_ = self.__all_sorted
         else:
@@ -855,9 +877,10 @@ def insert(self, items, drop_info):
         else:
             start = len(list_)
 
-        # Insert into the list `list_' references by using slice notation to
-        # assign the new values.
-        list_[:] = list_[:start] + items + list_[start:]
+        # Insert into the list `list_' references in place as the model of
+        # the treeview reads from it.
+        list_[start:start] = items
+        position = start
 
         # FIXME: This is the second check whether the list is sorted in this
         #        function.
@@ -865,18 +888,15 @@ def insert(self, items, drop_info):
             if start > 0:
                 item = list_[start-1]
                 start = self.__all_items.index(item)+1
-            else:
-                item = list_[start+1]
+            elif len(list_) > len(items):
+                item = list_[len(items)]
                 start = self.__all_items.index(item)
+            self.__all_items[start:start] = items
 
-            self.__all_items[:] = (self.__all_items[:start] + items +
-                                   self.__all_items[start:])
+        library.ref_uris([item.uri for item in items])
 
-        # Update the playlist statistics.
-        self.__length += sum(
-            [item.track[LENGTH] for item in items])
-        self.__size += sum(
-            [item.track[FILESIZE] for item in items])
+        self.__stats.add(items)
+        return position
 
     def get_selected_paths(self):
         return self.__treeview.get_selection().get_selected_rows()[-1]
@@ -887,18 +907,20 @@ def get_items(self, paths, remove=False):
 
         items = self.get_items_from_paths(paths)
         if remove:
-            self.__length -= sum([item.track[LENGTH] for item in items])
-            self.__size -= sum([item.track[FILESIZE] for item in items])
+            self.__generation += 1
+            self.__stats.remove(items)
+            if self.__mode & MODE_FILTERED:
+                self.__filtered_stats.remove(items)
 
-            # Remove the rows from the model.
+            # Remove the rows from the list of visible items through the model
+            # so the treeview learns about every deletion.
             model = self.__freeze_treeview()
-            get_iter = model.get_iter
-            iterators = map(get_iter, paths)
-            remove = model.remove
-            map(remove, iterators)
+            visible = model.items
+            model.delete_rows([path[0] for path in paths
+                               if 0 <= path[0] < len(visible)])
             self.__thaw_treeview()
 
-            # Remove items from the book-keeping lists.
+            # Remove items from the remaining book-keeping lists.
             lists = [self.__all_items]
             if self.__mode & MODE_FILTERED:
                 lists.append(self.__items)
@@ -907,48 +929,76 @@ def get_items(self, paths, remove=False):
             if self.__mode & MODE_SORTED:
                 lists.append(self.__all_sorted)
 
+            removed = set(items)
             for list_ in lists:
-                remove = list_.remove
-                map(remove, items)
+                if list_ is not visible:
+                    list_[:] = [item for item in list_ if item not in removed]
+            library.unref_uris([item.uri for item in items])
 
             playlist_manager.update_statusbar()
         return items
 
-    def remove_duplicates(self):
-        def remove_duplicates():
-            items = self.__get_current_items()
-            scroll_item, row_align, selected_items = \
-                self.__get_selection_and_row()
+    def __remove_duplicates(self, key):
+        # Removes visible items whose URI maps to the same value under `key'
+        # as that of an earlier item.
+        items = self.__get_current_items()
+        scroll_item, row_align, selected_items = \
+            self.__get_selection_and_row()
 
-            paths = self.get_selected_paths()
-            selected_items = self.get_items_from_paths(paths)
+        paths = self.get_selected_paths()
+        selected_items = self.get_items_from_paths(paths)
 
-            # Determine unique tracks
-            unique_items = blautil.BlaOrderedSet()
-            unique_uris = blautil.BlaOrderedSet()
-            for item in items:
-                if item.uri not in unique_uris:
-                    unique_items.add(item)
-                    unique_uris.add(item.uri)
-            unique_items = list(unique_items)
-            unique_uris = list(unique_uris)
+        unique_items = []
+        removed = []
+        seen = set()
+        for item in items:
+            value = key(item.uri)
+            if value in seen:
+                removed.append(item)
+            else:
+                seen.add(value)
+                unique_items.append(item)
+        if not removed:
+            return
 
-            if self.__mode & MODE_FILTERED:
-                if self.__mode & MODE_SORTED:
-                    self.__sorted = unique_items
-                else:
-                    self.__items = unique_items
+        # Duplicates in filtered playlists are only hidden.
+        if self.__mode & MODE_FILTERED:
+            self.__filtered_stats.remove(removed)
+            if self.__mode & MODE_SORTED:
+                self.__sorted = unique_items
             else:
-                if self.__mode & MODE_SORTED:
-                    self.__all_sorted = unique_items
-                else:
-                    self.__all_items = unique_items
+                self.__items = unique_items
+        else:
+            self.__stats.remove(removed)
+            library.unref_uris([item.uri for item in removed])
+            if self.__mode & MODE_SORTED:
+                self.__all_sorted = unique_items
+                removed = set(removed)
+                self.__all_items = [item for item in self.__all_items
+                                    if item not in removed]
+            else:
+                self.__all_items = unique_items
 
-            self.__populate_model(scroll_item, row_align, selected_items)
-            self.__treeview.set_sensitive(True)
+        self.__populate_model(scroll_item, row_align, selected_items)
 
-        self.__treeview.set_sensitive(False)
-        remove_duplicates()
+    def remove_duplicates(self):
+        # Items with the same URI are removed right away. Items which are the
+        # same recording are merged in the background afterwards, but only
+        # based on fingerprints which are already in the store. Computing
+        # missing ones means decoding every track.
+        if not self.modification_allowed(check_filter_state=False):
+            return
+        self.__remove_duplicates(lambda uri: uri)
+        generation = self.__generation
+        def merge(groups):
+            # Drop the result if the playlist was cleared, closed or changed
+            # in the meantime.
+            if (generation != self.__generation or
+                not self.modification_allowed(check_filter_state=False)):
+                return
+            self.__remove_duplicates(lambda uri: groups.get(uri, uri))
+        blafingerprint.fingerprints.group_async(
+            [item.uri for item in self.__get_current_items()], merge)
 
     def remove_invalid_tracks(self):
         # TODO
@@ -1028,11 +1078,18 @@ def sort(self, column_id, sort_order, scroll=False):
 
         scroll_item, row_align, selected_items = self.__get_selection_and_row()
 
-        items = (self.__items if self.__mode & MODE_FILTERED else
-                 self.__all_items)
+        # Filtered views are derived from the full views so the filter isn't
+        # applied again.
+        filtered = self.__mode & MODE_FILTERED
+        if filtered:
+            visible = set(map(id, self.__get_current_items()))
+
         if sort_order is None:
             self.__mode &= ~MODE_SORTED
             sort_indicator = False
+            if filtered:
+                self.__items = [item for item in self.__all_items
+                                if id(item) in visible]
         else:
             self.__mode |= MODE_SORTED
             sort_indicator = True
@@ -1041,17 +1098,19 @@ def sort(self, column_id, sort_order, scroll=False):
                 reverse = True
             elif sort_order == gtk.SORT_ASCENDING:
                 reverse = False
-            eval_ = BlaEval(column_id).eval
 
-            self.__all_sorted = sorted(
-                self.__all_items,
-                key=lambda item: eval_(item.track).lower(),
-                reverse=reverse)
-            items = sorted(
-                items,
-                key=lambda item: eval_(item.track).lower(),
-                reverse=reverse)
-            self.__sorted = items
+            # Sort the indices of the items by their cached keys so items
+            # themselves are never compared and ties keep their order.
+            items = self.__all_items
+            keys = get_sort_keys(items, column_id)
+            order = sorted(xrange(len(items)), key=keys.__getitem__,
+                           reverse=reverse)
+            self.__all_sorted = [items[idx] for idx in order]
+            if filtered:
+                self.__sorted = [item for item in self.__all_sorted
+                                 if id(item) in visible]
+            else:
+                self.__sorted = list(self.__all_sorted)
 
         if sort_order is not None:
             self.__sort_parameters = (column_id, sort_order, sort_indicator)
@@ -1075,11 +1134,15 @@ def get_uris(self, all_=False):
         return [item.uri for item in items]
 
     def update_uris(self, uris):
+        self.__generation += 1
         for item in self.__all_items:
             try:
-                item.uri = uris[item.uri]
+                uri = uris[item.uri]
             except KeyError:
-                pass
+                continue
+            library.ref_uris([uri])
+            library.unref_uris([item.uri])
+            item.uri = uri
 
     def get_item(self, choice=blaconst.TRACK_PLAY, force_advance=True):
         def get_random(old=None):
@@ -1097,9 +1160,7 @@ def get_random(old=None):
 
         # Remove the playing icon from the old row.
         current = playlist_manager.current
-        path = self.get_path_from_item(current)
-        if path is not None:
-            model[path][1] = None
+        model.set_stock(self.get_path_from_item(current), None)
 
         # If there are no tracks in the playlist, return.
         if not model.get_iter_first():
@@ -1149,11 +1210,9 @@ def get_random(old=None):
         return item
 
     def get_playlist_stats(self):
-        items = (self.__items if self.__mode & MODE_FILTERED else
-                 self.__all_items)
-        # TODO: maintain a __stats dict() in each playlist that stores this
-        #       info
-        return (len(items), self.__size, self.__length)
+        if self.__mode & MODE_FILTERED:
+            return self.__filtered_stats.get()
+        return self.__stats.get()
 
     def update_icon(self, clear=False):
         model = self.__treeview.get_model()
@@ -1166,10 +1225,7 @@ def update_icon(self, clear=False):
             stock = gtk.STOCK_MEDIA_PLAY
         elif blaconst.STATE_PAUSED:
             stock = gtk.STOCK_MEDIA_PAUSE
-        try:
-            model[path][1] = stock
-        except TypeError:
-            pass
+        model.set_stock(path, stock)
 
     def invalidate_visible_rows(self):
         try:
@@ -1724,10 +1780,7 @@ def save(path, type_):
             else:
                 active_playlist = current = None
 
-            uris = set()
-            for playlist in playlists:
-                uris.update(playlist.get_uris(all_=True))
-            library.save_ool_tracks(uris)
+            library.save_ool_tracks()
             blautil.serialize_to_file(
                 (playlists, active_playlist, current, queue.get_queue()),
                 blaconst.PLAYLISTS_PATH)
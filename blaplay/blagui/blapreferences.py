@@ -141,7 +141,8 @@ def destroy(*args):
             items = [
                 ("Add...", self.__add_directory),
                 ("Remove", self.__remove_directory),
-                ("Rescan all", self.__rescan_all)
+                ("Rescan all", self.__rescan_all),
+                ("Unparseable...", self.__show_failures)
             ]
             for idx, (label, callback) in enumerate(items):
                 button = gtk.Button(label)
@@ -294,6 +295,43 @@ def __rescan_all(self, button, treeview):
             for row in treeview.get_model():
                 library.scan_directory(row[0])
 
+        def __show_failures(self, button, treeview):
+            # Lists the files the library skips because they failed to parse
+            # and offers to forget about them so they're tried again.
+            diag = blaguiutils.BlaDialog(
+                parent=self.get_toplevel(), title="Unparseable files",
+                buttons=(gtk.STOCK_CLEAR, gtk.RESPONSE_REJECT,
+                         gtk.STOCK_CLOSE, gtk.RESPONSE_CLOSE))
+            diag.set_resizable(True)
+
+            model = gtk.ListStore(gobject.TYPE_STRING)
+            for uri in sorted(library.get_failures()):
+                model.append([uri])
+            failures = gtk.TreeView(model)
+            failures.set_property("rules_hint", True)
+            r = gtk.CellRendererText()
+            failures.insert_column_with_attributes(-1, "Path", r, text=0)
+
+            sw = BlaScrolledWindow()
+            sw.set_shadow_type(gtk.SHADOW_IN)
+            sw.set_size_request(500, 250)
+            sw.add(failures)
+            vbox = gtk.VBox(spacing=5)
+            vbox.set_border_width(10)
+            label = gtk.Label("%d files are skipped until they change:" %
+                              len(model))
+            label.set_alignment(xalign=0.0, yalign=0.5)
+            vbox.pack_start(label, expand=False)
+            vbox.pack_start(sw)
+            diag.vbox.pack_start(vbox)
+            diag.set_response_sensitive(gtk.RESPONSE_REJECT, len(model) > 0)
+
+            diag.show_all()
+            response = diag.run()
+            diag.destroy()
+            if response == gtk.RESPONSE_REJECT:
+                library.clear_failures()
+
         def __tree_lines_changed(self, checkbutton):
             blacfg.setboolean(
                 "library", "draw.tree.lines", checkbutton.get_active())
@@ -313,6 +351,16 @@ def __init__(self):
             logarithmic_volume_scale.connect(
                 "toggled", self.__volume_scale_changed)
 
+            replaygain_box = gtk.combo_box_new_text()
+            map(replaygain_box.append_text, ["off", "track", "album"])
+            replaygain_box.set_active(
+                blacfg.getint("player", "replaygain.mode"))
+            replaygain_box.connect("changed", self.__replaygain_mode_changed)
+            replaygain = gtk.HBox()
+            replaygain.pack_start(
+                gtk.Label("ReplayGain:"), expand=False, padding=2)
+            replaygain.pack_start(replaygain_box, expand=False, padding=8)
+
             state = blacfg.getboolean("player", "use.equalizer")
             self.__scales = []
 
@@ -352,11 +400,12 @@ def __init__(self):
             self.__button_box.pack_start(
                 button_table, expand=False, padding=16)
 
-            table = gtk.Table(rows=2, columns=2, homogeneous=False)
+            table = gtk.Table(rows=3, columns=2, homogeneous=False)
             table.set_row_spacings(2)
             table.attach(logarithmic_volume_scale, 0, 2, 0, 1, xpadding=2)
-            table.attach(use_equalizer, 0, 1, 1, 2, xpadding=2)
-            table.attach(self.__button_box, 1, 2, 1, 2, xpadding=2)
+            table.attach(replaygain, 0, 2, 1, 2, xpadding=2)
+            table.attach(use_equalizer, 0, 1, 2, 3, xpadding=2)
+            table.attach(self.__button_box, 1, 2, 2, 3, xpadding=2)
 
             self.__scale_box = gtk.HBox(homogeneous=True)
 
@@ -393,6 +442,10 @@ def __volume_scale_changed(self, checkbutton):
                               checkbutton.get_active())
             player.set_volume(blacfg.getfloat("player", "volume") * 100)
 
+        def __replaygain_mode_changed(self, combobox):
+            blacfg.set("player", "replaygain.mode", combobox.get_active())
+            player.update_replaygain()
+
         def __use_equalizer_changed(self, checkbutton):
             state = checkbutton.get_active()
             blacfg.setboolean("player", "use.equalizer", state)
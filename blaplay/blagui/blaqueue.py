@@ -29,7 +29,8 @@
 from blawindows import BlaScrolledWindow
 from blatracklist import (
     COLUMN_ARTIST, COLUMN_ALBUM, COLUMN_ALBUM_ARTIST, COLUMN_GENRE, popup,
-    update_columns, parse_track_list_stats, BlaTreeView, BlaTrackListItem)
+    update_columns, parse_track_list_stats, BlaTreeView, BlaTrackListItem,
+    BlaTrackListStats)
 from blastatusbar import BlaStatusbar
 from blaview import BlaViewMeta
 from blaplaylist import playlist_manager
@@ -46,8 +47,7 @@ class BlaQueue(BlaScrolledWindow):
     def __init__(self):
         super(BlaQueue, self).__init__()
 
-        self.__size = 0
-        self.__length = 0
+        self.__stats = BlaTrackListStats()
         self.clipboard = []
 
         self.__treeview = BlaTreeView(view_id=blaconst.VIEW_QUEUE)
@@ -155,6 +155,7 @@ def insert_func(iterator, item):
 
         for item in items:
             iterator = insert_func(iterator, [item, None])
+        self.__stats.add(items)
 
         if select_rows:
             treeview.freeze_notify()
@@ -176,6 +177,7 @@ def __get_items(self, remove=True):
             if remove:
                 remove = model.remove
                 map(remove, iterators)
+                self.__stats.remove(items)
                 self.update_queue_positions()
             return items
         return []
@@ -185,16 +187,16 @@ def play_item(self, treeview, path, column=None):
         iterator = model.get_iter(path)
         model[iterator][0].play()
         if blacfg.getboolean("general", "queue.remove.when.activated"):
+            self.__stats.remove([model[iterator][0]])
             model.remove(iterator)
             self.update_queue_positions()
 
     def update_statusbar(self):
-        model = self.__treeview.get_model()
-        count = len(model)
+        count, size, length = self.__stats.get()
         if count == 0:
             info = ""
         else:
-            info = parse_track_list_stats(count, self.__size, self.__length)
+            info = parse_track_list_stats(count, size, length)
         BlaStatusbar.set_view_info(blaconst.VIEW_QUEUE, info)
 
     def select(self, type_):
@@ -249,13 +251,6 @@ def update_queue_positions(self):
         playlist = playlist_manager.get_current_playlist()
         playlist.invalidate_visible_rows()
 
-        # Calculate size and length of the queue and update the statusbar.
-        size = length = 0
-        for row in model:
-            track = row[0].track
-            size += track[FILESIZE]
-            length += track[LENGTH]
-        self.__size, self.__length = size, length
         self.emit("count_changed", blaconst.VIEW_QUEUE, self.n_items)
         self.update_statusbar()
 
@@ -280,9 +275,12 @@ def remove_items(self, items):
         # This is invoked by playlists who want to remove tracks from the
         # queue.
         model = self.__treeview.get_model()
+        removed = []
         for row in model:
             if row[0] in items:
+                removed.append(row[0])
                 model.remove(row.iter)
+        self.__stats.remove(removed)
         self.update_queue_positions()
 
     def get_queue(self):
@@ -346,26 +344,33 @@ def remove(self, *args):
     def remove_duplicates(self):
         unique = set()
         model = self.__treeview.get_model()
+        removed = []
         for row in model:
             uri = row[0].uri
             if uri not in unique:
                 unique.add(uri)
             else:
+                removed.append(row[0])
                 model.remove(row.iter)
+        self.__stats.remove(removed)
         self.update_queue_positions()
 
     def remove_invalid_tracks(self):
         model = self.__treeview.get_model()
         isfile = os.path.isfile
 
+        removed = []
         for row in model:
             uri = row[0].uri
             if not isfile(uri):
+                removed.append(row[0])
                 model.remove(row.iter)
+        self.__stats.remove(removed)
         self.update_queue_positions()
 
     def clear(self):
         self.__treeview.get_model().clear()
+        self.__stats.clear()
         self.update_queue_positions()
 
     def get_item(self):
@@ -374,6 +379,7 @@ def get_item(self):
         if iterator:
             item = model[iterator][0]
             model.remove(iterator)
+            self.__stats.remove([item])
             self.update_queue_positions()
             return item
         return None
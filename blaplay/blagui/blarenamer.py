@@ -0,0 +1,157 @@
+# blaplay, Copyright (C) 2014  Niklas Koep
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+import gobject
+import gtk
+
+from blaplay.blacore import blacfg, blarename
+from blaplay.formats._identifiers import *
+from blawindows import BlaScrolledWindow
+import blaguiutils
+
+MODE_RENAME, MODE_TAGS = xrange(2)
+
+
+class BlaRenameDialog(blaguiutils.BlaDialog):
+    """
+    Lets the user enter a pattern and shows what renaming the files in `uris'
+    after their tags (MODE_RENAME) or setting their tags from their paths
+    (MODE_TAGS) would do before anything is changed.
+    """
+
+    def __init__(self, uris, mode=MODE_RENAME):
+        if mode == MODE_RENAME:
+            title = "Rename files from tags"
+            self.__key = "rename.pattern"
+        else:
+            title = "Tags from filenames"
+            self.__key = "tags.pattern"
+        super(BlaRenameDialog, self).__init__(
+            title=title, buttons=(gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL,
+                                  gtk.STOCK_APPLY, gtk.RESPONSE_OK))
+        self.set_resizable(True)
+        self.set_size_request(700, 400)
+        self.__uris = uris
+        self.__mode = mode
+        self.__plan = None
+        self.__tid = 0
+
+        vbox = gtk.VBox(spacing=5)
+        vbox.set_border_width(10)
+
+        hbox = gtk.HBox(spacing=5)
+        hbox.pack_start(gtk.Label("Pattern:"), expand=False)
+        self.__entry = gtk.Entry()
+        self.__entry.set_text(blacfg.getstring("library", self.__key))
+        self.__entry.connect("changed", self.__pattern_changed)
+        hbox.pack_start(self.__entry)
+        vbox.pack_start(hbox, expand=False)
+
+        label = gtk.Label("Fields: %s" % ", ".join(
+            "<%s>" % name for name in sorted(blarename.FIELDS)))
+        label.set_alignment(xalign=0.0, yalign=0.5)
+        label.set_line_wrap(True)
+        vbox.pack_start(label, expand=False)
+
+        # The third column holds the color of a row. Conflicts are shown in
+        # red.
+        self.__model = gtk.ListStore(str, str, str)
+        treeview = gtk.TreeView(self.__model)
+        treeview.set_enable_search(False)
+        if mode == MODE_RENAME:
+            labels = ["Path", "New path"]
+        else:
+            labels = ["Path", "New tags"]
+        for idx, label in enumerate(labels):
+            renderer = gtk.CellRendererText()
+            column = gtk.TreeViewColumn(label, renderer, text=idx,
+                                        foreground=2)
+            column.set_resizable(True)
+            column.set_expand(True)
+            treeview.append_column(column)
+        sw = BlaScrolledWindow()
+        sw.set_shadow_type(gtk.SHADOW_IN)
+        sw.add(treeview)
+        vbox.pack_start(sw)
+
+        self.__status = gtk.Label()
+        self.__status.set_alignment(xalign=0.0, yalign=0.5)
+        vbox.pack_start(self.__status, expand=False)
+
+        self.vbox.pack_start(vbox)
+        self.__update_plan()
+        self.show_all()
+
+    def __pattern_changed(self, entry):
+        gobject.source_remove(self.__tid)
+        def update():
+            self.__update_plan()
+            return False
+        self.__tid = gobject.timeout_add(500, update)
+
+    def __update_plan(self):
+        # Recomputes the plan for the current pattern and shows it. Nothing
+        # is changed on disk until the dialog is confirmed.
+        self.__model.clear()
+        self.__plan = None
+        try:
+            pattern = blarename.BlaPattern(self.__entry.get_text())
+        except ValueError as exc:
+            self.__status.set_text(str(exc))
+            self.set_response_sensitive(gtk.RESPONSE_OK, False)
+            return
+
+        append = self.__model.append
+        if self.__mode == MODE_RENAME:
+            renames, conflicts = blarename.plan_renames(self.__uris, pattern)
+            for path_from, path_to in renames:
+                append([path_from, path_to, None])
+            for path_from, path_to in conflicts:
+                append([path_from, path_to, "red"])
+            self.__plan = renames
+            status = "%d files to rename, %d conflicts" % (
+                len(renames), len(conflicts))
+        else:
+            changes, unmatched = blarename.plan_tags(self.__uris, pattern)
+            for uri, values in changes:
+                tags = ", ".join(
+                    "%s: %s" % (IDENTIFIER_LABELS[identifier],
+                                values[identifier].encode("utf-8"))
+                    for identifier in sorted(values))
+                append([uri, tags, None])
+            for uri in unmatched:
+                append([uri, "", "red"])
+            self.__plan = changes
+            status = "%d files to tag, %d files don't match" % (
+                len(changes), len(unmatched))
+        self.__status.set_text(status)
+        self.set_response_sensitive(gtk.RESPONSE_OK, bool(self.__plan))
+
+    def run(self):
+        response = super(BlaRenameDialog, self).run()
+        gobject.source_remove(self.__tid)
+        if response == gtk.RESPONSE_OK:
+            # The plan might be outdated if the pattern was just changed.
+            self.__update_plan()
+            blacfg.set("library", self.__key, self.__entry.get_text())
+            if self.__plan:
+                if self.__mode == MODE_RENAME:
+                    blarename.rename(self.__plan)
+                else:
+                    blarename.tag(self.__plan)
+        self.destroy()
+        return response
+
@@ -25,9 +25,8 @@
 
 import blaplay
 library = blaplay.bla.library
-from blaplay.blacore import blaconst
+from blaplay.blacore import blaconst, blatagwriter
 from blaplay import blautil, blagui
-from blaplay.formats._blatrack import BlaTrack
 from blaplay.formats._identifiers import *
 from blawindows import BlaWindow, BlaScrolledWindow
 import blaguiutils
@@ -195,6 +194,7 @@ def key_press_event(treeview, event):
             ("Undo changes", gtk.STOCK_UNDO, BlaTagEditor.__undo),
             ("Apply changes", gtk.STOCK_OK, BlaTagEditor.__apply)
         ]
+        self.__writer = None
         for tooltip, stock, callback in buttons:
             button = gtk.Button()
             button.set_tooltip_text(tooltip)
@@ -207,6 +207,7 @@ def key_press_event(treeview, event):
             button.modify_style(style)
             button.connect_object("clicked", callback, self)
             self.__hbox.pack_start(button)
+        self.__apply_button = button
         self.__hbox.set_sensitive(False)
 
         self._modified = blautil.BlaNotifyDict()
@@ -235,8 +236,7 @@ def _populate_model(self, model):
         # Additional tags
         additional_tags = set()
         update = additional_tags.update
-        keys_additional_tags = BlaTrack.keys_additional_tags
-        map(update, map(keys_additional_tags, tracks))
+        map(update, [track.keys_additional_tags() for track in tracks])
 
         for tag in additional_tags:
             try:
@@ -366,33 +366,46 @@ def __popup(self, event):
         menu.popup(None, None, None, event.button, event.time)
 
     def __apply(self):
-        if len(self._modified) == 0:
+        if len(self._modified) == 0 or self.__writer is not None:
             return
 
+        # Tags are written in the background. Lock the editor meanwhile as
+        # the tracks being written are the ones holding the changes.
+        self._treeview.set_sensitive(False)
+        self.__apply_button.set_sensitive(False)
+        self._pb.set_fraction(0.0)
+        self._pb.set_text("")
         self._pb.set_visible(True)
-        unit = 1.0 / len(self._modified)
-        idx = 0
-        succeeded = 0
-        for uri, track in self._modified.iteritems():
-            self._pb.set_fraction(unit * (idx+1))
-            self._pb.set_text(uri)
-            library[uri] = track
-            succeeded += int(track.save())
-            idx += 1
-        self._pb.set_visible(False)
-
-        library.sync()
 
-        self._update_model(self._uris)
-
-        n_modified = len(self._modified)
-        if n_modified > 0 and succeeded != n_modified:
-            blaguiutils.warning_dialog(
-                "Failed to write tags for %d of %d files." %
-                ((n_modified-succeeded), n_modified))
-        self._modified.clear()
+        def progress(writer, n_done, n_tracks):
+            self._pb.set_fraction(float(n_done) / n_tracks)
+            self._pb.set_text("%d of %d files" % (n_done, n_tracks))
+
+        def finished(writer, failed):
+            self.__writer = None
+            self._pb.set_visible(False)
+            self._treeview.set_sensitive(True)
+            self.__apply_button.set_sensitive(True)
+            n_modified = len(self._modified)
+            self._modified.clear()
+            self._update_model(self._uris)
+            if failed:
+                blaguiutils.warning_dialog(
+                    "Failed to write tags for %d of %d files." %
+                    (len(failed), n_modified))
+
+        writer = self.__writer = blatagwriter.BlaTagWriter(
+            self._modified.values())
+        writer.connect("progress", progress)
+        writer.connect("finished", finished)
+        writer.start()
 
     def __undo(self):
+        # Undoing while tags are being written cancels writing the remaining
+        # files. Changes which weren't written yet are dropped.
+        if self.__writer is not None:
+            self.__writer.cancel()
+            return
         self._modified.clear()
         self.__update_model_and_restore_selection()
 
@@ -406,6 +419,10 @@ def __init__(self, playlist_manager):
 
     def _populate_model(self, model):
         def get_value(track, identifier):
+            # A gain of 0 dB is a valid value.
+            if (identifier in (REPLAYGAIN_TRACK_GAIN, REPLAYGAIN_ALBUM_GAIN)
+                and track[identifier] != ""):
+                return "%+.2f dB" % track[identifier]
             if not track[identifier] and identifier != MONITORED_DIRECTORY:
                 return None
             elif identifier == FILESIZE:
@@ -420,6 +437,11 @@ def get_value(track, identifier):
                 value = track.sampling_rate
             elif identifier == CHANNELS:
                 value = str(track[CHANNELS])
+            elif identifier in (REPLAYGAIN_TRACK_PEAK, REPLAYGAIN_ALBUM_PEAK):
+                value = "%.6f" % track[identifier]
+            elif identifier in (OFFSET_START, OFFSET_END):
+                # Offsets of virtual tracks are positions in their file.
+                value = "%d:%05.2f" % divmod(track[identifier], 60)
             else:
                 value = track[identifier]
             return value
@@ -427,6 +449,10 @@ def get_value(track, identifier):
         tracks = [library[uri] for uri in iter(self._uris)]
 
         for identifier in IDENTIFIER_PROPERTIES:
+            # The name of a track's image in the cover cache is of no use to
+            # the user.
+            if identifier == COVER_ART:
+                continue
             value = get_value(tracks[0], identifier)
             for track in tracks[1:]:
                 if value != get_value(track, identifier):
@@ -15,6 +15,7 @@
 # Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
 import os
+import locale
 
 import gobject
 import gtk
@@ -574,6 +575,59 @@ def __filesize_cb(track):
         __directory_cb, __path_cb, __filesize_cb
     ]
 
+def _collate(value):
+    # Returns a key which sorts strings case-insensitively according to the
+    # current locale.
+    if isinstance(value, str):
+        value = value.decode("utf-8", "replace")
+    return locale.strxfrm(value.lower().encode("utf-8"))
+
+def _number(value):
+    # Returns the leading number of values like `3/12' or `2004-05-01', or -1
+    # if there is none.
+    if not isinstance(value, basestring):
+        return value if value != "" else -1
+    try:
+        return int(value.replace("-", "/").split("/")[0])
+    except ValueError:
+        return -1
+
+def _album_order(track):
+    # Key for the natural order of a library, i.e. by album artist, year,
+    # album, disc and track number.
+    album_artist = BlaEval(COLUMN_ALBUM_ARTIST).eval(track)
+    return (_collate(album_artist), _number(track[DATE]),
+            _collate(track[ALBUM]), _number(track[DISC]),
+            _number(track[TRACK]))
+
+# Sort keys of columns whose values don't sort like the strings displayed.
+# Other columns sort by the locale-aware key of their displayed value.
+_SORT_KEYS = {
+    COLUMN_TRACK: lambda track: (_number(track[DISC]), _number(track[TRACK])),
+    COLUMN_DURATION: lambda track: _number(track[LENGTH]),
+    COLUMN_YEAR: lambda track: _number(track[DATE]),
+    COLUMN_BITRATE: lambda track: _number(track[BITRATE]),
+    COLUMN_FILESIZE: lambda track: _number(track[FILESIZE])
+}
+
+def get_sort_keys(items, column_id):
+    """
+    Returns the sort keys of `items' for column `column_id'. Ties are broken
+    by the album order so sorting by e.g. album artist sorts the albums of an
+    artist by year and their tracks by disc and track number in one pass.
+    Keys are cached by the library until a track's tags change.
+    """
+
+    try:
+        key = _SORT_KEYS[column_id]
+    except KeyError:
+        eval_ = BlaEval(column_id).eval
+        key = lambda track: _collate(eval_(track))
+    def sort_key(track):
+        return (key(track),) + _album_order(track)
+    return library.get_sort_keys(
+        [item.uri for item in items], ("column", column_id), sort_key)
+
 class BlaColumn(gtk.TreeViewColumn):
     def __init__(self, column_id):
         super(BlaColumn, self).__init__()
@@ -618,11 +672,167 @@ def __cell_data_func(self, column, renderer, model, iterator, column_id):
 
         renderer.set_property("text", text)
 
+class BlaTrackListModel(gtk.GenericTreeModel):
+    """
+    List model which reads its rows straight from a list of BlaTrackListItem
+    instances instead of copying them into a gtk.ListStore. The list is
+    shared with the owner of the model who has to announce changes to it
+    through insert_rows() and delete_rows(). Rows consist of the item and the
+    stock id of its state icon.
+    """
+
+    __types = (gobject.TYPE_PYOBJECT, gobject.TYPE_STRING)
+
+    def __init__(self, items):
+        super(BlaTrackListModel, self).__init__()
+        # Row references are row indices. GTK only holds borrowed references
+        # to them so we keep the int objects alive ourselves.
+        self.set_property("leak-references", False)
+        self.items = items
+        self.__refs = []
+        self.__stock = {}
+
+    def __ref(self, idx):
+        refs = self.__refs
+        if idx >= len(refs):
+            refs.extend(xrange(len(refs), idx+1))
+        return refs[idx]
+
+    def on_get_flags(self):
+        return gtk.TREE_MODEL_LIST_ONLY
+
+    def on_get_n_columns(self):
+        return len(self.__types)
+
+    def on_get_column_type(self, n):
+        return self.__types[n]
+
+    def on_get_iter(self, path):
+        if path[0] < len(self.items):
+            return self.__ref(path[0])
+        return None
+
+    def on_get_path(self, rowref):
+        return (rowref,)
+
+    def on_get_value(self, rowref, column):
+        try:
+            item = self.items[rowref]
+        except IndexError:
+            return None
+        if column == 0:
+            return item
+        return self.__stock.get(item)
+
+    def on_iter_next(self, rowref):
+        if rowref+1 < len(self.items):
+            return self.__ref(rowref+1)
+        return None
+
+    def on_iter_children(self, parent):
+        if parent is None and self.items:
+            return self.__ref(0)
+        return None
+
+    def on_iter_has_child(self, rowref):
+        return False
+
+    def on_iter_n_children(self, rowref):
+        if rowref is None:
+            return len(self.items)
+        return 0
+
+    def on_iter_nth_child(self, parent, n):
+        if parent is None and 0 <= n < len(self.items):
+            return self.__ref(n)
+        return None
+
+    def on_iter_parent(self, child):
+        return None
+
+    def set_stock(self, path, stock):
+        try:
+            item = self.items[path[0]]
+        except (TypeError, IndexError):
+            return
+        if stock is None:
+            self.__stock.pop(item, None)
+        else:
+            self.__stock[item] = stock
+        self.row_changed(path, self.get_iter(path))
+
+    def insert_rows(self, start, n):
+        # Announces `n' rows which were inserted into the list at `start'.
+        row_inserted = self.row_inserted
+        get_iter = self.get_iter
+        for idx in xrange(start, start+n):
+            row_inserted((idx,), get_iter((idx,)))
+
+    def delete_rows(self, indices):
+        # Removes the rows at `indices' from the list, announcing every
+        # deletion right after it happened so the view and the list never
+        # disagree on the number of rows.
+        items = self.items
+        stock = self.__stock
+        row_deleted = self.row_deleted
+        for idx in sorted(indices, reverse=True):
+            stock.pop(items.pop(idx), None)
+            row_deleted((idx,))
+
+class BlaTrackListStats(object):
+    """
+    Running totals of the number of items in a track list and the size and
+    length of their tracks. Owners report every item they add or remove so
+    the statusbar never has to look at all of them.
+    """
+
+    def __init__(self, items=()):
+        self.clear()
+        self.add(items)
+
+    def __totals(self, items):
+        sizes, lengths = library.get_columns(
+            [item.uri for item in items], [FILESIZE, LENGTH])
+        return sum(size or 0 for size in sizes), sum(
+            length or 0 for length in lengths)
+
+    def clear(self):
+        self.count = self.size = self.length = 0
+
+    def add(self, items):
+        if items:
+            size, length = self.__totals(items)
+            self.count += len(items)
+            self.size += size
+            self.length += length
+
+    def remove(self, items):
+        if items:
+            size, length = self.__totals(items)
+            self.count -= len(items)
+            self.size -= size
+            self.length -= length
+
+    def get(self):
+        return self.count, self.size, self.length
+
 class BlaTrackListItem(object):
+    # Playlists hold one item per row so items don't get an instance dict.
+    __slots__ = ("uri", "playlist")
+
     def __init__(self, uri):
         self.uri = uri
         self.playlist = None
 
+    def __getstate__(self):
+        return {"uri": self.uri, "playlist": self.playlist}
+
+    def __setstate__(self, state):
+        # Items pickled before they had slots restore from their old instance
+        # dict.
+        self.uri = state["uri"]
+        self.playlist = state.get("playlist")
+
     @property
     def track(self):
         return library[self.uri]
@@ -25,7 +25,7 @@
 player = blaplay.bla.player
 library = blaplay.bla.library
 ui_manager = blaplay.bla.ui_manager
-from blaplay.blacore import blaconst, blacfg
+from blaplay.blacore import blaconst, blacfg, blacovers
 from blaplay import blautil, blagui
 from blaplay.formats._identifiers import *
 from blawindows import BlaScrolledWindow
@@ -165,8 +165,10 @@ def delete_cover(*args):
             return True
 
         def __prepare_cover(self, cover):
+            height = self.get_allocation()[-1]
             try:
-                pb = gtk.gdk.pixbuf_new_from_file(cover)
+                pb = gtk.gdk.pixbuf_new_from_file(
+                    blacovers.get_thumbnail(cover, height))
             except gobject.GError:
                 if cover != blaconst.COVER:
                     try:
@@ -177,7 +179,6 @@ def __prepare_cover(self, cover):
                     return False
                 pb = gtk.gdk.pixbuf_new_from_file(blaconst.COVER)
 
-            height = self.get_allocation()[-1]
             pb = pb.scale_simple(height, height, gtk.gdk.INTERP_HYPER)
             self.__pb_prev = self.__pb
             self.__pb = pb
@@ -28,11 +28,17 @@
 import functools
 from threading import Thread, ThreadError, Lock
 import collections
+import bisect
+import stat
 import time
 
 import gobject
 import gio
 import gtk
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
 
 
 def clamp(min_, max_, value):
@@ -165,13 +171,13 @@ def open_with_filehandler(f, msg):
                 error_dialog(msg)
 
 def discover(d, directories_only=False):
-    checked_directories = []
+    checked_directories = set()
     if not hasattr(d, "__iter__"):
         d = [d]
 
     realpath = os.path.realpath
     walk = os.walk
-    append = checked_directories.append
+    append = checked_directories.add
     join = os.path.join
 
     for directory in d:
@@ -188,6 +194,111 @@ def discover(d, directories_only=False):
             for filename in filenames:
                 yield join(dirname, filename)
 
+def _list_directory(dirname):
+    # Yields (path, stat_result, is_symlink) tuples for all entries of
+    # `dirname'. Stat results follow symlinks. With scandir we avoid stat'ing
+    # subdirectories as their type is already known from the directory
+    # listing.
+    join = os.path.join
+    if scandir is not None:
+        for entry in scandir(dirname):
+            try:
+                if entry.is_dir():
+                    yield entry.path, None, entry.is_symlink()
+                else:
+                    yield entry.path, entry.stat(), entry.is_symlink()
+            except OSError:
+                pass
+    else:
+        for name in os.listdir(dirname):
+            path = join(dirname, name)
+            try:
+                st = os.lstat(path)
+                is_symlink = stat.S_ISLNK(st.st_mode)
+                if is_symlink:
+                    st = os.stat(path)
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                st = None
+            yield path, st, is_symlink
+
+def discover_stat(d, cache=None):
+    """
+    Like discover(), but yields (path, stat_result) tuples for every regular
+    file below the directories in `d' from a single walk. Directories are
+    identified by device and inode number to break symlink cycles so paths
+    are only resolved for symlinked directories.
+
+    `cache' may be a dict mapping directories to the (mtime, nlink,
+    subdirectories, filenames) tuples of their last listing. Directories
+    whose mtime and link count match their entry are not listed again, only
+    the files in them are stat'ed. The dict is updated in place.
+    """
+
+    if not hasattr(d, "__iter__"):
+        d = [d]
+    if cache is None:
+        cache = {}
+
+    realpath = os.path.realpath
+    join = os.path.join
+    S_ISREG = stat.S_ISREG
+    # Changes made within the same mtime tick as our listing would go
+    # unnoticed so we don't cache directories which were modified recently.
+    racy_after = time.time() - 2
+    checked_directories = set()
+    visited = set()
+    roots = map(realpath, d)
+    directories = list(roots)
+    while directories:
+        dirname = directories.pop()
+        try:
+            st = os.stat(dirname)
+            key = (st.st_dev, st.st_ino)
+            if key in checked_directories:
+                continue
+            checked_directories.add(key)
+            visited.add(dirname)
+
+            entry = cache.get(dirname)
+            if entry is not None and entry[:2] == (st.st_mtime, st.st_nlink):
+                subdirectories, filenames = entry[2:]
+                files = []
+                for filename in filenames:
+                    path = join(dirname, filename)
+                    try:
+                        files.append((path, os.stat(path)))
+                    except OSError:
+                        pass
+            else:
+                subdirectories = []
+                files = []
+                for path, st_, is_symlink in _list_directory(dirname):
+                    if st_ is None:
+                        subdirectories.append(
+                            realpath(path) if is_symlink else path)
+                    elif S_ISREG(st_.st_mode):
+                        files.append((path, st_))
+                if st.st_mtime < racy_after:
+                    cache[dirname] = (
+                        st.st_mtime, st.st_nlink, tuple(subdirectories),
+                        tuple(os.path.basename(path) for path, st_ in files))
+                else:
+                    cache.pop(dirname, None)
+        except OSError:
+            continue
+        directories.extend(subdirectories)
+        for path, st in files:
+            yield path, st
+
+    # Drop the entries of directories below `d' which no longer exist.
+    prefixes = tuple(root.rstrip("/") + "/" for root in roots)
+    for dirname in cache.keys():
+        if dirname not in visited and (dirname in roots or
+                                       dirname.startswith(prefixes)):
+            del cache[dirname]
+
 def serialize_to_file(data, path):
     # Write data to tempfile first.
     fd, tmp_path = tempfile.mkstemp()
@@ -398,6 +509,172 @@ def __eq__(self, other):
     def __del__(self):
         self.clear()
 
+class BlaPathIndex(object):
+    """
+    Sorted index of file paths. All paths below a directory form a contiguous
+    range in the index so retrieving or removing them only takes a binary
+    search plus time proportional to the number of affected paths. Added
+    paths are buffered and merged into the index in one go on the next
+    lookup so adding many paths, e.g. while scanning, doesn't take quadratic
+    time.
+    """
+
+    def __init__(self, paths=()):
+        self.__paths = sorted(set(paths))
+        self.__added = set()
+
+    def __merge(self):
+        if self.__added:
+            paths = self.__paths
+            paths.extend(self.__added)
+            paths.sort()
+            self.__added = set()
+        return self.__paths
+
+    def __len__(self):
+        return len(self.__merge())
+
+    def __iter__(self):
+        return iter(self.__merge())
+
+    def __contains__(self, path):
+        if path in self.__added:
+            return True
+        paths = self.__paths
+        idx = bisect.bisect_left(paths, path)
+        return idx < len(paths) and paths[idx] == path
+
+    def add(self, path):
+        if path not in self:
+            self.__added.add(path)
+
+    def discard(self, path):
+        if path in self.__added:
+            self.__added.discard(path)
+            return
+        paths = self.__paths
+        idx = bisect.bisect_left(paths, path)
+        if idx < len(paths) and paths[idx] == path:
+            del paths[idx]
+
+    def __get_range(self, directory):
+        # "0" is the character following "/" so every path starting with
+        # `directory' + "/" sorts before `directory' + "0".
+        directory = directory.rstrip("/")
+        paths = self.__merge()
+        return (bisect.bisect_left(paths, directory + "/"),
+                bisect.bisect_left(paths, directory + "0"))
+
+    def get_paths_below(self, directory):
+        start, stop = self.__get_range(directory)
+        return self.__paths[start:stop]
+
+    def get_paths_starting_with(self, prefix):
+        # The upper bound is the prefix with its last character incremented.
+        char = unichr if isinstance(prefix, unicode) else chr
+        upper = prefix[:-1] + char(ord(prefix[-1]) + 1)
+        paths = self.__merge()
+        return paths[bisect.bisect_left(paths, prefix):
+                     bisect.bisect_left(paths, upper)]
+
+class BlaTokenIndex(object):
+    """
+    Inverted index from the words of strings to the keys the strings were
+    added under. Words are case-folded runs of alphanumeric characters.
+    Searching for a term yields the keys of all strings which have, for
+    every word in the term, a word containing it. This is a superset of the
+    keys whose strings contain the term itself so callers still have to
+    check the candidates, but only them.
+    """
+
+    __tokenize = re.compile(r"\w+", re.UNICODE).findall
+    # Maximum number of search results kept around for narrowing down later
+    # searches.
+    __CACHE_SIZE = 64
+
+    def __init__(self):
+        self.__postings = {}
+        self.__words = {}
+        self.__cache = {}
+
+    def __len__(self):
+        return len(self.__words)
+
+    def __contains__(self, key):
+        return key in self.__words
+
+    @classmethod
+    def tokenize(cls, string):
+        if isinstance(string, str):
+            string = string.decode("utf-8", "replace")
+        return cls.__tokenize(string.lower())
+
+    def add(self, key, strings):
+        # Replaces the strings indexed for `key'.
+        self.discard(key)
+        words = set()
+        tokenize = self.tokenize
+        for string in strings:
+            words.update(tokenize(string))
+        postings = self.__postings
+        for word in words:
+            try:
+                postings[word].add(key)
+            except KeyError:
+                postings[word] = set([key])
+                self.__cache.clear()
+        self.__words[key] = tuple(words)
+
+    def discard(self, key):
+        postings = self.__postings
+        for word in self.__words.pop(key, ()):
+            keys = postings[word]
+            keys.discard(key)
+            if not keys:
+                del postings[word]
+                self.__cache.clear()
+
+    def __find(self, piece):
+        # Returns the words containing `piece'. Words containing `piece' also
+        # contain all of its substrings so the results of earlier searches,
+        # e.g. for the previous keystroke, narrow down the scan.
+        cache = self.__cache
+        try:
+            return cache[piece]
+        except KeyError:
+            pass
+        words = None
+        for other, found in cache.items():
+            if other in piece and (words is None or len(found) < len(words)):
+                words = found
+        if words is None:
+            words = list(self.__postings)
+        found = [word for word in words if piece in word]
+        if len(cache) >= self.__CACHE_SIZE:
+            cache.clear()
+        cache[piece] = found
+        return found
+
+    def search(self, term):
+        # Returns the set of candidate keys for `term', or None if `term'
+        # doesn't contain any word characters the index could look up.
+        pieces = self.tokenize(term)
+        if not pieces:
+            return None
+        postings = self.__postings
+        result = None
+        for piece in set(pieces):
+            keys = set()
+            for word in self.__find(piece):
+                keys.update(postings.get(word, ()))
+            if result is None:
+                result = keys
+            else:
+                result &= keys
+            if not result:
+                break
+        return result
+
 class BlaNotifyDict(dict):
     __slots__ = ("__callbacks")
 
@@ -30,7 +30,8 @@
 
 import blaplay
 from blaplay import blaconst
-from blaplay import blautil
+from blaplay import blautil, formats
+from blaplay.blacore import blacovers
 from blaplay.blautil import blafm
 from blaplay.formats._identifiers import *
 
@@ -127,6 +128,8 @@ def __init__(self):
         super(BlaFetcher, self).__init__()
         self.__json_parser = BlaFetcher.JSONParser()
         self.__html_parser = BlaFetcher.HTMLParser()
+        # Results of cover searches per directory
+        self.__covers = {}
 
     def __download_feed(self, baseurl, separator, erase, replace, safe, artist,
                         title):
@@ -269,6 +272,28 @@ def emit(lyrics):
 
         emit(lyrics)
 
+    def __find_cover(self, track):
+        # Tracks from libraries created before covers were extracted during
+        # parsing have no COVER_ART. Their embedded art or the image in their
+        # directory is looked up once and remembered in the library. Tracks
+        # without a cover are marked as such so they aren't searched again.
+        uri = track.uri
+        name = blacovers.find_cover(formats.split_uri(uri)[0], self.__covers)
+
+        def update():
+            library = blaplay.bla.library
+            try:
+                track = library[uri].materialize()
+            except KeyError:
+                return False
+            track[COVER_ART] = name or blacovers.NO_COVER
+            library[uri] = track
+            return False
+        gobject.idle_add(update)
+        if name is None:
+            return None
+        return os.path.join(blaconst.COVER_IMAGES, name)
+
     @blautil.thread
     def __fetch_cover(self, track, timestamp, force_download):
         def emit(cover):
@@ -277,45 +302,22 @@ def emit(cover):
             return False
 
         gobject.source_remove(self.__tid)
-        cover = None
+
+        # Embedded covers and images next to the files are picked up when the
+        # files are parsed so we only need to look at the cover cache here.
+        if not force_download:
+            cover = track.get_cover_path()
+            if cover is None and not track[COVER_ART]:
+                cover = self.__find_cover(track)
+            if cover is not None:
+                return emit(cover)
 
         image_base = track.get_cover_basepath()
         if image_base is None:
             return
 
-        if not force_download:
-            if os.path.isfile("%s.jpg" % image_base):
-                cover = "%s.jpg" % image_base
-            elif os.path.isfile("%s.png" % image_base):
-                cover = "%s.png" % image_base
-
-        if cover is not None:
-            return emit(cover)
-
         self.__tid = gobject.timeout_add(2000, emit, blaconst.COVER)
         cover = blafm.get_cover(track, image_base)
-        # Don't try to get a cover from disk if we were specifically asked to
-        # download it.
-        if cover is None and not force_download:
-            base = os.path.dirname(track.uri)
-            images = [f for f in os.listdir(base)
-                      if blautil.get_extension(f).lower() in ["jpg", "png"]]
-            r = re.compile(
-                r"front|cover|^folder|^albumart.*large", re.UNICODE)
-            for image in images:
-                name = image.lower()
-                if r.search(name):
-                    path = os.path.join(base, image)
-                    name = os.path.basename(image_base)
-                    images = [f for f in os.listdir(blaconst.COVERS)
-                              if f.startswith(name)]
-                    images = [os.path.join(blaconst.COVERS, f)
-                              for f in images]
-                    map(os.unlink, images)
-                    cover = "%s.%s" % (
-                        image_base, blautil.get_extension(path))
-                    shutil.copy(path, cover)
-                    break
         if cover is not None:
             emit(cover)
 
@@ -17,21 +17,103 @@
 import os
 
 from blaplay import blautil
+from _blasource import BlaSource
+import _blacue
+from _blacue import SEPARATOR
 
+# Maps extensions to the preferred format class for them.
 formats = {}
 
+# Maps extensions to all format classes which claim them in order of
+# preference.
+_handlers = {}
+
+# List of (offset, magic bytes, format class) tuples for content sniffing.
+_magic = []
+
 
 class TagParseError(Exception):
     pass
 
 
-def get_track(path):
-    ext = blautil.get_extension(path).lower()
+def _get_extension(path):
+    return os.path.splitext(path)[1][1:].lower()
+
+def is_supported(path):
+    # Cheap check for the library to filter paths by before parsing them.
+    ext = _get_extension(path)
+    return ext in formats or ext in _blacue.extensions
+
+def split_uri(uri):
+    # Returns the path of the backing file and the track number for URIs of
+    # virtual tracks, i.e. tracks of a CUE sheet, and (uri, None) otherwise.
+    path, sep, number = uri.rpartition(SEPARATOR)
+    if sep and number.isdigit() and _get_extension(path) in formats:
+        return path, int(number)
+    return uri, None
+
+def _resolve(ext, head):
+    # Picks the format class for a file from the magic bytes at the start of
+    # the file. The most specific match wins. Ties, e.g. between the MP4 and
+    # the video parser, are broken by the extension. Files whose content we
+    # don't recognize are left to the extension's handler.
+    candidates = _handlers[ext]
+    matches = []
+    longest = 0
+    for offset, magic, format_ in _magic:
+        if len(magic) >= longest and head.startswith(magic, offset):
+            if len(magic) > longest:
+                longest = len(magic)
+                matches = []
+            matches.append(format_)
+    for format_ in candidates:
+        if format_ in matches:
+            return format_
+    return matches[0] if matches else candidates[0]
+
+def _parse(source, ext):
     try:
-        track = formats[ext](path)
-    except (KeyError, TagParseError):
-        track = None
-    return track
+        return _resolve(ext, source.head)(source)
+    except TagParseError:
+        return None
+
+def get_track(path):
+    ext = _get_extension(path)
+    if ext not in _handlers:
+        return None
+    with BlaSource(path) as source:
+        return _parse(source, ext)
+
+def get_tracks(path):
+    """
+    Returns the list of tracks found in the file at `path'. For CUE sheets and
+    files with an embedded sheet these are the virtual tracks of the sheet.
+    Files which can't be parsed yield an empty list.
+    """
+
+    ext = _get_extension(path)
+    if ext in _blacue.extensions:
+        return _blacue.get_sheet_tracks(path)
+    if ext not in _handlers:
+        return []
+    with BlaSource(path) as source:
+        track = _parse(source, ext)
+        if track is None:
+            return []
+        return _blacue.get_embedded_tracks(track, source) or [track]
+
+def get_picture(path):
+    """
+    Returns a tuple (mime type, data) of the front cover embedded in the file
+    at `path' or None.
+    """
+
+    path = split_uri(path)[0]
+    ext = _get_extension(path)
+    if ext not in _handlers:
+        return None
+    with BlaSource(path) as source:
+        return _resolve(ext, source.head)._read_picture(source)
 
 def _is_py_file(s):
     # TODO: move this to blautil since we also use it for visualizations
@@ -44,6 +126,8 @@ def _check_module_integrity(module, name):
         # TODO: use the iter() built-in to check iterability
         if not hasattr(extensions, "__iter__"):
             raise AttributeError
+        if not hasattr(getattr(format_, "magic", []), "__iter__"):
+            raise AttributeError
         # TODO: check if these are callable
         for attr in ["_read_tags", "_save"]:
             if not hasattr(format_, attr):
@@ -62,6 +146,7 @@ def _check_module_integrity(module, name):
 #        overly specific when it comes to extensions just filter out every file
 #        which starts with an underscore, put all passed names into a set() and
 #        iterate over this instead
+_formats = []
 for module in filter(_is_py_file, os.listdir(os.path.dirname(__file__))):
     basename = blautil.toss_extension(module)
     name = basename.capitalize()
@@ -75,11 +160,21 @@ def _check_module_integrity(module, name):
     else:
         format_ = _check_module_integrity(module, name)
         if format_:
-            for ext in format_.extensions:
-                # FIXME: with the addition of video support we overwrite
-                #        certain extension handlers here, e.g. mp4
-                formats[ext] = format_
+            _formats.append(format_)
+
+# Dedicated parsers take precedence over generic container parsers (i.e. the
+# video parser) for the extensions they share. Sort the rest by name so the
+# order doesn't depend on the order of the directory listing.
+_formats.sort(key=lambda format_: (getattr(format_, "generic", False),
+                                   format_.__name__))
+for format_ in _formats:
+    for ext in format_.extensions:
+        _handlers.setdefault(ext, []).append(format_)
+        formats.setdefault(ext, format_)
+    for offset, magic in getattr(format_, "magic", []):
+        _magic.append((offset, magic, format_))
 
 del _is_py_file
 del _check_module_integrity
+del _formats
 
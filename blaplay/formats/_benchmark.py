@@ -0,0 +1,115 @@
+# blaplay, Copyright (C) 2014  Niklas Koep
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+"""
+Compares the throughput of the fast tag readers in formats._fastread with the
+mutagen-based readers, broken down by format. Tracks returned by both paths
+are compared as well so regressions in the fast path show up as mismatches.
+
+Usage: python2 -m blaplay.formats._benchmark [-r ROUNDS] PATH [PATH ...]
+"""
+
+import os
+import time
+import logging
+import argparse
+import __builtin__
+
+# The formats package expects the logging functions set up by blaplay.py.
+for name, func in [("print_d", logging.debug), ("print_i", logging.info),
+                   ("print_w", logging.warning)]:
+    if not hasattr(__builtin__, name):
+        setattr(__builtin__, name, func)
+
+from blaplay import blautil
+from blaplay import formats
+from blaplay.formats import _fastread
+from blaplay.formats._identifiers import MTIME
+
+
+def _collect(paths):
+    # Groups the files below `paths' by the name of their format class.
+    files = {}
+    for path in paths:
+        if os.path.isdir(path):
+            candidates = blautil.discover(path)
+        else:
+            candidates = [os.path.realpath(path)]
+        for path in candidates:
+            ext = blautil.get_extension(path).lower()
+            try:
+                format_ = formats.formats[ext]
+            except KeyError:
+                continue
+            files.setdefault(format_.__name__, []).append(path)
+    return files
+
+def _parse(paths, fast):
+    _fastread.enabled = fast
+    tracks = []
+    start = time.time()
+    for path in paths:
+        try:
+            tracks.append(formats.get_track(path))
+        except Exception:
+            tracks.append(None)
+    return time.time() - start, tracks
+
+def _normalize(track):
+    if track is None:
+        return None
+    track = dict(track)
+    track.pop(MTIME, None)
+    return track
+
+def run(paths, rounds):
+    files = _collect(paths)
+    if not files:
+        print "No supported files found"
+        return
+
+    print "%-8s %7s %12s %12s %8s %10s" % (
+        "Format", "Files", "mutagen/s", "fast/s", "Speedup", "Mismatches")
+    for name, paths in sorted(files.iteritems()):
+        # Prime the page cache so the first path we measure isn't penalized.
+        _parse(paths, False)
+        best_slow = best_fast = float("inf")
+        for _ in xrange(rounds):
+            duration, slow_tracks = _parse(paths, False)
+            best_slow = min(best_slow, duration)
+            duration, fast_tracks = _parse(paths, True)
+            best_fast = min(best_fast, duration)
+
+        mismatches = sum(1 for slow, fast in zip(slow_tracks, fast_tracks)
+                         if _normalize(slow) != _normalize(fast))
+        n = len(paths)
+        print "%-8s %7d %12.1f %12.1f %7.2fx %10d" % (
+            name, n, n / max(best_slow, 1e-9), n / max(best_fast, 1e-9),
+            best_slow / max(best_fast, 1e-9), mismatches)
+    _fastread.enabled = True
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the fast tag readers against mutagen")
+    parser.add_argument("paths", metavar="PATH", nargs="+",
+                        help="files or directories to parse")
+    parser.add_argument("-r", "--rounds", type=int, default=3,
+                        help="number of rounds to take the best time of")
+    args = parser.parse_args()
+    run(args.paths, max(args.rounds, 1))
+
+if __name__ == "__main__":
+    main()
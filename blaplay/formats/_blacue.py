@@ -0,0 +1,315 @@
+# blaplay, Copyright (C) 2014  Niklas Koep
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+"""
+CUE sheet support. Every track of a sheet is exposed as a virtual track which
+covers a section of the audio file backing it. The URI of a virtual track is
+the path of the backing file followed by SEPARATOR and the track number. The
+track's section is given by its OFFSET_START and OFFSET_END properties in
+seconds. A missing end offset means the track lasts until the end of the file.
+"""
+
+import os
+import re
+import codecs
+
+from _blatrack import BlaTrack
+import _fastread
+from _identifiers import *
+
+extensions = ["cue"]
+
+SEPARATOR = "#"
+
+# Sheets bigger than this are certainly not CUE sheets.
+MAX_SHEET_SIZE = 256 * 1024
+
+# INDEX times are given as mm:ss:ff where ff counts CD frames.
+_FRAMES_PER_SECOND = 75
+
+_TOKEN = re.compile(r'"([^"]*)"?|(\S+)')
+
+# Commands which may appear on the sheet level and on the track level.
+_TAG_COMMANDS = frozenset(["TITLE", "PERFORMER", "SONGWRITER", "ISRC"])
+_REM_COMMANDS = frozenset(["DATE", "GENRE", "DISCNUMBER", "TOTALDISCS",
+                           "COMMENT"])
+
+
+class CueSheetError(Exception):
+    pass
+
+
+class BlaCueSheet(object):
+    """
+    Parsed CUE sheet. `tags' maps the commands on the sheet level to their
+    values and `files' is a list of (filename, tracks) tuples. Each track is a
+    dict with the track's `number', its `start' offset in seconds and its own
+    `tags'. Non-audio tracks and tracks without an index are dropped.
+    """
+
+    def __init__(self, text):
+        self.tags = {}
+        self.files = []
+        track = None
+        for line in text.splitlines():
+            tokens = [quoted or word for quoted, word in _TOKEN.findall(line)]
+            if not tokens:
+                continue
+            command, args = tokens[0].upper(), tokens[1:]
+            target = self.tags if track is None else track["tags"]
+
+            if command == "FILE" and args:
+                self.files.append((args[0], []))
+                track = None
+            elif command == "TRACK" and args:
+                track = None
+                if not self.files:
+                    self.files.append((None, []))
+                if len(args) > 1 and args[1].upper() != "AUDIO":
+                    continue
+                try:
+                    number = int(args[0])
+                except ValueError:
+                    continue
+                track = {"number": number, "start": None, "tags": {}}
+                self.files[-1][1].append(track)
+            elif command == "INDEX" and track is not None and len(args) > 1:
+                try:
+                    number = int(args[0])
+                    start = _parse_time(args[1])
+                except ValueError:
+                    continue
+                # Index 1 marks the start of the track proper. Index 0 only
+                # marks the pregap.
+                if number == 1 or track["start"] is None:
+                    track["start"] = start
+            elif command in _TAG_COMMANDS and args:
+                target[command] = args[0]
+            elif command == "REM" and len(args) > 1:
+                key = args[0].upper()
+                if key in _REM_COMMANDS:
+                    target[key] = " ".join(args[1:])
+
+        for _, tracks in self.files:
+            tracks[:] = [track for track in tracks
+                         if track["start"] is not None]
+        self.files = [(filename, tracks) for filename, tracks in self.files
+                      if tracks]
+        if not self.files:
+            raise CueSheetError("No audio tracks")
+
+    @classmethod
+    def from_points(cls, points):
+        # Builds a sheet without tags from a list of (track number, start
+        # offset) tuples.
+        sheet = cls.__new__(cls)
+        sheet.tags = {}
+        sheet.files = [(None, [{"number": number, "start": start, "tags": {}}
+                               for number, start in points])]
+        return sheet
+
+    @property
+    def tracks(self):
+        return [track for _, tracks in self.files for track in tracks]
+
+
+class BlaCueTrack(BlaTrack):
+    """
+    Virtual track of a CUE sheet. The tags of these tracks are defined by the
+    sheet so they can't be written to the backing file.
+    """
+
+    __slots__ = ()
+
+    def _save(self):
+        return False
+
+    def save(self):
+        return False
+
+
+def _parse_time(value):
+    minutes, seconds, frames = map(int, value.split(":"))
+    return minutes * 60 + seconds + frames / float(_FRAMES_PER_SECOND)
+
+def _decode(data):
+    # Sheets written on Windows are often encoded in the system's codepage.
+    if data.startswith(codecs.BOM_UTF8):
+        data = data[len(codecs.BOM_UTF8):]
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return data.decode("cp1252", "replace")
+
+def make_uri(path, number):
+    return "%s%s%02d" % (path, SEPARATOR, number)
+
+def split(base, sheet, tracks):
+    """
+    Returns the virtual tracks for the sheet entries `tracks', all of which
+    refer to the file that the track `base' was parsed from. The audio
+    properties of `base' are shared by all of them.
+    """
+
+    path = base[URI]
+    length = base[LENGTH] or 0
+    filesize = base[FILESIZE] or 0
+    total = max(track["number"] for track in sheet.tracks)
+    sheet_tags = sheet.tags
+    virtual_tracks = []
+
+    for idx, entry in enumerate(tracks):
+        tags = entry["tags"]
+        start = entry["start"]
+        try:
+            end = tracks[idx+1]["start"]
+        except IndexError:
+            end = None
+
+        track = BlaCueTrack.__new__(BlaCueTrack)
+        dict.update(track, base)
+        # The track gain of the backing file applies to the whole sheet.
+        for key in [TITLE, TRACK, "cuesheet", REPLAYGAIN_TRACK_GAIN,
+                    REPLAYGAIN_TRACK_PEAK]:
+            dict.pop(track, key, None)
+
+        if "TITLE" in sheet_tags:
+            track[ALBUM] = sheet_tags["TITLE"]
+        artist = tags.get("PERFORMER") or sheet_tags.get("PERFORMER")
+        if artist:
+            track[ARTIST] = artist
+            if sheet_tags.get("PERFORMER", artist) != artist:
+                track[ALBUM_ARTIST] = sheet_tags["PERFORMER"]
+        composer = tags.get("SONGWRITER") or sheet_tags.get("SONGWRITER")
+        if composer:
+            track[COMPOSER] = composer
+        for key, identifier in [("DATE", DATE), ("GENRE", GENRE),
+                                ("COMMENT", "comment")]:
+            if key in sheet_tags:
+                track[identifier] = sheet_tags[key]
+        if "DISCNUMBER" in sheet_tags:
+            disc = sheet_tags["DISCNUMBER"]
+            if "TOTALDISCS" in sheet_tags:
+                disc += "/%s" % sheet_tags["TOTALDISCS"]
+            track[DISC] = disc
+        if "ISRC" in tags:
+            track["isrc"] = tags["ISRC"]
+        track[TITLE] = tags.get("TITLE") or u"Track %02d" % entry["number"]
+        track[TRACK] = u"%d/%d" % (entry["number"], total)
+
+        track[URI] = make_uri(path, entry["number"])
+        track[OFFSET_START] = start
+        if end is not None:
+            track[OFFSET_END] = end
+            duration = end - start
+        else:
+            duration = length - start
+        duration = max(duration, 0)
+        track[LENGTH] = int(duration)
+        # Attribute every track its share of the file so the sizes of all
+        # tracks of a sheet add up to the size of the backing file.
+        if length:
+            track[FILESIZE] = int(filesize * min(duration / length, 1.0))
+        virtual_tracks.append(track)
+
+    return virtual_tracks
+
+def get_embedded_tracks(track, source):
+    """
+    Returns the virtual tracks of a sheet embedded in the file `source' which
+    `track' was parsed from. This is either a CUESHEET Vorbis comment or the
+    CUESHEET metadata block of a FLAC file. Returns an empty list for files
+    without a sheet.
+    """
+
+    text = track.get("cuesheet")
+    if isinstance(text, list):
+        text = text[0] if text else None
+    sheet = None
+    if text:
+        try:
+            sheet = BlaCueSheet(text)
+        except CueSheetError:
+            pass
+    if sheet is None and source.head.startswith("fLaC"):
+        try:
+            points = _fastread.read_flac_cuesheet(source)
+        except _fastread.FastReadError:
+            points = None
+        if points:
+            sheet = BlaCueSheet.from_points(points)
+    if sheet is None:
+        return []
+    # The file names in an embedded sheet refer to the original rip. All its
+    # tracks belong to the file it's embedded in.
+    return split(track, sheet, sheet.tracks)
+
+def _find_file(directory, filename, is_supported):
+    # Sheets often still name the file they were ripped to, e.g. a WAV file
+    # which has since been encoded to FLAC, so fall back to a supported file
+    # with the same name but another extension.
+    filename = filename.replace("\\", "/")
+    path = os.path.join(directory, filename)
+    if os.path.isfile(path):
+        return path
+    path = os.path.join(directory, os.path.basename(filename))
+    if os.path.isfile(path):
+        return path
+    stem = os.path.splitext(os.path.basename(filename))[0].lower()
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return None
+    for name in sorted(names):
+        path = os.path.join(directory, name)
+        if (os.path.splitext(name)[0].lower() == stem and is_supported(path)
+            and os.path.splitext(name)[1][1:].lower() not in extensions):
+            return path
+    return None
+
+def get_sheet_tracks(path):
+    """
+    Returns the virtual tracks described by the CUE sheet at `path'. The
+    sheet is parsed once and every file it refers to is only parsed once as
+    well, no matter how many tracks it holds.
+    """
+
+    from blaplay.formats import get_track, is_supported
+
+    try:
+        with open(path, "rb") as f:
+            data = f.read(MAX_SHEET_SIZE + 1)
+    except IOError:
+        return []
+    if len(data) > MAX_SHEET_SIZE:
+        return []
+    try:
+        sheet = BlaCueSheet(_decode(data))
+    except CueSheetError:
+        return []
+
+    directory = os.path.dirname(path)
+    virtual_tracks = []
+    for filename, tracks in sheet.files:
+        if filename is None:
+            continue
+        backing = _find_file(directory, filename, is_supported)
+        if backing is None:
+            continue
+        base = get_track(backing)
+        if base is not None:
+            virtual_tracks.extend(split(base, sheet, tracks))
+    return virtual_tracks
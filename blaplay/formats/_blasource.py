@@ -0,0 +1,94 @@
+# blaplay, Copyright (C) 2014  Niklas Koep
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+import os
+
+# Sizes of the regions at the start and the end of a file which are read in
+# one go. Together they cover the tags and stream headers of most files.
+HEAD_SIZE = 64 * 1024
+TAIL_SIZE = 64 * 1024
+
+
+class BlaSource(object):
+    """
+    Shared read access to a file for the format parsers. The file is opened
+    once and stat'ed once. The head and tail regions are each fetched with a
+    single read the first time they're accessed and then served from memory,
+    both to the parser and to anything else inspecting the file on the way,
+    e.g. for format detection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.__f = open(path, "rb")
+        st = os.fstat(self.__f.fileno())
+        self.mtime = st.st_mtime
+        self.size = st.st_size
+        # Number of reads issued so far.
+        self.reads = 0
+        self.__head = self.__tail = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __read(self, offset, size):
+        self.reads += 1
+        self.__f.seek(offset)
+        return self.__f.read(size)
+
+    @property
+    def head(self):
+        if self.__head is None:
+            self.__head = self.__read(0, HEAD_SIZE)
+        return self.__head
+
+    @property
+    def tail(self):
+        # Small files are covered by the head already.
+        if self.__tail is None:
+            if self.size <= HEAD_SIZE:
+                self.__tail = self.head[-TAIL_SIZE:]
+            else:
+                self.__tail = self.__read(
+                    max(0, self.size - TAIL_SIZE), TAIL_SIZE)
+        return self.__tail
+
+    @property
+    def file(self):
+        # Gives parsers which insist on a file object direct access.
+        self.__f.seek(0)
+        return self.__f
+
+    def read(self, offset, size):
+        """
+        Returns `size' bytes starting at `offset', served from the head or
+        tail buffer if they contain the requested range.
+        """
+
+        end = min(offset + size, self.size)
+        if self.__head is not None and end <= len(self.__head):
+            return self.__head[offset:end]
+        if self.__tail is not None:
+            tail_offset = self.size - len(self.__tail)
+            if offset >= tail_offset:
+                return self.__tail[offset-tail_offset:end-tail_offset]
+        return self.__read(offset, size)
+
+    def close(self):
+        self.__f.close()
@@ -0,0 +1,330 @@
+# blaplay, Copyright (C) 2014  Niklas Koep
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+from array import array
+
+from _blatrack import BlaTrack, BlaTrackMixin
+from _identifiers import *
+
+# Properties stored in numeric arrays. Missing values are marked with -1 which
+# none of these properties can legitimately assume. ReplayGain gains can so
+# they're kept in plain columns.
+_NUMERIC = {
+    MTIME: "d",
+    FILESIZE: "l",
+    LENGTH: "l",
+    SAMPLING_RATE: "l",
+    CHANNELS: "l",
+    BITRATE: "l",
+    OFFSET_START: "d",
+    OFFSET_END: "d"
+}
+_MISSING = -1
+
+# Interned strings of removed rows are dropped after this many removals.
+_PRUNE_INTERVAL = 1024
+
+# String columns whose values are likely to be shared between tracks. Values
+# of these columns are interned, i.e. every distinct string is kept only once.
+_INTERNED = frozenset([
+    ARTIST, ALBUM, DATE, GENRE, COMPOSER, PERFORMER, ALBUM_ARTIST, TRACK, DISC,
+    MONITORED_DIRECTORY, CHANNEL_MODE, FORMAT, ENCODING, COVER_ART
+])
+
+
+class BlaTrackTable(object):
+    """
+    Columnar storage for tracks. The identifiers from formats._identifiers
+    are stored in one column each, either as an array of numbers or as a list
+    of (interned) strings. Tags parsed as lists of values only keep their
+    first value in the column and set a bit in the row's list mask. The full
+    list of multi-valued tags as well as tags without a numerical identifier
+    live in a side table. Rows are never reused within a session so row ids
+    remain valid references to a track. Removing a row frees its values but
+    its empty slot is only reclaimed on the next startup.
+    """
+
+    def __init__(self):
+        self.__columns = []
+        for identifier in xrange(N_IDENTIFIERS):
+            try:
+                column = array(_NUMERIC[identifier])
+            except KeyError:
+                column = []
+            self.__columns.append(column)
+        self.__classes = []
+        self.__lists = array("l")
+        self.__extras = {}
+        self.__strings = {}
+        # Maps names of sort orders to dicts of cached sort keys by row.
+        self.__sort_keys = {}
+        self.__n_rows = 0
+        self.__n_removed = 0
+
+    def __len__(self):
+        return self.__n_rows - self.__n_removed
+
+    def __set(self, row, key, value):
+        try:
+            column = self.__columns[key]
+        except (IndexError, TypeError):
+            self.__extras.setdefault(row, {})[key] = value
+            return
+
+        if isinstance(value, list):
+            self.__lists[row] |= 1 << key
+            if len(value) != 1:
+                self.__extras.setdefault(row, {})[key] = value
+            value = value[0] if value else ""
+        else:
+            self.__lists[row] &= ~(1 << key)
+            if row in self.__extras:
+                self.__extras[row].pop(key, None)
+
+        if key in _NUMERIC:
+            if value == "" or value is None:
+                value = _MISSING
+            try:
+                column[row] = value
+            except (TypeError, OverflowError):
+                column[row] = _MISSING
+                self.__extras.setdefault(row, {})[key] = value
+        elif key in _INTERNED:
+            column[row] = self.__strings.setdefault(value, value)
+        else:
+            column[row] = value
+
+    def __invalidate(self, row):
+        for keys in self.__sort_keys.itervalues():
+            keys.pop(row, None)
+
+    def __fill(self, row, track):
+        for key, value in dict.iteritems(track):
+            self.__set(row, key, value)
+
+    def add(self, track):
+        """
+        Appends the contents of the BlaTrack instance `track' to the table and
+        returns the id of the new row.
+        """
+
+        row = self.__n_rows
+        for identifier, column in enumerate(self.__columns):
+            column.append(_MISSING if identifier in _NUMERIC else "")
+        self.__classes.append(type(track))
+        self.__lists.append(0)
+        self.__n_rows += 1
+        self.__fill(row, track)
+        return row
+
+    def update(self, row, track):
+        """
+        Replaces the contents of row `row' with those of `track'.
+        """
+
+        self.__invalidate(row)
+        for identifier, column in enumerate(self.__columns):
+            column[row] = _MISSING if identifier in _NUMERIC else ""
+        self.__extras.pop(row, None)
+        self.__classes[row] = type(track)
+        self.__lists[row] = 0
+        self.__fill(row, track)
+
+    def remove(self, row):
+        if self.__classes[row] is None:
+            return
+        self.__invalidate(row)
+        for identifier, column in enumerate(self.__columns):
+            column[row] = _MISSING if identifier in _NUMERIC else ""
+        self.__extras.pop(row, None)
+        self.__classes[row] = None
+        self.__lists[row] = 0
+        self.__n_removed += 1
+        if self.__n_removed % _PRUNE_INTERVAL == 0:
+            self.__prune_strings()
+
+    def __prune_strings(self):
+        strings = {}
+        for identifier in _INTERNED:
+            for value in self.__columns[identifier]:
+                strings[value] = value
+        self.__strings = strings
+
+    def set_value(self, row, key, value):
+        self.__invalidate(row)
+        self.__set(row, key, value)
+
+    def get_value(self, row, key, default=""):
+        # Returns the full value of a tag, i.e. the list of values for
+        # multi-valued tags.
+        try:
+            return self.__extras[row][key]
+        except KeyError:
+            pass
+        try:
+            value = self.__columns[key][row]
+        except (IndexError, TypeError):
+            return default
+        if value == _MISSING and key in _NUMERIC:
+            return default
+        if self.__lists[row] & (1 << key):
+            return [value]
+        return value
+
+    def get_first_value(self, row, key):
+        # Equivalent of BlaTrack.__getitem__.
+        try:
+            value = self.__columns[key][row]
+        except (IndexError, TypeError):
+            try:
+                value = self.__extras[row][key]
+            except KeyError:
+                return ""
+            if isinstance(value, list) and value:
+                return value[0]
+            return value
+        if key in _NUMERIC and value == _MISSING:
+            try:
+                return self.__extras[row][key]
+            except KeyError:
+                return ""
+        return value
+
+    def get_keys(self, row):
+        lists = self.__lists[row]
+        keys = [identifier for identifier, column in enumerate(self.__columns)
+                if column[row] not in ("", _MISSING) or
+                lists & (1 << identifier)]
+        try:
+            keys.extend(key for key in self.__extras[row] if key not in keys)
+        except KeyError:
+            pass
+        return keys
+
+    def get_column(self, identifier):
+        # Gives direct access to a column, e.g. for aggregating values over
+        # many rows without creating row views.
+        return self.__columns[identifier]
+
+    def get_values(self, rows, key):
+        # Returns the first values of `key' for every row in `rows', reading
+        # string columns directly.
+        if key in _NUMERIC:
+            get_first_value = self.get_first_value
+            return [get_first_value(row, key) for row in rows]
+        column = self.__columns[key]
+        return [column[row] for row in rows]
+
+    def get_sort_keys(self, rows, name, func):
+        """
+        Returns the keys of the sort order `name' for every row in `rows'.
+        Missing keys are computed by calling `func' with a row view and kept
+        until their row changes.
+        """
+
+        keys = self.__sort_keys.setdefault(name, {})
+        result = []
+        append = result.append
+        for row in rows:
+            try:
+                key = keys[row]
+            except KeyError:
+                key = keys[row] = func(BlaTrackRow(self, row))
+            append(key)
+        return result
+
+    def is_valid(self, row):
+        try:
+            return row >= 0 and self.__classes[row] is not None
+        except IndexError:
+            return False
+
+    def row(self, row):
+        return BlaTrackRow(self, row)
+
+    def materialize(self, row):
+        """
+        Creates a full BlaTrack instance of the track's format class from row
+        `row' without parsing the file again, e.g. for editing or pickling.
+        """
+
+        cls = self.__classes[row]
+        track = cls.__new__(cls)
+        for key in self.get_keys(row):
+            dict.__setitem__(track, key, self.get_value(row, key))
+        return track
+
+class BlaTrackRow(BlaTrackMixin):
+    """
+    Thin view of a row in a BlaTrackTable which mimics the read interface of
+    BlaTrack.
+    """
+
+    __slots__ = ("table", "row")
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    def __getitem__(self, key):
+        return self.table.get_first_value(self.row, key)
+
+    def __setitem__(self, key, value):
+        self.table.set_value(self.row, key, value)
+
+    def __contains__(self, key):
+        return key in self.table.get_keys(self.row)
+
+    def __eq__(self, other):
+        return (isinstance(other, BlaTrackRow) and
+                self.table is other.table and self.row == other.row)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((id(self.table), self.row))
+
+    def __nonzero__(self):
+        return self.table.is_valid(self.row)
+
+    def __deepcopy__(self, memo):
+        return self.table.materialize(self.row)
+
+    def __reduce__(self):
+        track = self.table.materialize(self.row)
+        return (_restore, (type(track), track.items()))
+
+    def has_key(self, key):
+        return key in self
+
+    def get(self, key, default=None):
+        return self.table.get_value(self.row, key, default)
+
+    def keys(self):
+        return self.table.get_keys(self.row)
+
+    def items(self):
+        get_value = self.table.get_value
+        return [(key, get_value(self.row, key)) for key in self.keys()]
+
+    def materialize(self):
+        return self.table.materialize(self.row)
+
+def _restore(cls, state):
+    track = cls.__new__(cls)
+    track.__setstate__(state)
+    return track
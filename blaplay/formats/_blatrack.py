@@ -16,20 +16,140 @@
 
 import os
 
+import mutagen
+
 from blaplay.blacore import blacfg, blaconst
 from blaplay import blautil
 from _identifiers import *
 
+# Padding strategies for mutagen's save methods were added in mutagen 1.31.
+_HAS_PADDING = mutagen.version >= (1, 31)
 
-class BlaTrack(dict):
-    __slots__ = ("_deleted_tags")
+# ReplayGain values are stored in freeform tags. Formats prefix their names
+# differently and taggers don't agree on their case so names are compared in
+# lowercase with any prefix stripped.
+_REPLAYGAIN_TAGS = {
+    "replaygain_track_gain": REPLAYGAIN_TRACK_GAIN,
+    "replaygain_track_peak": REPLAYGAIN_TRACK_PEAK,
+    "replaygain_album_gain": REPLAYGAIN_ALBUM_GAIN,
+    "replaygain_album_peak": REPLAYGAIN_ALBUM_PEAK
+}
+_REPLAYGAIN_NAMES = dict(
+    zip(_REPLAYGAIN_TAGS.values(), _REPLAYGAIN_TAGS.keys()))
+
+
+def _get_replaygain_identifier(key):
+    return _REPLAYGAIN_TAGS.get(key.rsplit(":", 1)[-1].lower())
+
+
+class BlaTrackMixin(object):
+    """
+    Accessors shared by BlaTrack and the row views of BlaTrackTable. Classes
+    using this mixin need to implement `__getitem__' and `keys'.
+    """
+
+    __slots__ = ()
+
+    def keys_tags(self):
+        # This returns every key that corresponds to a tag as opposed to an
+        # attribute like filesize, etc.
+        return list(set(self.keys()).difference(IDENTIFIER_PROPERTIES))
+
+    def keys_additional_tags(self):
+        # This returns every key that corresponds to a tag that does not have
+        # a numerical identifier as defined in formats._identifiers.
+        return list(set(self.keys()).difference(xrange(N_IDENTIFIERS)))
+
+    # TODO: cache properties which don't change over time
+
+    def get_cover_basepath(self):
+        if "" in (self[ARTIST], self[ALBUM]):
+            return None
+        base = "%s-%s" % (
+            self[ARTIST].replace(" ", "_"), self[ALBUM].replace(" ", "_"))
+        base = base.replace("/", "_")
+        return os.path.join(blaconst.COVERS, base)
+
+    def get_cover_path(self):
+        # Covers set by the user or downloaded from last.fm take precedence
+        # over art which was extracted from the file or its directory when the
+        # track was parsed.
+        basepath = self.get_cover_basepath()
+        if basepath is not None:
+            for ext in ["jpg", "png"]:
+                cover = "%s.%s" % (basepath, ext)
+                if os.path.isfile(cover):
+                    return cover
+        name = self[COVER_ART]
+        if name:
+            cover = os.path.join(blaconst.COVER_IMAGES, name)
+            if os.path.isfile(cover):
+                return cover
+        return None
+
+    def get_lyrics_key(self):
+        if "" in (self[ARTIST], self[TITLE]):
+            return ""
+        lyrics_key = "%s-%s" % (
+            self[ARTIST].replace(" ", "_").replace("/", "_"),
+            self[TITLE].replace(" ", "_").replace("/", "_"))
+        return lyrics_key
+
+    def get_filesize(self, short=False):
+        filesize = "%.2f MB" % float(self[FILESIZE] / (1024. ** 2))
+        if not short:
+            filesize += " (%d bytes)" % self[FILESIZE]
+        return filesize
+
+    @property
+    def duration(self):
+        m, s = divmod(self[LENGTH], 60)
+        h, x = divmod(m, 60)
+        return "%d:%02d:%02d" % (h, m, s) if h else "%d:%02d" % (m, s)
+
+    @property
+    def uri(self):
+        return self[URI]
+
+    @property
+    def basename(self):
+        return os.path.basename(blautil.toss_extension(self.uri))
+
+    @property
+    def bitrate(self):
+        return "%d kbps" % (self[BITRATE] / 1000) if self[BITRATE] else ""
+
+    @property
+    def sampling_rate(self):
+        return "%d Hz" % self[SAMPLING_RATE] if self[SAMPLING_RATE] else ""
 
-    def __init__(self, path):
-        self[MTIME] = os.path.getmtime(path)
-        self[FILESIZE] = os.path.getsize(path)
-        self[URI] = path
+class BlaTrack(dict, BlaTrackMixin):
+    __slots__ = ("_deleted_tags")
 
-        self._read_tags()
+    # Prefix of the names of the freeform tags written by set_replaygain().
+    _replaygain_prefix = ""
+
+    def __init__(self, source):
+        # `source' is a BlaSource instance which is shared between all parsers
+        # looking at the file.
+        self[MTIME] = source.mtime
+        self[FILESIZE] = source.size
+        self[URI] = source.path
+
+        self._read_tags(source)
+        self.__parse_replaygain()
+
+    def __parse_replaygain(self):
+        # Values are written as e.g. "-6.48 dB" for gains and "0.988831" for
+        # peaks.
+        for key in self.keys_additional_tags():
+            identifier = _get_replaygain_identifier(key)
+            if identifier is None:
+                continue
+            try:
+                self[identifier] = float(self[key].split()[0])
+            except (AttributeError, IndexError, ValueError):
+                pass
 
     def __getstate__(self):
         return self.items()
@@ -70,12 +190,63 @@ def __getitem__(self, key):
         except IndexError:
             return item
 
-    def _read_tags(self):
+    def _read_tags(self, source):
         pass
 
+    @staticmethod
+    def _read_picture(source):
+        # Returns a tuple (mime type, data) of the front cover embedded in the
+        # file or None.
+        return None
+
+    @staticmethod
+    def _pick_picture(pictures):
+        # Picks the front cover from a list of (picture type, mime type, data)
+        # tuples, falling back to the first picture.
+        for type_, mime, data in pictures:
+            if type_ == 3:
+                return mime, data
+        return pictures[0][1:] if pictures else None
+
     def _save(self):
         return True
 
+    def set_replaygain(self, values):
+        """
+        Sets the ReplayGain properties from the dict `values' which maps
+        REPLAYGAIN_* identifiers to gains in dB and peaks, respectively. The
+        corresponding tags are replaced so they're written on the next save.
+        """
+
+        for key in self.keys_additional_tags():
+            if _get_replaygain_identifier(key) in values:
+                del self[key]
+        for identifier, value in values.iteritems():
+            self[identifier] = value
+            if identifier in (REPLAYGAIN_TRACK_GAIN, REPLAYGAIN_ALBUM_GAIN):
+                text = u"%.2f dB" % value
+            else:
+                text = u"%.6f" % value
+            name = self._replaygain_prefix + _REPLAYGAIN_NAMES[identifier]
+            self[name] = [text]
+
+    @staticmethod
+    def _padding(info):
+        # Reuses the padding after the tag block whenever the new tags fit so
+        # the file is updated in place. Otherwise the audio data needs to be
+        # moved anyway so reserve enough padding for the next edits to fit.
+        if info.padding >= 0:
+            return info.padding
+        return 10 * 1024 + info.size // 100
+
+    def _save_file(self, obj, *args):
+        # Saves the mutagen file or tag object `obj' using our padding
+        # strategy where supported.
+        if _HAS_PADDING:
+            obj.save(*args, padding=self._padding)
+        else:
+            obj.save(*args)
+
     def _parse_info(self, info):
         self[SAMPLING_RATE] = info.sample_rate
 
@@ -121,68 +292,3 @@ def save(self):
         self[MTIME] = os.path.getmtime(self[URI])
         return status
 
-    def keys_tags(self):
-        # This returns every key that corresponds to a tag as opposed to an
-        # attribute like filesize, etc.
-        return list(set(self.keys()).difference(IDENTIFIER_PROPERTIES))
-
-    def keys_additional_tags(self):
-        # This returns every key that corresponds to a tag that does not have
-        # a numerical identifier as defined in formats._identifiers.
-        return list(set(self.keys()).difference(xrange(N_IDENTIFIERS)))
-
-    # TODO: cache properties which don't change over time
-
-    def get_cover_basepath(self):
-        if "" in (self[ARTIST], self[ALBUM]):
-            return None
-        base = "%s-%s" % (
-            self[ARTIST].replace(" ", "_"), self[ALBUM].replace(" ", "_"))
-        base = base.replace("/", "_")
-        return os.path.join(blaconst.COVERS, base)
-
-    def get_cover_path(self):
-        basepath = self.get_cover_basepath()
-        if basepath is not None:
-            for ext in ["jpg", "png"]:
-                cover = "%s.%s" % (basepath, ext)
-                if os.path.isfile(cover):
-                    return cover
-        return None
-
-    def get_lyrics_key(self):
-        if "" in (self[ARTIST], self[TITLE]):
-            return ""
-        lyrics_key = "%s-%s" % (
-            self[ARTIST].replace(" ", "_").replace("/", "_"),
-            self[TITLE].replace(" ", "_").replace("/", "_"))
-        return lyrics_key
-
-    def get_filesize(self, short=False):
-        filesize = "%.2f MB" % float(self[FILESIZE] / (1024. ** 2))
-        if not short:
-            filesize += " (%d bytes)" % self[FILESIZE]
-        return filesize
-
-    @property
-    def duration(self):
-        m, s = divmod(self[LENGTH], 60)
-        h, x = divmod(m, 60)
-        return "%d:%02d:%02d" % (h, m, s) if h else "%d:%02d" % (m, s)
-
-    @property
-    def uri(self):
-        return self[URI]
-
-    @property
-    def basename(self):
-        return os.path.basename(blautil.toss_extension(self.uri))
-
-    @property
-    def bitrate(self):
-        return "%d kbps" % (self[BITRATE] / 1000) if self[BITRATE] else ""
-
-    @property
-    def sampling_rate(self):
-        return "%d Hz" % self[SAMPLING_RATE] if self[SAMPLING_RATE] else ""
-
@@ -0,0 +1,753 @@
+# blaplay, Copyright (C) 2014  Niklas Koep
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+"""
+Header-only tag readers for the most common formats. Instead of building
+full mutagen objects these only look at the ID3v2 frames, the Vorbis comment
+block, or the MP4 `moov' atom, respectively, and estimate the duration from
+the Xing/VBRI, STREAMINFO, or `mdhd' headers. Every reader issues a bounded
+number of reads per file and raises FastReadError on anything out of the
+ordinary so the format classes can fall back to mutagen. All readers take a
+BlaSource instance and start out from its head and tail buffers.
+"""
+
+import struct
+import functools
+
+from _blasource import HEAD_SIZE
+
+# Maximum number of reads issued for a single file, including the ones for the
+# head and tail buffers.
+MAX_READS = 6
+
+# We don't bother with `moov' atoms bigger than this.
+MAX_MOOV_SIZE = 16 * 1024 * 1024
+
+# The format classes only take the fast path if this is set. It's toggled by
+# the benchmark in formats._benchmark to compare both paths.
+enabled = True
+
+_uint16_be = struct.Struct(">H")
+_uint32_be = struct.Struct(">I")
+_uint64_be = struct.Struct(">Q")
+_uint32_le = struct.Struct("<I")
+
+
+class FastReadError(Exception):
+    pass
+
+
+class BlaStreamInfo(object):
+    """
+    Minimal stand-in for mutagen's stream info classes as consumed by
+    BlaTrack._parse_info(). Attributes a format doesn't provide are simply
+    left unset.
+    """
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+def _read(source, offset, size):
+    if source.reads >= MAX_READS:
+        raise FastReadError("Exceeded the maximum number of reads")
+    return source.read(offset, size)
+
+def _reader(func):
+    # Turns everything a malformed file can make our parsing code raise into
+    # FastReadError.
+    @functools.wraps(func)
+    def wrapper(source):
+        try:
+            return func(source)
+        except (IOError, OSError, struct.error, IndexError, KeyError,
+                TypeError, ValueError, UnicodeError) as exc:
+            raise FastReadError(repr(exc))
+    return wrapper
+
+# ID3v2 and MPEG audio
+
+_MPEG_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416,
+             448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320,
+             384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256,
+             320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224,
+             256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+}
+_MPEG_BITRATES[(2, 3)] = _MPEG_BITRATES[(2, 2)]
+
+_MPEG_SAMPLE_RATES = {
+    1: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    2.5: [11025, 12000, 8000]
+}
+
+# Number of bytes scanned for the first MPEG frame after the ID3v2 tag.
+_MPEG_PROBE_SIZE = 16 * 1024
+
+# Frame flags which change the layout of the frame data and which we therefore
+# leave to mutagen. The first entry applies to ID3v2.3, the second one to
+# ID3v2.4.
+_ID3_UNSUPPORTED_FRAME_FLAGS = {3: 0x00c0, 4: 0x000f}
+
+_ID3_ENCODINGS = {0: "latin1", 1: "utf-16", 2: "utf-16-be", 3: "utf-8"}
+
+
+def _syncsafe(data):
+    value = 0
+    for c in data:
+        c = ord(c)
+        if c & 0x80:
+            raise FastReadError("Invalid syncsafe integer")
+        value = (value << 7) | c
+    return value
+
+def _is_frame_id(frame_id):
+    return all("A" <= c <= "Z" or "0" <= c <= "9" for c in frame_id)
+
+def _decode_id3_text(data):
+    # Decodes the data of a text frame into a list of values.
+    encoding = ord(data[0])
+    data = data[1:]
+    if encoding == 0:
+        # Latin-1 text is frequently UTF-8 in disguise.
+        values = []
+        for value in data.split("\0"):
+            value = value.decode("latin1").strip().encode("latin1")
+            try:
+                values.append(value.decode("utf-8"))
+            except UnicodeError:
+                values.append(value.decode("latin1"))
+    else:
+        if encoding in (1, 2) and len(data) % 2:
+            data = data[:-1]
+        values = [value.strip(u"\ufeff").strip() for value in
+                  data.decode(_ID3_ENCODINGS[encoding]).split(u"\0")]
+    while values and not values[-1]:
+        values.pop()
+    return values
+
+def _split_id3_description(data):
+    # Splits the description string off the data of TXXX and WXXX frames.
+    encoding = ord(data[0])
+    if encoding in (1, 2):
+        offset = 1
+        while True:
+            offset = data.index("\0\0", offset)
+            if offset % 2:
+                break
+            offset += 1
+        description, data = data[1:offset], data[offset+2:]
+    else:
+        description, data = data[1:].split("\0", 1)
+    description = description.decode(_ID3_ENCODINGS[encoding])
+    return description.strip(u"\ufeff"), chr(encoding) + data
+
+def _parse_id3v2(source, head):
+    """
+    Parses the text frames of an ID3v2.3 or ID3v2.4 tag at the start of
+    `head'. Returns a dict mapping frame ids to lists of values and the offset
+    of the end of the tag. TXXX frames are stored under "TXXX:<description>".
+    """
+
+    if head[:3] != "ID3" or len(head) < 10:
+        return {}, 0
+    version, flags = ord(head[3]), ord(head[5])
+    # Unsynchronization and extended headers are rare enough to not bother
+    # with them.
+    if version not in (3, 4) or flags & 0xc0:
+        raise FastReadError("Unsupported ID3v2 tag")
+    end = 10 + _syncsafe(head[6:10])
+    unsupported_flags = _ID3_UNSUPPORTED_FRAME_FLAGS[version]
+
+    frames = {}
+    data, base = head, 0
+    offset = 10
+    while offset + 10 <= end:
+        if offset + 10 > base + len(data):
+            data, base = _read(source, offset, HEAD_SIZE), offset
+        header = data[offset-base:offset-base+10]
+        frame_id = header[:4]
+        if frame_id[0] == "\0":
+            # We hit the padding.
+            break
+        if not _is_frame_id(frame_id):
+            raise FastReadError("Invalid ID3v2 frame id %r" % frame_id)
+        if version == 4:
+            size = _syncsafe(header[4:8])
+        else:
+            size = _uint32_be.unpack(header[4:8])[0]
+        frame_flags = _uint16_be.unpack(header[8:10])[0]
+        start = offset + 10
+        offset = start + size
+        if offset > end:
+            raise FastReadError("ID3v2 frame exceeds the tag")
+        if frame_id[0] != "T" and frame_id != "WXXX" or size == 0:
+            continue
+        if frame_flags & unsupported_flags:
+            raise FastReadError("Unsupported ID3v2 frame flags")
+
+        if offset > base + len(data):
+            data, base = _read(source, start, max(size, HEAD_SIZE)), start
+        payload = data[start-base:offset-base]
+        if frame_id == "WXXX":
+            description, payload = _split_id3_description(payload)
+            frames[frame_id] = [payload[1:].split("\0")[0].decode("latin1")]
+        elif frame_id == "TXXX":
+            description, payload = _split_id3_description(payload)
+            frames["TXXX:%s" % description] = _decode_id3_text(payload)
+        else:
+            frames[frame_id] = _decode_id3_text(payload)
+
+    # Map ID3v2.3 dates to their ID3v2.4 counterparts like mutagen does.
+    if "TYER" in frames and "TDRC" not in frames:
+        date = frames["TYER"][0]
+        tdat = (frames.get("TDAT") or [""])[0]
+        time = (frames.get("TIME") or [""])[0]
+        if len(tdat) == 4:
+            date += "-%s-%s" % (tdat[2:], tdat[:2])
+            if len(time) == 4:
+                date += "T%s:%s" % (time[:2], time[2:])
+        frames["TDRC"] = [date]
+    if "TORY" in frames and "TDOR" not in frames:
+        frames["TDOR"] = frames["TORY"]
+
+    if flags & 0x10:
+        end += 10
+    return frames, end
+
+def _parse_id3v1(data):
+    if len(data) != 128 or data[:3] != "TAG":
+        return {}
+    title, artist, album, year, comment, track, genre = struct.unpack(
+        "3x30s30s30s4s29sBB", data)
+
+    frames = {}
+    for frame_id, value in [("TIT2", title), ("TPE1", artist),
+                            ("TALB", album), ("TDRC", year)]:
+        value = value.split("\0")[0].strip().decode("latin1")
+        if value:
+            frames[frame_id] = [value]
+    # A zero byte before the track number marks an ID3v1.1 tag.
+    if track and (track != 32 or data[-3] == "\0"):
+        frames["TRCK"] = [unicode(track)]
+    if genre != 255:
+        frames["TCON"] = [unicode(genre)]
+    return frames
+
+def _parse_mpeg_header(data, offset):
+    # Returns a tuple (version, layer, bitrate, sampling rate, padding, mode)
+    # for a valid MPEG audio frame header at `offset', or None otherwise.
+    header = _uint32_be.unpack_from(data, offset)[0]
+    if header >> 21 != 0x7ff:
+        return None
+    version = (header >> 19) & 3
+    layer = 4 - ((header >> 17) & 3)
+    bitrate = (header >> 12) & 0xf
+    sampling_rate = (header >> 10) & 3
+    if version == 1 or layer == 4 or bitrate in (0, 15) or sampling_rate == 3:
+        return None
+    version = {0: 2.5, 2: 2, 3: 1}[version]
+    bitrate = _MPEG_BITRATES[(int(version), layer)][bitrate] * 1000
+    sampling_rate = _MPEG_SAMPLE_RATES[version][sampling_rate]
+    padding = (header >> 9) & 1
+    mode = (header >> 6) & 3
+    return version, layer, bitrate, sampling_rate, padding, mode
+
+def _mpeg_frame_size(version, layer, bitrate, sampling_rate, padding):
+    if layer == 1:
+        return (12 * bitrate // sampling_rate + padding) * 4
+    if layer == 3 and version != 1:
+        return 72 * bitrate // sampling_rate + padding
+    return 144 * bitrate // sampling_rate + padding
+
+def _find_mpeg_frame(data):
+    # Returns the offset and the parsed header of the first frame in `data'
+    # which is followed by another valid frame header.
+    offset = data.find("\xff")
+    while 0 <= offset <= len(data) - 4:
+        header = _parse_mpeg_header(data, offset)
+        if header is not None:
+            next_offset = offset + _mpeg_frame_size(*header[:5])
+            if (next_offset + 4 <= len(data) and
+                _parse_mpeg_header(data, next_offset) is not None):
+                return offset, header
+        offset = data.find("\xff", offset + 1)
+    raise FastReadError("No MPEG audio frame found")
+
+@_reader
+def read_mp3(source):
+    """
+    Returns a tuple (frames, frames_id3v1, info) where `frames' are the text
+    frames of the ID3v2 tag as returned by _parse_id3v2(), `frames_id3v1'
+    holds the fields of the ID3v1 tag mapped to their ID3v2 frame ids, and
+    `info' is a BlaStreamInfo instance.
+    """
+
+    head = source.head
+    frames, start = _parse_id3v2(source, head)
+
+    if start + _MPEG_PROBE_SIZE <= len(head) or len(head) == source.size:
+        data = head[start:start+_MPEG_PROBE_SIZE]
+    else:
+        data = _read(source, start, _MPEG_PROBE_SIZE)
+    offset, (version, layer, bitrate, sampling_rate, padding, mode) = (
+        _find_mpeg_frame(data))
+
+    frames_id3v1 = _parse_id3v1(source.tail[-128:])
+
+    # Look for a Xing or VBRI header in the first frame.
+    samples_per_frame = 384 if layer == 1 else 1152
+    if layer == 3 and version != 1:
+        samples_per_frame = 576
+    if version == 1:
+        xing_offset = 17 if mode == 3 else 32
+    else:
+        xing_offset = 9 if mode == 3 else 17
+    xing_offset += offset + 4
+    n_frames = n_bytes = None
+    if data[xing_offset:xing_offset+4] in ("Xing", "Info"):
+        flags = _uint32_be.unpack_from(data, xing_offset + 4)[0]
+        position = xing_offset + 8
+        if flags & 1:
+            n_frames = _uint32_be.unpack_from(data, position)[0]
+            position += 4
+        if flags & 2:
+            n_bytes = _uint32_be.unpack_from(data, position)[0]
+    elif data[offset+36:offset+40] == "VBRI":
+        n_bytes, n_frames = struct.unpack_from(">II", data, offset + 46)
+
+    if n_frames:
+        length = n_frames * samples_per_frame / float(sampling_rate)
+        if n_bytes:
+            bitrate = int(n_bytes * 8 / length)
+    else:
+        size = source.size - start - offset
+        if frames_id3v1:
+            size -= 128
+        length = size * 8 / float(bitrate)
+    if length <= 0:
+        raise FastReadError("Invalid duration")
+
+    info = BlaStreamInfo(sample_rate=sampling_rate, bitrate=bitrate,
+                         mode=mode, length=length)
+    return frames, frames_id3v1, info
+
+# Vorbis comments
+
+def _parse_vorbis_comment(data, offset=0):
+    # Parses a Vorbis comment block into a dict mapping lowercase keys to
+    # lists of values, i.e. the same view mutagen's VCommentDict provides.
+    vendor_length = _uint32_le.unpack_from(data, offset)[0]
+    offset += 4 + vendor_length
+    n_comments = _uint32_le.unpack_from(data, offset)[0]
+    offset += 4
+    tags = {}
+    for _ in xrange(n_comments):
+        length = _uint32_le.unpack_from(data, offset)[0]
+        offset += 4
+        comment = data[offset:offset+length]
+        offset += length
+        if len(comment) != length:
+            raise FastReadError("Truncated Vorbis comment")
+        try:
+            key, value = comment.split("=", 1)
+        except ValueError:
+            continue
+        # Keys are restricted to ASCII.
+        key.decode("ascii")
+        tags.setdefault(key.lower(), []).append(
+            value.decode("utf-8", "replace"))
+    return tags
+
+@_reader
+def read_flac(source):
+    """
+    Returns a tuple (tags, info) of the Vorbis comments and the STREAMINFO
+    block of a native FLAC file.
+    """
+
+    data = source.head
+    if data[:4] != "fLaC":
+        raise FastReadError("Not a native FLAC stream")
+
+    tags = info = None
+    base, offset = 0, 4
+    last = False
+    while not last and (tags is None or info is None):
+        if offset + 4 > base + len(data):
+            data, base = _read(source, offset, HEAD_SIZE), offset
+        header = _uint32_be.unpack_from(data, offset - base)[0]
+        last = bool(header & 0x80000000)
+        type_ = (header >> 24) & 0x7f
+        length = header & 0xffffff
+        start = offset + 4
+        offset = start + length
+        # Only read the block if we actually need it. This lets us skip over
+        # embedded pictures.
+        if type_ not in (0, 4):
+            continue
+        if offset > base + len(data):
+            data, base = _read(source, start, max(length, HEAD_SIZE)), start
+        block = data[start-base:offset-base]
+        if len(block) != length:
+            raise FastReadError("Truncated metadata block")
+
+        if type_ == 0:
+            # STREAMINFO: 20 bits sampling rate, 3 bits channels, 5 bits bits
+            # per sample, 36 bits total samples.
+            value = _uint64_be.unpack_from(block, 10)[0]
+            sampling_rate = value >> 44
+            channels = ((value >> 41) & 7) + 1
+            n_samples = value & 0xfffffffff
+            if not sampling_rate:
+                raise FastReadError("Invalid sampling rate")
+            info = BlaStreamInfo(
+                sample_rate=sampling_rate, channels=channels,
+                length=n_samples / float(sampling_rate))
+        else:
+            tags = _parse_vorbis_comment(block)
+
+    if info is None:
+        raise FastReadError("Missing STREAMINFO block")
+    return tags or {}, info
+
+@_reader
+def read_flac_cuesheet(source):
+    """
+    Returns a list of (track number, start offset in seconds) tuples from the
+    CUESHEET block of a native FLAC file, or None if it doesn't have one. The
+    lead-out track is not included.
+    """
+
+    data = source.head
+    if data[:4] != "fLaC":
+        raise FastReadError("Not a native FLAC stream")
+
+    sampling_rate = None
+    base, offset = 0, 4
+    last = False
+    while not last:
+        if offset + 4 > base + len(data):
+            data, base = _read(source, offset, HEAD_SIZE), offset
+        header = _uint32_be.unpack_from(data, offset - base)[0]
+        last = bool(header & 0x80000000)
+        type_ = (header >> 24) & 0x7f
+        length = header & 0xffffff
+        start = offset + 4
+        offset = start + length
+        if type_ not in (0, 5):
+            continue
+        if offset > base + len(data):
+            data, base = _read(source, start, max(length, HEAD_SIZE)), start
+        block = data[start-base:offset-base]
+        if len(block) != length:
+            raise FastReadError("Truncated metadata block")
+
+        if type_ == 0:
+            sampling_rate = _uint64_be.unpack_from(block, 10)[0] >> 44
+            continue
+        if not sampling_rate:
+            raise FastReadError("Invalid sampling rate")
+
+        # Media catalog number (128 bytes), lead-in (8), flags and reserved
+        # (259), followed by the track count and the tracks themselves.
+        n_tracks = ord(block[395])
+        pos = 396
+        points = []
+        for _ in xrange(n_tracks):
+            track_offset = _uint64_be.unpack_from(block, pos)[0]
+            number = ord(block[pos+8])
+            n_indices = ord(block[pos+35])
+            pos += 36
+            # The track starts at index point 1, or the first index point if
+            # there is none.
+            index_offset = None
+            for _ in xrange(n_indices):
+                value = _uint64_be.unpack_from(block, pos)[0]
+                if index_offset is None or ord(block[pos+8]) == 1:
+                    index_offset = value
+                pos += 12
+            if number in (170, 255):
+                break
+            points.append((number, (track_offset + (index_offset or 0)) /
+                           float(sampling_rate)))
+        return points
+    return None
+
+def _iter_ogg_packets(data):
+    # Yields (serial number, packet) pairs for all packets which end within
+    # `data'. Packets continued across pages are put back together.
+    offset = 0
+    packets = {}
+    while offset + 27 <= len(data):
+        if data[offset:offset+4] != "OggS":
+            raise FastReadError("Lost Ogg page sync")
+        serial = _uint32_le.unpack_from(data, offset + 14)[0]
+        n_segments = ord(data[offset+26])
+        lacing = data[offset+27:offset+27+n_segments]
+        offset += 27 + n_segments
+        packet = packets.pop(serial, "")
+        for c in lacing:
+            size = ord(c)
+            packet += data[offset:offset+size]
+            offset += size
+            if offset > len(data):
+                raise FastReadError("Packet exceeds the data read")
+            if size < 255:
+                yield serial, packet
+                packet = ""
+        if packet:
+            packets[serial] = packet
+
+@_reader
+def read_ogg_vorbis(source):
+    """
+    Returns a tuple (tags, info) of the Vorbis comments and the stream
+    information of an Ogg Vorbis file.
+    """
+
+    head = source.head
+    tags = info = None
+    serial = None
+    # The identification and the comment header are the first two packets of
+    # the stream. A comment header which doesn't fit into the head (think
+    # embedded cover art) leaves `tags' unset and makes us bail out below.
+    try:
+        for serial_, packet in _iter_ogg_packets(head):
+            if serial is None:
+                if packet[:7] != "\x01vorbis":
+                    raise FastReadError("Not a Vorbis stream")
+                serial = serial_
+                (channels, sampling_rate, max_bitrate, nominal_bitrate,
+                 min_bitrate) = struct.unpack_from("<BIiii", packet, 11)
+                if not sampling_rate:
+                    raise FastReadError("Invalid sampling rate")
+            elif serial_ == serial:
+                if packet[:7] != "\x03vorbis":
+                    raise FastReadError("Missing comment header")
+                tags = _parse_vorbis_comment(packet, 7)
+                break
+    except FastReadError:
+        if serial is None:
+            raise
+    if tags is None:
+        raise FastReadError("Comment header not found")
+
+    # The granule position of the last page gives the number of samples.
+    tail = source.tail
+    offset = tail.rfind("OggS")
+    while offset >= 0:
+        granule, serial_ = struct.unpack_from("<qI", tail, offset + 6)
+        if serial_ == serial and granule >= 0:
+            break
+        offset = tail.rfind("OggS", 0, offset)
+    else:
+        raise FastReadError("Last Ogg page not found")
+
+    # Mimic mutagen's sanity checks of the bitrate fields.
+    if nominal_bitrate == 0:
+        bitrate = (max_bitrate + min_bitrate) // 2
+    elif max_bitrate and max_bitrate < nominal_bitrate:
+        bitrate = max_bitrate
+    elif min_bitrate > nominal_bitrate:
+        bitrate = min_bitrate
+    else:
+        bitrate = nominal_bitrate
+
+    info = BlaStreamInfo(
+        sample_rate=sampling_rate, channels=channels, bitrate=bitrate,
+        length=granule / float(sampling_rate))
+    return tags, info
+
+# MP4
+
+def _iter_atoms(data, start, end):
+    # Yields (name, start, end) tuples for the atoms in data[start:end] where
+    # `start' points past the atom header.
+    offset = start
+    while offset + 8 <= end:
+        size, name = struct.unpack_from(">I4s", data, offset)
+        header_size = 8
+        if size == 1:
+            size = _uint64_be.unpack_from(data, offset + 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size or offset + size > end:
+            raise FastReadError("Invalid atom size")
+        yield name, offset + header_size, offset + size
+        offset += size
+
+def _find_atom(data, start, end, *path):
+    for name in path:
+        for name_, start_, end_ in _iter_atoms(data, start, end):
+            if name_ == name:
+                start, end = start_, end_
+                break
+        else:
+            return None
+    return start, end
+
+def _read_descriptor_length(data, offset):
+    length = 0
+    for _ in xrange(4):
+        c = ord(data[offset])
+        offset += 1
+        length = (length << 7) | (c & 0x7f)
+        if not c & 0x80:
+            break
+    return length, offset
+
+def _parse_esds(data, start, end):
+    # Returns the average bitrate from an `esds' atom's DecoderConfig
+    # descriptor.
+    offset = start + 4
+    if ord(data[offset]) != 0x03:
+        raise FastReadError("Missing ES descriptor")
+    length, offset = _read_descriptor_length(data, offset + 1)
+    flags = ord(data[offset+2])
+    if flags & 0xe0:
+        raise FastReadError("Unsupported ES descriptor flags")
+    offset += 3
+    if ord(data[offset]) != 0x04:
+        raise FastReadError("Missing decoder config descriptor")
+    length, offset = _read_descriptor_length(data, offset + 1)
+    return _uint32_be.unpack_from(data, offset + 9)[0]
+
+def _parse_mp4_info(data, start, end):
+    for name, trak_start, trak_end in _iter_atoms(data, start, end):
+        if name != "trak":
+            continue
+        hdlr = _find_atom(data, trak_start, trak_end, "mdia", "hdlr")
+        if hdlr is None or data[hdlr[0]+8:hdlr[0]+12] != "soun":
+            continue
+
+        mdhd_start = _find_atom(data, trak_start, trak_end, "mdia", "mdhd")[0]
+        if ord(data[mdhd_start]) == 0:
+            timescale, duration = struct.unpack_from(
+                ">II", data, mdhd_start + 12)
+        else:
+            timescale, duration = struct.unpack_from(
+                ">IQ", data, mdhd_start + 20)
+        if not timescale:
+            raise FastReadError("Invalid timescale")
+
+        stsd = _find_atom(data, trak_start, trak_end, "mdia", "minf", "stbl",
+                          "stsd")
+        if stsd is None:
+            raise FastReadError("Missing sample description")
+        entry = stsd[0] + 8
+        format_ = data[entry+4:entry+8]
+        channels = _uint16_be.unpack_from(data, entry + 24)[0]
+        sampling_rate = _uint32_be.unpack_from(data, entry + 32)[0] >> 16
+        bitrate = 0
+        if format_ == "mp4a":
+            entry_end = entry + _uint32_be.unpack_from(data, entry)[0]
+            esds = _find_atom(data, entry + 36, entry_end, "esds")
+            if esds is not None:
+                bitrate = _parse_esds(data, *esds)
+        return BlaStreamInfo(
+            sample_rate=sampling_rate, channels=channels, bitrate=bitrate,
+            length=duration / float(timescale))
+    raise FastReadError("No audio track found")
+
+def _parse_ilst(data, start, end):
+    # Returns the tags in the same form as mutagen's MP4Tags, limited to the
+    # text atoms, track and disc numbers, and freeform atoms.
+    tags = {}
+    for name, atom_start, atom_end in _iter_atoms(data, start, end):
+        if name == "----":
+            mean = key = ""
+            values = []
+            for name_, start_, end_ in _iter_atoms(data, atom_start, atom_end):
+                if name_ == "mean":
+                    mean = data[start_+4:end_]
+                elif name_ == "name":
+                    key = data[start_+4:end_]
+                elif name_ == "data":
+                    values.append(data[start_+8:end_])
+            tags["----:%s:%s" % (mean, key)] = values
+            continue
+
+        values = []
+        for name_, start_, end_ in _iter_atoms(data, atom_start, atom_end):
+            if name_ != "data":
+                continue
+            type_ = _uint32_be.unpack_from(data, start_)[0] & 0xffffff
+            payload = data[start_+8:end_]
+            if name in ("trkn", "disk"):
+                values.append(struct.unpack_from(">HH", payload, 2))
+            elif type_ == 1:
+                values.append(payload.decode("utf-8"))
+            elif type_ == 2:
+                values.append(payload.decode("utf-16-be"))
+        if values:
+            tags[name] = values
+    return tags
+
+@_reader
+def read_mp4(source):
+    """
+    Returns a tuple (tags, info) of the iTunes metadata in `moov/udta' and the
+    stream information of the first audio track of an MP4 file.
+    """
+
+    # Walk the top-level atoms until we hit `moov'. Every atom not contained
+    # in the head costs us another read, but files rarely have more than a
+    # handful of top-level atoms.
+    data, base = source.head, 0
+    offset = 0
+    while True:
+        if offset + 16 > base + len(data):
+            data, base = _read(source, offset, HEAD_SIZE), offset
+        header = data[offset-base:offset-base+16]
+        if len(header) < 8:
+            raise FastReadError("No moov atom found")
+        size, name = struct.unpack_from(">I4s", header)
+        header_size = 8
+        if size == 1:
+            size = _uint64_be.unpack_from(header, 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = source.size - offset
+        if size < header_size:
+            raise FastReadError("Invalid atom size")
+        if name == "moov":
+            break
+        offset += size
+
+    if size > MAX_MOOV_SIZE:
+        raise FastReadError("moov atom too big")
+    if offset + size > base + len(data):
+        data, base = _read(source, offset, size), offset
+    data = data[offset-base:offset-base+size]
+    if len(data) != size:
+        raise FastReadError("Truncated moov atom")
+
+    info = _parse_mp4_info(data, header_size, size)
+    ilst = _find_atom(data, header_size, size, "udta", "meta")
+    tags = {}
+    if ilst is not None:
+        # `meta' is a full atom, i.e. its children follow a version and flags
+        # field.
+        ilst = _find_atom(data, ilst[0] + 4, ilst[1], "ilst")
+        if ilst is not None:
+            tags = _parse_ilst(data, *ilst)
+    return tags, info
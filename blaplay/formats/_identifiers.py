@@ -14,11 +14,14 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
-N_IDENTIFIERS = 21
+N_IDENTIFIERS = 28
 
+# New identifiers must be appended as tracks are persisted with them.
 (ARTIST, TITLE, ALBUM, DATE, GENRE, COMPOSER, PERFORMER, ALBUM_ARTIST, TRACK,
  DISC, URI, MONITORED_DIRECTORY, MTIME, FILESIZE, LENGTH, SAMPLING_RATE,
- CHANNELS, CHANNEL_MODE, BITRATE, FORMAT, ENCODING) = xrange(N_IDENTIFIERS)
+ CHANNELS, CHANNEL_MODE, BITRATE, FORMAT, ENCODING, OFFSET_START,
+ OFFSET_END, COVER_ART, REPLAYGAIN_TRACK_GAIN, REPLAYGAIN_TRACK_PEAK,
+ REPLAYGAIN_ALBUM_GAIN, REPLAYGAIN_ALBUM_PEAK) = xrange(N_IDENTIFIERS)
 
 IDENTIFIER_LABELS = [
     # tags
@@ -28,7 +31,8 @@
     # properties
     "Path", "Monitored directory", "Last modified", "Filesize", "Duration",
     "Sampling rate", "Channels", "Channel mode", "Bitrate", "Format",
-    "Encoding"
+    "Encoding", "Start offset", "End offset", "Cover art", "Track gain",
+    "Track peak", "Album gain", "Album peak"
 ]
 
 IDENTIFIER_TAGS = xrange(10)
@@ -22,8 +22,11 @@
 
 
 class Asf(BlaTrack):
-    __slots__ = ("extensions", "__tag_to_literal", "__literal_to_tag")
+    __slots__ = (
+        "extensions", "magic", "__tag_to_literal", "__literal_to_tag")
     extensions = ["wma"]
+    # ASF header object GUID
+    magic = [(0, "\x30\x26\xb2\x75\x8e\x66\xcf\x11")]
     __tag_to_literal = {
         "Author": ARTIST,
         "Title": TITLE,
@@ -44,7 +47,7 @@ class Asf(BlaTrack):
     __literal_to_tag = dict(
         zip(__tag_to_literal.values(), __tag_to_literal.keys()))
 
-    def _read_tags(self):
+    def _read_tags(self, source):
         try:
             audio = _Asf(self.uri)
         except AsfError:
@@ -94,6 +97,6 @@ def _save(self):
                 tag = identifier
             tags[tag] = values
 
-        audio.save()
+        self._save_file(audio)
         return True
 
@@ -23,6 +23,7 @@
 
 from _blatrack import BlaTrack
 from blaplay.formats import TagParseError
+import _fastread
 from _identifiers import *
 
 # This is a mapping between the Mutagen encoding constants and their string
@@ -36,9 +37,17 @@ def isascii(string):
 
 class Mp3(BlaTrack):
     __slots__ = (
-        "extensions", "__idv3v1", "__tag_to_literal", "__literal_to_tag"
+        "extensions", "magic", "__idv3v1", "__tag_to_literal",
+        "__literal_to_tag"
     )
     extensions = ["mp2", "mp3"]
+    # Files without an ID3v2 tag start right away with the sync word of the
+    # first frame (MPEG 1, 2 and 2.5, layer II and III).
+    magic = [
+        (0, "ID3"), (0, "\xff\xe2"), (0, "\xff\xe3"), (0, "\xff\xf2"),
+        (0, "\xff\xf3"), (0, "\xff\xf4"), (0, "\xff\xf5"), (0, "\xff\xfa"),
+        (0, "\xff\xfb"), (0, "\xff\xfc"), (0, "\xff\xfd")
+    ]
     # Those are tags that we could get from id3v1 and id3v2. In case they're
     # not present in the id3v2 tags we check in id3v1.
     __id3v1 = [
@@ -109,7 +118,43 @@ def fix_encoding(s):
 
         return frames
 
-    def _read_tags(self):
+    def _read_tags(self, source):
+        try:
+            if not _fastread.enabled:
+                raise _fastread.FastReadError
+            self.__read_tags_fast(source)
+        except _fastread.FastReadError:
+            self.__read_tags_mutagen()
+        self[FORMAT] = "MP3"
+        self[ENCODING] = "lossy"
+
+    def __read_tags_fast(self, source):
+        frames, frames_id3v1, info = _fastread.read_mp3(source)
+
+        for tag, identifier in self.__tag_to_literal.iteritems():
+            try:
+                values = frames[tag]
+            except KeyError:
+                if tag not in self.__id3v1 or tag not in frames_id3v1:
+                    continue
+                values = frames_id3v1[tag]
+                # ID3v1 tags store the genre as index into the list of
+                # genres defined by the spec.
+                if tag == "TCON":
+                    values = id3.TCON(encoding=3, text=values).genres
+            self[identifier] = values
+
+        for key, values in frames.iteritems():
+            if not key.startswith("TXXX:"):
+                continue
+            desc = key[5:]
+            if desc == "ALBUM ARTIST":
+                desc = ALBUM_ARTIST
+            self[desc] = values
+
+        self._parse_info(info)
+
+    def __read_tags_mutagen(self):
         def fix_encoding(args):
             text, enc = args
             if enc == 0:
@@ -175,8 +220,15 @@ def fix_encoding(args):
                 fix_encoding, zip(tag.text, [enc] * len(value)))
 
         self._parse_info(audio.info)
-        self[FORMAT] = "MP3"
-        self[ENCODING] = "lossy"
+
+    @classmethod
+    def _read_picture(cls, source):
+        try:
+            tags = id3.ID3(source.path)
+        except id3.error:
+            return None
+        return cls._pick_picture([(frame.type, frame.mime, frame.data)
+                                  for frame in tags.getall("APIC")])
 
     def _save(self):
         try:
@@ -227,9 +279,9 @@ def _save(self):
             tags.add(id3.Frames[tag](**kwargs))
 
         try:
-            audio.save()
+            self._save_file(audio)
         except NameError:
-            tags.save(self.uri)
+            self._save_file(tags, self.uri)
             return False
         return True
 
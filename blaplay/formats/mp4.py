@@ -14,16 +14,22 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
-from mutagen.mp4 import MP4 as _Mp4, error as Mp4Error
+from mutagen.mp4 import MP4 as _Mp4, MP4Cover, error as Mp4Error
 
 from _blatrack import BlaTrack
 from blaplay.formats import TagParseError
+import _fastread
 from _identifiers import *
 
 
 class Mp4(BlaTrack):
-    __slots__ = ("extensions", "__tag_to_literal", "__literal_to_tag")
+    __slots__ = (
+        "extensions", "magic", "__tag_to_literal", "__literal_to_tag",
+        "_replaygain_prefix")
     extensions = ["aac", "m4a", "mp4"]
+    # The major brands of audio-only files are more specific than the generic
+    # `ftyp' match we share with the video parser.
+    magic = [(4, "ftyp"), (4, "ftypM4A "), (4, "ftypM4B "), (4, "ftypM4P ")]
     # Freeform keys begin with "----" (four dashes).
     __tag_to_literal = {
         "\xa9ART": ARTIST,
@@ -42,14 +48,21 @@ class Mp4(BlaTrack):
     }
     __literal_to_tag = dict(
         zip(__tag_to_literal.values(), __tag_to_literal.keys()))
+    _replaygain_prefix = "com.apple.iTunes:"
 
-    def _read_tags(self):
+    def _read_tags(self, source):
         try:
-            audio = _Mp4(self.uri)
-        except Mp4Error:
-            raise TagParseError
+            if not _fastread.enabled:
+                raise _fastread.FastReadError
+            tags, info = _fastread.read_mp4(source)
+        except _fastread.FastReadError:
+            try:
+                audio = _Mp4(self.uri)
+            except Mp4Error:
+                raise TagParseError
+            tags, info = audio.tags or {}, audio.info
 
-        for key, values in (audio.tags or {}).iteritems():
+        for key, values in tags.iteritems():
             if key in ("disk", "trkn"):
                 value = ["%d/%d" % values[0]]
             elif key.startswith("----:"):
@@ -64,10 +77,24 @@ def _read_tags(self):
             except KeyError:
                 self[key] = value
 
-        self._parse_info(audio.info)
+        self._parse_info(info)
         self[FORMAT] = "MPEG-4 AAC"
         self[ENCODING] = "lossy" if self[BITRATE] else "lossless"
 
+    @staticmethod
+    def _read_picture(source):
+        try:
+            audio = _Mp4(source.path)
+        except Mp4Error:
+            return None
+        covers = (audio.tags or {}).get("covr")
+        if not covers:
+            return None
+        cover = covers[0]
+        if cover.imageformat == MP4Cover.FORMAT_PNG:
+            return "image/png", str(cover)
+        return "image/jpeg", str(cover)
+
     def _save(self):
         try:
             audio = _Mp4(self.uri)
@@ -119,6 +146,6 @@ def _save(self):
             else:
                 audio[tag] = values
 
-        audio.save()
+        self._save_file(audio)
         return True
 
@@ -21,10 +21,18 @@
 
 
 class Video(BlaTrack):
-    __slots__ = ("extensions", "__tag_to_literal", "__literal_to_tag",
-                 "__split_keys", "__discoverer")
+    __slots__ = ("extensions", "magic", "generic", "__tag_to_literal",
+                 "__literal_to_tag", "__split_keys", "__discoverer")
     extensions = ["avi", "flv", "mkv", "wmv", "mp4", "webm", "divx", "m2v",
                   "mov", "mpg"]
+    # GStreamer handles just about any container so we only take extensions
+    # which no dedicated parser claims.
+    generic = True
+    magic = [
+        (4, "ftyp"), (4, "ftypM4V "), (4, "ftypqt  "), (4, "moov"),
+        (8, "AVI "), (0, "\x1a\x45\xdf\xa3"), (0, "FLV\x01"),
+        (0, "\x00\x00\x01\xba"), (0, "\x30\x26\xb2\x75\x8e\x66\xcf\x11")
+    ]
     __tag_to_literal = {
         gst.TAG_ARTIST: ARTIST,
         gst.TAG_TITLE: TITLE,
@@ -52,7 +60,7 @@ def _parse_info(self, info):
         self[FORMAT] = tags["container-format"]
         self[LENGTH] = int(info.get_duration() / gst.SECOND)
 
-    def _read_tags(self):
+    def _read_tags(self, source):
         # FIXME: this method can quite often block the main loop or at least
         #        slow it down a lot to create jerky animations in the
         #        visualizations. maybe we should look into the async methods
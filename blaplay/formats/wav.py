@@ -22,10 +22,11 @@
 
 
 class Wav(BlaTrack):
-    __slots__ = ("extensions")
+    __slots__ = ("extensions", "magic")
     extensions = ["wav"]
+    magic = [(8, "WAVE")]
 
-    def _read_tags(self):
+    def _read_tags(self, source):
         # The wave module uses fixed sampling rates. Custom sampling rates are
         # therefore mapped to commonly used ones. Additionally, it doesn't
         # detect compression modes like ADPCM. Therefore we just specify
@@ -33,7 +34,7 @@ def _read_tags(self):
         # use-cases anyway.
 
         try:
-            audio = wave.open(self.uri, "r")
+            audio = wave.open(source.file, "r")
         except wave.Error:
             raise TagParseError
 
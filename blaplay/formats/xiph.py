@@ -14,20 +14,25 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
+import struct
+import base64
+
 from mutagen.oggvorbis import OggVorbis, error as OggVorbisError
 from mutagen.oggflac import OggFLAC, error as OggFLACError
-from mutagen.flac import FLAC, error as FLACError
+from mutagen.flac import FLAC, Picture, error as FLACError
 
 from blaplay import blautil
 from _blatrack import BlaTrack
+from _blasource import BlaSource
 from blaplay.formats import TagParseError
+import _fastread
 from _identifiers import *
 
 
 class Xiph(BlaTrack):
     __slots__ = (
-        "__ext_to_format", "extensions", "__tag_to_literal",
-        "__literal_to_tag", "__split_keys"
+        "__ext_to_format", "__fast_readers", "extensions", "magic",
+        "__tag_to_literal", "__literal_to_tag", "__split_keys"
     )
     __ext_to_format = {
         "ogg": (OggVorbis, "OGG Vorbis", "lossy"),
@@ -36,7 +41,12 @@ class Xiph(BlaTrack):
         "flac": (FLAC, "FLAC", "lossless"),
         "oggflac": (OggFLAC, "Ogg FLAC", "lossless")
     }
+    __fast_readers = {
+        OggVorbis: _fastread.read_ogg_vorbis,
+        FLAC: _fastread.read_flac
+    }
     extensions = __ext_to_format.keys()
+    magic = [(0, "fLaC"), (0, "OggS")]
     __tag_to_literal = {
         "artist": ARTIST,
         "title": TITLE,
@@ -56,17 +66,39 @@ class Xiph(BlaTrack):
         DISC: ("discnumber", "totaldiscs")
     }
 
-    def _read_tags(self):
+    @classmethod
+    def __get_format(cls, source):
+        # Determine the container from the stream's magic bytes so misnamed
+        # files are handled by the right mutagen class. The extension only
+        # decides for files we don't recognize.
+        head = source.head
+        if head.startswith("fLaC"):
+            ext = "flac"
+        elif head.startswith("OggS"):
+            ext = "oggflac" if head.startswith("\x7fFLAC", 28) else "ogg"
+        else:
+            ext = blautil.get_extension(source.path).lower()
+        return cls.__ext_to_format[ext]
+
+    def _read_tags(self, source):
         uri = self.uri
-        baseclass, format_, encoding = self.__ext_to_format[
-            blautil.get_extension(uri)]
-
         try:
-            audio = baseclass(uri)
-        except (OggVorbisError, OggFLACError, FLACError):
+            baseclass, format_, encoding = self.__get_format(source)
+        except KeyError:
             raise TagParseError
 
-        for key, values in (audio.tags or {}).iteritems():
+        try:
+            if not _fastread.enabled:
+                raise _fastread.FastReadError
+            tags, info = self.__fast_readers[baseclass](source)
+        except (KeyError, _fastread.FastReadError):
+            try:
+                audio = baseclass(uri)
+            except (OggVorbisError, OggFLACError, FLACError):
+                raise TagParseError
+            tags, info = audio.tags or {}, audio.info
+
+        for key, values in tags.iteritems():
             try:
                 identifier = self.__tag_to_literal[key]
             except KeyError:
@@ -82,17 +114,35 @@ def _read_tags(self):
             if self[identifier] and total in self.keys_tags():
                 self[identifier] += "/" + self.pop(total)
 
-        self._parse_info(audio.info)
+        self._parse_info(info)
         self[FORMAT] = format_
         self[ENCODING] = encoding
 
+    @classmethod
+    def _read_picture(cls, source):
+        # Native FLAC files keep their pictures in PICTURE blocks. In Ogg
+        # streams they're stored as base64-encoded Vorbis comments instead.
+        try:
+            baseclass = cls.__get_format(source)[0]
+            audio = baseclass(source.path)
+        except (KeyError, OggVorbisError, OggFLACError, FLACError):
+            return None
+        pictures = list(getattr(audio, "pictures", []))
+        for value in (audio.tags or {}).get("metadata_block_picture", []):
+            try:
+                pictures.append(Picture(base64.b64decode(value)))
+            except (TypeError, struct.error, FLACError):
+                continue
+        return cls._pick_picture([(picture.type, picture.mime, picture.data)
+                                  for picture in pictures])
+
     def _save(self):
         uri = self.uri
-        baseclass, format_, encoding = self.__ext_to_format[
-            blautil.get_extension(uri)]
         try:
+            with BlaSource(uri) as source:
+                baseclass, format_, encoding = self.__get_format(source)
             audio = baseclass(uri)
-        except IOError:
+        except (IOError, KeyError):
             return False
 
         tags = audio.tags
@@ -132,6 +182,6 @@ def _save(self):
             else:
                 tags[tag] = values
 
-        audio.save()
+        self._save_file(audio)
         return True
 